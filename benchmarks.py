@@ -0,0 +1,1479 @@
+#!/usr/bin/env python
+
+"""
+Benchmarks for the haggling module.
+
+Each benchmark is a function returning a list of result dicts, one per data point.
+Run them from the command line, e.g.
+
+    python benchmarks.py pool --sizes 10000 100000 1000000
+
+Results are printed as a table, and written as JSON with --json. Two JSON runs of
+the suite benchmark can be checked for regressions, e.g.
+
+    python benchmarks.py --json new.json suite
+    python benchmarks.py compare old.json new.json --threshold 0.25
+"""
+
+import argparse
+import asyncio
+import contextlib
+import gc
+import json
+import os
+import pickle
+import random
+import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+
+from haggling import *
+
+
+def _timed(function, *args, **kwargs):
+	"""
+	Runs function(*args, **kwargs) and returns (result, seconds taken).
+	"""
+	start = time.perf_counter()
+	result = function(*args, **kwargs)
+	return result, time.perf_counter() - start
+
+
+def benchPool(sizes, event_sourced=False, memory=False):
+	"""
+	Scaling benchmark for HagglerPool. For each size a pool of that many negotiations
+	is created in bulk, each gets an offer submitted, then is looked up by id and by
+	user, and finally every other negotiation is accepted (and evicted).
+
+	Args:
+	    sizes (list): numbers of negotiations
+	    event_sourced (bool): create event sourced Hagglers
+	    memory (bool): trace allocations to report bytes per open negotiation. This
+	        slows everything down so the timings are not comparable with memory off.
+
+	Returns:
+	    list: a result dict per size
+	"""
+	results = []
+	for size in sizes:
+		gc.collect()
+		if memory:
+			tracemalloc.start()
+
+		pool = HagglerPool(event_sourced=event_sourced, on_end="evict")
+		negotiations = [(i, "buyer{0}".format(i % 10000), "seller{0}".format(i)) for i in range(size)]
+
+		_, create_time = _timed(pool.createMany, negotiations)
+
+		def submitAll():
+			for negotiation_id, buyer, seller in negotiations:
+				pool.submit(negotiation_id, seller, buyer, Offer("widget", 100, 10))
+
+		_, submit_time = _timed(submitAll)
+
+		bytes_per_deal = None
+		if memory:
+			bytes_per_deal = tracemalloc.get_traced_memory()[0] / size
+
+		def lookupAll():
+			get = pool.get
+			for i in range(size):
+				get(i)
+
+		_, lookup_time = _timed(lookupAll)
+
+		def openByUser():
+			for i in range(min(size, 10000)):
+				pool.openNegotiations("buyer{0}".format(i))
+
+		_, user_time = _timed(openByUser)
+
+		def acceptHalf():
+			for negotiation_id, buyer, seller in negotiations[::2]:
+				pool.accept(negotiation_id, buyer)
+
+		_, accept_time = _timed(acceptHalf)
+
+		if memory:
+			tracemalloc.stop()
+
+		results.append({
+			"benchmark": "pool",
+			"negotiations": size,
+			"event_sourced": event_sourced,
+			"create_us": 1e6 * create_time / size,
+			"submit_us": 1e6 * submit_time / size,
+			"lookup_us": 1e6 * lookup_time / size,
+			"open_by_user_us": 1e6 * user_time / min(size, 10000),
+			"accept_evict_us": 1e6 * accept_time / len(negotiations[::2]),
+			"bytes_per_deal": bytes_per_deal,
+			"open_after": len(pool),
+		})
+		del pool, negotiations
+
+	return results
+
+
+def _marketMakerTraffic(negotiations, rounds):
+	"""
+	Builds (negotiation_id, action, user_id, payload) tuples for a replay of
+	market maker traffic: an offer per negotiation, rounds of withdraw, counter
+	offer and stale accept retries, then an accept.
+	"""
+	actions = []
+	for i in range(negotiations):
+		actions.append((i, "submit", "maker", ("taker{0}".format(i), Offer("widget", 100, 10))))
+	for r in range(rounds):
+		for i in range(negotiations):
+			actions.append((i, "withdraw", "maker", None))
+			actions.append((i, "accept", "taker{0}".format(i), None))
+			actions.append((i, "proposeUpdate", "maker", Offer("widget", 100 - r, 10)))
+	for i in range(negotiations):
+		actions.append((i, "accept", "taker{0}".format(i), None))
+		actions.append((i, "accept", "taker{0}".format(i), None))
+	return actions
+
+
+def _replaySingle(pool, actions):
+	for negotiation_id, action, user_id, payload in actions:
+		if action == "submit":
+			pool.submit(negotiation_id, user_id, payload[0], payload[1])
+		elif action == "proposeUpdate":
+			pool.proposeUpdate(negotiation_id, user_id, payload)
+		elif action == "updatePrivateData":
+			pool.updatePrivateData(negotiation_id, user_id, payload)
+		else:
+			getattr(pool, action)(negotiation_id, user_id)
+
+
+def benchBatch(negotiations, rounds):
+	"""
+	Compares replaying market maker traffic through the HagglerPool action methods
+	one by one against a single HagglerPool.applyBatch call. Rejected actions
+	print in both, so stdout is discarded.
+
+	Args:
+	    negotiations (int): number of negotiations
+	    rounds (int): withdraw/accept/proposeUpdate rounds per negotiation
+
+	Returns:
+	    list: a result dict per mode
+	"""
+	actions = _marketMakerTraffic(negotiations, rounds)
+	results = []
+	for mode in ("single", "batch"):
+		pool = HagglerPool(on_end="evict")
+		pool.createMany((i, "maker", "taker{0}".format(i)) for i in range(negotiations))
+		gc.collect()
+
+		with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+			if mode == "single":
+				_, seconds = _timed(_replaySingle, pool, actions)
+			else:
+				_, seconds = _timed(pool.applyBatch, actions)
+
+		results.append({
+			"benchmark": "batch",
+			"mode": mode,
+			"negotiations": negotiations,
+			"actions": len(actions),
+			"seconds": seconds,
+			"actions_per_s": len(actions) / seconds,
+		})
+	return results
+
+
+def benchWal(negotiations, rounds, policies):
+	"""
+	Write throughput of a HagglerPool logging to a WriteAheadLog with each fsync
+	policy, and the time HagglerPool.recover takes to replay the log.
+
+	Args:
+	    negotiations (list): numbers of negotiations - the log size scales with these
+	    rounds (int): withdraw/accept/proposeUpdate rounds per negotiation
+	    policies (list): fsync policies to write with
+
+	Returns:
+	    list: a result dict per (negotiations, policy)
+	"""
+	results = []
+	with tempfile.TemporaryDirectory() as directory:
+		for size in negotiations:
+			actions = _marketMakerTraffic(size, rounds)
+			for policy in policies:
+				path = os.path.join(directory, "{0}-{1}.wal".format(size, policy))
+				pool = HagglerPool(on_end="evict", errors="return", wal=WriteAheadLog(path, policy))
+				gc.collect()
+
+				def write():
+					pool.createMany((i, "maker", "taker{0}".format(i)) for i in range(size))
+					_replaySingle(pool, actions)
+					pool.wal.close()
+
+				_, write_time = _timed(write)
+				records = pool.wal.records
+				del pool
+				gc.collect()
+
+				recovered, recover_time = _timed(HagglerPool.recover, path, FSYNC_NEVER, on_end="evict")
+				recovered.wal.close()
+
+				results.append({
+					"benchmark": "wal",
+					"negotiations": size,
+					"fsync": policy,
+					"records": records,
+					"log_mb": os.path.getsize(path) / 1e6,
+					"write_per_s": (size + len(actions)) / write_time,
+					"recover_s": recover_time,
+					"recover_records_per_s": records / recover_time,
+				})
+				del recovered
+	return results
+
+
+def benchSnapshot(sizes, rounds, compare_pickle=True):
+	"""
+	Time and file size of HagglerPool.snapshot and HagglerPool.restore for pools of
+	negotiations that have each seen some market maker traffic, against pickling
+	the pool.
+
+	Args:
+	    sizes (list): numbers of negotiations
+	    rounds (int): withdraw/accept/proposeUpdate rounds per negotiation
+	    compare_pickle (bool): also time pickle.dump and pickle.load of the pool
+
+	Returns:
+	    list: a result dict per (size, format)
+	"""
+	results = []
+	with tempfile.TemporaryDirectory() as directory:
+		for size in sizes:
+			pool = HagglerPool(errors="return")
+			pool.createMany((i, "maker", "taker{0}".format(i)) for i in range(size))
+			# leave the negotiations open
+			pool.applyBatch([a for a in _marketMakerTraffic(size, rounds) if a[1] != "accept"])
+			formats = ["snapshot", "pickle"] if compare_pickle else ["snapshot"]
+			for name in formats:
+				path = os.path.join(directory, "{0}.{1}".format(size, name))
+				gc.collect()
+				if name == "snapshot":
+					_, save_time = _timed(pool.snapshot, path)
+					gc.collect()
+					restored, load_time = _timed(HagglerPool.restore, path)
+				else:
+					def dump():
+						with open(path, "wb") as f:
+							pickle.dump(pool, f, pickle.HIGHEST_PROTOCOL)
+
+					def load():
+						with open(path, "rb") as f:
+							return pickle.load(f)
+
+					_, save_time = _timed(dump)
+					gc.collect()
+					restored, load_time = _timed(load)
+
+				results.append({
+					"benchmark": "snapshot",
+					"negotiations": size,
+					"format": name,
+					"save_s": save_time,
+					"load_s": load_time,
+					"file_mb": os.path.getsize(path) / 1e6,
+					"restored": len(restored),
+				})
+				del restored
+				os.remove(path)
+			del pool
+	return results
+
+
+def benchArchive(sizes, rounds, queries=10000):
+	"""
+	Python heap held by a HagglerPool whose negotiations have all finished, with the
+	default dict archive against a ColumnarArchive, and the time returnVersion and
+	versionDifferences take on archived negotiations.
+
+	Args:
+	    sizes (list): numbers of negotiations
+	    rounds (int): withdraw/accept/proposeUpdate rounds per negotiation
+	    queries (int): number of each query timed
+
+	Returns:
+	    list: a result dict per (size, archive)
+	"""
+	results = []
+	with tempfile.TemporaryDirectory() as directory:
+		for size in sizes:
+			actions = _marketMakerTraffic(size, rounds)
+			for name in ("dict", "columnar"):
+				gc.collect()
+				tracemalloc.start()
+				archive = None
+				if name == "columnar":
+					archive = ColumnarArchive(os.path.join(directory, "{0}.archive".format(size)), errors="return")
+				pool = HagglerPool(errors="return", archive=archive)
+				pool.createMany((i, "maker", "taker{0}".format(i)) for i in range(size))
+				pool.applyBatch(actions)
+				gc.collect()
+				heap = tracemalloc.get_traced_memory()[0]
+				tracemalloc.stop()
+
+				step = max(1, size // queries)
+				ids = list(range(0, size, step))[:queries]
+				last = 1 + rounds * 2 + 1
+
+				def returnVersions():
+					for i in ids:
+						pool.returnVersion(i, "maker", last)
+
+				def differences():
+					for i in ids:
+						pool.versionDifferences(i, "maker", 1, last)
+
+				_, return_time = _timed(returnVersions)
+				_, differences_time = _timed(differences)
+
+				results.append({
+					"benchmark": "archive",
+					"negotiations": size,
+					"archive": name,
+					"archived": len(pool.archive),
+					"heap_mb": heap / 1e6,
+					"return_version_us": 1e6 * return_time / len(ids),
+					"differences_us": 1e6 * differences_time / len(ids),
+				})
+				if archive is not None:
+					archive.close()
+				del pool, archive
+	return results
+
+
+def _percentile(values, percent):
+	"""
+	Nearest rank percentile of sorted values.
+	"""
+	return values[min(len(values) - 1, int(len(values) * percent / 100))]
+
+
+def benchAsync(negotiations, rounds, queue_size):
+	"""
+	In process load test of AsyncHagglerPool. A client per negotiation runs at the
+	same time as all the others, awaiting each call in turn: create, submit, rounds
+	of withdraw/accept/proposeUpdate, then accept. A second client per negotiation
+	fires its calls without waiting in between to fill the queues.
+
+	Args:
+	    negotiations (list): numbers of concurrent negotiations
+	    rounds (int): withdraw/accept/proposeUpdate rounds per negotiation
+	    queue_size (int): AsyncHagglerPool queue size
+
+	Returns:
+	    list: a result dict per number of negotiations
+	"""
+	async def client(service, i, latencies):
+		taker = "taker{0}".format(i)
+		calls = [(service.create, (i, "maker", taker)), (service.submit, (i, "maker", taker, Offer("widget", 100, 10)))]
+		for r in range(rounds):
+			calls.append((service.withdraw, (i, "maker")))
+			calls.append((service.accept, (i, taker)))
+			calls.append((service.proposeUpdate, (i, "maker", Offer("widget", 100 - r, 10))))
+		for method, args in calls:
+			start = time.perf_counter()
+			await method(*args)
+			latencies.append(time.perf_counter() - start)
+
+	async def burst(service, i):
+		await asyncio.gather(*[service.updatePrivateData(i, "maker", {"round": r}) for r in range(rounds)])
+
+	async def run(size):
+		service = AsyncHagglerPool(queue_size=queue_size, errors="return", on_end="evict")
+		latencies = []
+		start = time.perf_counter()
+		await asyncio.gather(*[client(service, i, latencies) for i in range(size)], *[burst(service, i) for i in range(size)])
+		await service.join()
+		return latencies, time.perf_counter() - start
+
+	results = []
+	for size in negotiations:
+		gc.collect()
+		latencies, seconds = asyncio.run(run(size))
+		latencies.sort()
+		calls = len(latencies) + size * rounds
+		results.append({
+			"benchmark": "async",
+			"negotiations": size,
+			"queue_size": queue_size,
+			"calls": calls,
+			"calls_per_s": calls / seconds,
+			"p50_ms": 1e3 * _percentile(latencies, 50),
+			"p95_ms": 1e3 * _percentile(latencies, 95),
+			"p99_ms": 1e3 * _percentile(latencies, 99),
+		})
+	return results
+
+
+# joint states the two Users of a negotiation can be in after a withdraw or proposeUpdate
+_JOINT_STATES = {
+	("AwaitingMyAcceptance", "AwaitingTheirAcceptance"),
+	("AwaitingTheirAcceptance", "AwaitingMyAcceptance"),
+	("WithdrawnByMe", "WithdrawnByThem"),
+	("WithdrawnByThem", "WithdrawnByMe"),
+}
+
+
+def benchThreads(threads, negotiations, operations):
+	"""
+	Contention benchmark for ThreadSafeHaggler. For each thread count, that many
+	writer threads withdraw and counter offer on negotiations picked from a shared
+	set - fewer negotiations means more contention - while the same number of
+	reader threads check that both Users are in matching states and call
+	versionDifferences as many times. Runs with a plain pool too, where readers read the Users
+	directly, to count the torn states locking prevents.
+
+	Args:
+	    threads (list): numbers of writer (and reader) threads
+	    negotiations (int): number of negotiations shared by the threads
+	    operations (int): withdraw/proposeUpdate pairs per writer thread, and reads
+	        per reader thread
+
+	Returns:
+	    list: a result dict per (thread count, mode)
+	"""
+	results = []
+	for count in threads:
+		for threadsafe in (False, True):
+			pool = HagglerPool(errors="return", threadsafe=threadsafe)
+			pool.createMany((i, "maker", "taker{0}".format(i)) for i in range(negotiations))
+			for i in range(negotiations):
+				pool.submit(i, "maker", "taker{0}".format(i), Offer("widget", 100, 10))
+			hagglers = [pool.get(i) for i in range(negotiations)]
+			torn = []
+
+			def write(seed):
+				for n in range(operations):
+					i = (seed + n * 7919) % negotiations
+					user_id = "maker" if n % 2 else "taker{0}".format(i)
+					pool.withdraw(i, user_id)
+					pool.proposeUpdate(i, user_id, Offer("widget", n % 100, 10))
+
+			def read(seed):
+				bad = 0
+				for n in range(seed, seed + operations):
+					i = n % negotiations
+					users = (hagglers[i].view if threadsafe else hagglers[i]).users
+					if (users["maker"].state, users["taker{0}".format(i)].state) not in _JOINT_STATES:
+						bad += 1
+					pool.versionDifferences(i, "maker", 1, 2)
+				torn.append(bad)
+
+			workers = [threading.Thread(target=write, args=(t,)) for t in range(count)]
+			workers += [threading.Thread(target=read, args=(t,)) for t in range(count)]
+			start = time.perf_counter()
+			for thread in workers:
+				thread.start()
+			for thread in workers:
+				thread.join()
+			seconds = time.perf_counter() - start
+
+			results.append({
+				"benchmark": "threads",
+				"threads": count,
+				"threadsafe": threadsafe,
+				"negotiations": negotiations,
+				"writes_per_s": 2 * count * operations / seconds,
+				"reads_per_s": count * operations / seconds,
+				"torn_reads": sum(torn),
+			})
+	return results
+
+
+def benchShards(workers, negotiations, rounds, batch_size):
+	"""
+	Throughput of ShardedHagglerPool against worker count, replaying market maker
+	traffic in applyBatch calls of batch_size actions. Worker count 0 is a plain
+	HagglerPool in this process, for comparison.
+
+	Args:
+	    workers (list): worker counts
+	    negotiations (int): number of negotiations
+	    rounds (int): withdraw/accept/proposeUpdate rounds per negotiation
+	    batch_size (int): actions per applyBatch call
+
+	Returns:
+	    list: a result dict per worker count
+	"""
+	actions = _marketMakerTraffic(negotiations, rounds)
+	batches = [actions[i:i + batch_size] for i in range(0, len(actions), batch_size)]
+	results = []
+	for count in workers:
+		if count:
+			pool = ShardedHagglerPool(count, errors="return", on_end="evict")
+		else:
+			pool = HagglerPool(errors="return", on_end="evict")
+		pool.createMany((i, "maker", "taker{0}".format(i)) for i in range(negotiations))
+		gc.collect()
+
+		def replay():
+			for batch in batches:
+				pool.applyBatch(batch)
+
+		_, seconds = _timed(replay)
+		if count:
+			pool.close()
+		results.append({
+			"benchmark": "shards",
+			"workers": count,
+			"negotiations": negotiations,
+			"batch_size": batch_size,
+			"actions_per_s": len(actions) / seconds,
+		})
+	return results
+
+
+# operations timed by the suite benchmark
+SUITE_OPERATIONS = (
+	"submit",
+	"proposeUpdate",
+	"withdraw",
+	"accept",
+	"cancel",
+	"updatePrivateData",
+	"returnVersion",
+	"versionDifferences",
+	"printHistory",
+)
+
+# keys identifying the same measurement in two runs of the suite
+_SUITE_KEYS = ("benchmark", "dimension", "history", "private_info", "live", "operation")
+
+
+def _grow(pool, negotiation_id, taker, length):
+	"""
+	Submits an offer on a created negotiation then has the two Users take turns
+	to counter offer until each User has length versions.
+
+	Returns:
+	    tuple: (user id of the last to offer, user id of the other)
+	"""
+	pool.submit(negotiation_id, "maker", taker, Offer("widget", 100, 10))
+	users = ("maker", taker)
+	for n in range(1, length):
+		pool.proposeUpdate(negotiation_id, users[n % 2], Offer("widget", 100 - n % 50, 10))
+	return users[(length - 1) % 2], users[length % 2]
+
+
+def _suiteCase(history, private_info, live, samples):
+	"""
+	Builds the pool for one case of the suite: live open negotiations of 1 version,
+	a main negotiation whose maker has history versions and private_info keys, fresh
+	negotiations to submit on and negotiations of history versions to accept and
+	cancel.
+
+	Returns:
+	    tuple: (pool, user who can withdraw on the main negotiation, user who can
+	        accept the ending negotiations, number of ending negotiations of each kind)
+	"""
+	pool = HagglerPool(errors="return", on_end="evict")
+	pool.createMany((("live", i), "maker", "taker{0}".format(i)) for i in range(live))
+	for i in range(live):
+		pool.submit(("live", i), "maker", "taker{0}".format(i), Offer("widget", 100, 10))
+
+	pool.create("main", "maker", "taker")
+	mover, _ = _grow(pool, "main", "taker", max(1, history - 1))
+	pool.updatePrivateData("main", "maker", {"key{0}".format(k): k for k in range(private_info)})
+
+	# negotiations that end are rebuilt per sample, so long histories get fewer samples
+	ending = max(3, min(samples, 200000 // history))
+	for name in ("accept", "cancel"):
+		for k in range(ending):
+			pool.create((name, k), "maker", "taker")
+			_, accepter = _grow(pool, (name, k), "taker", history)
+	pool.createMany((("fresh", k), "maker", "taker") for k in range(samples))
+	return pool, mover, accepter, ending
+
+
+def _suiteTimings(pool, history, private_info, samples, mover, accepter, ending):
+	"""
+	Times each of SUITE_OPERATIONS on a pool built by _suiteCase.
+
+	Returns:
+	    dict: operation -> list of call times in seconds
+	"""
+	rng = random.Random(0)
+	clock = time.perf_counter
+	timings = {operation: [] for operation in SUITE_OPERATIONS}
+	private_data = {"key{0}".format(k): -k for k in range(private_info)}
+	offer = Offer("widget", 99, 10)
+
+	def timeCall(operation, method, *args):
+		start = clock()
+		result = method(*args)
+		timings[operation].append(clock() - start)
+		# a rejected action would time the wrong thing
+		if operation in ACTION_CODES and result != RESULT_OK:
+			raise RuntimeError("{0}{1} was rejected: {2}".format(operation, args, RESULT_NAMES[result]))
+
+	for k in range(samples):
+		timeCall("submit", pool.submit, ("fresh", k), "maker", "taker", offer)
+		timeCall("withdraw", pool.withdraw, "main", mover)
+		timeCall("proposeUpdate", pool.proposeUpdate, "main", mover, offer)
+		timeCall("updatePrivateData", pool.updatePrivateData, "main", "maker", private_data)
+		versions = pool.get("main").users["maker"].curr_version - 1
+		timeCall("returnVersion", pool.returnVersion, "main", "maker", rng.randint(1, versions))
+		timeCall("versionDifferences", pool.versionDifferences, "main", "maker", rng.randint(1, versions), rng.randint(1, versions))
+
+	for k in range(ending):
+		timeCall("accept", pool.accept, ("accept", k), accepter)
+		timeCall("cancel", pool.cancel, ("cancel", k), accepter)
+
+	with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+		for _ in range(max(3, min(samples, 1000000 // history))):
+			timeCall("printHistory", pool.printHistory, "main", "maker")
+
+	return timings
+
+
+def benchSuite(histories, private_infos, lives, samples=200):
+	"""
+	Times every Haggler action and query, through a HagglerPool, along three
+	dimensions - history length, number of private_info keys and number of live
+	negotiations - varying one at a time from the first value of the others.
+
+	Each call is timed on its own and the median and 90th percentile reported. The
+	peak Python memory of building and running each case is measured with
+	tracemalloc on a separate, untimed run. Everything is seeded, so runs are
+	comparable - see compareResults.
+
+	Args:
+	    histories (list): history lengths in versions
+	    private_infos (list): private_info sizes in keys
+	    lives (list): numbers of other open negotiations in the pool
+	    samples (int): calls timed per operation, fewer for accept, cancel and
+	        printHistory on long histories
+
+	Returns:
+	    list: a result dict per (case, operation)
+	"""
+	cases = []
+	for history in histories:
+		cases.append(("history", history, private_infos[0], lives[0]))
+	for private_info in private_infos[1:]:
+		cases.append(("private_info", histories[0], private_info, lives[0]))
+	for live in lives[1:]:
+		cases.append(("live", histories[0], private_infos[0], live))
+
+	results = []
+	for dimension, history, private_info, live in cases:
+		gc.collect()
+		tracemalloc.start()
+		case = _suiteCase(history, private_info, live, samples)
+		_suiteTimings(case[0], history, private_info, samples, *case[1:])
+		peak = tracemalloc.get_traced_memory()[1]
+		tracemalloc.stop()
+		del case
+
+		gc.collect()
+		case = _suiteCase(history, private_info, live, samples)
+		timings = _suiteTimings(case[0], history, private_info, samples, *case[1:])
+		del case
+
+		for operation in SUITE_OPERATIONS:
+			times = sorted(timings[operation])
+			results.append({
+				"benchmark": "suite",
+				"dimension": dimension,
+				"history": history,
+				"private_info": private_info,
+				"live": live,
+				"operation": operation,
+				"samples": len(times),
+				"median_us": 1e6 * _percentile(times, 50),
+				"p90_us": 1e6 * _percentile(times, 90),
+				"peak_mb": peak / 1e6,
+			})
+	return results
+
+
+def compareResults(old, new, threshold):
+	"""
+	Compares two runs of the suite benchmark, matching results on the case and
+	operation.
+
+	Args:
+	    old (list): result dicts of the earlier run
+	    new (list): result dicts of the later run
+	    threshold (float): relative increase in median time or peak memory that
+	        counts as a regression, e.g. 0.25
+
+	Returns:
+	    list: a dict per regression
+	"""
+	before = {tuple(r.get(k) for k in _SUITE_KEYS): r for r in old}
+	regressions = []
+	for result in new:
+		previous = before.get(tuple(result.get(k) for k in _SUITE_KEYS))
+		if previous is None:
+			continue
+		for measure in ("median_us", "peak_mb"):
+			if previous[measure] and result[measure] > previous[measure] * (1 + threshold):
+				regressions.append({
+					"dimension": result["dimension"],
+					"history": result["history"],
+					"private_info": result["private_info"],
+					"live": result["live"],
+					"operation": result["operation"],
+					"measure": measure,
+					"before": previous[measure],
+					"after": result[measure],
+				})
+	return regressions
+
+
+def benchMetrics(pairs):
+	"""
+	Cost of metrics: time per action of withdraw/proposeUpdate pairs on one Haggler
+	before metrics are enabled, while enabled and after they are disabled again.
+
+	Args:
+	    pairs (int): withdraw/proposeUpdate pairs per mode
+
+	Returns:
+	    list: a result dict per mode
+	"""
+	results = []
+	for mode in ("off", "enabled", "disabled"):
+		if mode == "enabled":
+			metrics.enable()
+		elif mode == "disabled":
+			metrics.disable()
+		haggler = Haggler("maker", "taker", errors="return")
+		haggler.submit("maker", "taker", Offer("widget", 100, 10))
+		offer = Offer("widget", 99, 10)
+		gc.collect()
+
+		def run():
+			for _ in range(pairs):
+				haggler.withdraw("maker")
+				haggler.proposeUpdate("maker", offer)
+
+		_, seconds = _timed(run)
+		results.append({
+			"benchmark": "metrics",
+			"metrics": mode,
+			"actions": 2 * pairs,
+			"action_us": 1e6 * seconds / (2 * pairs),
+		})
+	metrics.reset()
+	return results
+
+
+def benchExport(negotiations, rounds, formats, memory=False):
+	"""
+	Throughput of HagglerPool.exportHistories for every version of a pool of
+	negotiations that have each seen some market maker traffic, written to a file.
+	With memory, the peak traced memory of the export is measured on a separate run,
+	against joining all the lines into one string first.
+
+	Args:
+	    negotiations (int): number of negotiations
+	    rounds (int): withdraw/accept/proposeUpdate rounds per negotiation
+	    formats (list): EXPORT_* formats to export in
+	    memory (bool): also measure peak memory (slower)
+
+	Returns:
+	    list: a result dict per format
+	"""
+	pool = HagglerPool(errors="return")
+	pool.createMany((i, "maker", "taker{0}".format(i)) for i in range(negotiations))
+	pool.applyBatch(_marketMakerTraffic(negotiations, rounds))
+	results = []
+	with tempfile.TemporaryDirectory() as directory:
+		path = os.path.join(directory, "export")
+		for name in formats:
+			gc.collect()
+			with open(path, "w") as f:
+				versions, seconds = _timed(pool.exportHistories, f, name)
+			result = {
+				"benchmark": "export",
+				"format": name,
+				"versions": versions,
+				"seconds": seconds,
+				"versions_per_s": versions / seconds,
+				"file_mb": os.path.getsize(path) / 1e6,
+			}
+			if memory:
+				with open(path, "w") as f:
+					tracemalloc.start()
+					pool.exportHistories(f, name)
+					result["peak_mb"] = tracemalloc.get_traced_memory()[1] / 1e6
+					tracemalloc.stop()
+				with open(path, "w") as f:
+					tracemalloc.start()
+					f.write("".join(pool.iterHistories(name)))
+					result["joined_peak_mb"] = tracemalloc.get_traced_memory()[1] / 1e6
+					tracemalloc.stop()
+			results.append(result)
+	return results
+
+
+def benchTail(histories, polls=1000):
+	"""
+	Cost of polling one negotiation for its newest version, with historySince and a
+	cursor against reading the whole history again, for histories of several lengths.
+
+	Args:
+	    histories (list): history lengths to poll at
+	    polls (int): polls per length, each after one new version
+
+	Returns:
+	    list: a result dict per (length, method)
+	"""
+	results = []
+	for length in histories:
+		for method in ("cursor", "full"):
+			pool = HagglerPool(errors="return", journal=True)
+			pool.create(0, "maker", "taker")
+			_grow(pool, 0, "taker", length)
+			haggler = pool.get(0)
+			cursor = pool.historySince("maker")[1]
+			seconds = 0.0
+			for _ in range(polls):
+				pool.updatePrivateData(0, "maker", {"poll": cursor})
+				start = time.perf_counter()
+				if method == "cursor":
+					offers, cursor = pool.historySince("maker", cursor)
+				else:
+					offers = list(haggler.users["maker"].offer_history)
+				seconds += time.perf_counter() - start
+			results.append({
+				"benchmark": "tail",
+				"history": length,
+				"method": method,
+				"poll_us": 1e6 * seconds / polls,
+			})
+	return results
+
+
+def benchFeed(negotiations, rounds, subscribers):
+	"""
+	Cost of a ChangeFeed on applyBatch replays of market maker traffic: no feed, a feed
+	without subscribers, one subscriber to everything (drained after the replay),
+	and many subscribers each following one taker.
+
+	Args:
+	    negotiations (int): number of negotiations
+	    rounds (int): withdraw/accept/proposeUpdate rounds per negotiation
+	    subscribers (int): number of per-user subscribers
+
+	Returns:
+	    list: a result dict per configuration
+	"""
+	actions = _marketMakerTraffic(negotiations, rounds)
+	results = []
+	for name in ("none", "idle", "everything", "per_user"):
+		feed = None if name == "none" else ChangeFeed()
+		subscriptions = []
+		if name == "everything":
+			subscriptions.append(feed.subscribe(buffer_size=len(actions) * 2))
+		elif name == "per_user":
+			for i in range(subscribers):
+				subscriptions.append(feed.subscribe(user_ids=["taker{0}".format(i)], kind=EVENT_STATE))
+		pool = HagglerPool(errors="return", feed=feed)
+		pool.createMany((i, "maker", "taker{0}".format(i)) for i in range(negotiations))
+		gc.collect()
+		_, seconds = _timed(pool.applyBatch, actions)
+		events = 0
+		for subscription in subscriptions:
+			batch = subscription.poll()
+			while batch:
+				events += len(batch)
+				batch = subscription.poll()
+		results.append({
+			"benchmark": "feed",
+			"feed": name,
+			"actions": len(actions),
+			"events": events,
+			"action_us": 1e6 * seconds / len(actions),
+		})
+	return results
+
+
+def _fullDifferences(history, v1, v2):
+	# versionDifferences as it was before the delta index - every attribute compared
+	a = vars(history[v1 - 1])
+	b = vars(history[v2 - 1])
+	return {k: [a[k], b[k]] for k in a if a[k] != b[k]}
+
+
+def benchDiffs(histories, private_infos, queries=1000):
+	"""
+	versionDifferences on random version pairs, and consecutiveDifferences over the
+	whole history, against comparing every attribute of both versions. The maker
+	of a negotiation holds private_infos keys of private_info, and on every step
+	counter offers and updates one of them.
+
+	Args:
+	    histories (list): history lengths
+	    private_infos (int): keys updated in private_info
+	    queries (int): random version pairs per length
+
+	Returns:
+	    list: a result dict per (length, method)
+	"""
+	results = []
+	rng = random.Random(1)
+	for length in histories:
+		pool = HagglerPool(errors="return")
+		pool.create(0, "maker", "taker")
+		pool.submit(0, "maker", "taker", Offer("widget", 100, 10))
+		pool.updatePrivateData(0, "maker", {"key{0}".format(k): 0 for k in range(private_infos)})
+		users = ("taker", "maker")
+		for n in range(1, length // 2):
+			pool.proposeUpdate(0, users[n % 2], Offer("widget", 100 - n % 50, 10))
+			pool.updatePrivateData(0, "maker", {"key{0}".format(n % private_infos): n})
+		haggler = pool.get(0)
+		history = haggler.users["maker"].offer_history
+		pairs = [(rng.randint(1, len(history)), rng.randint(1, len(history))) for _ in range(queries)]
+		# build the index outside the timings, as the first query after each action would
+		haggler.versionDifferences("maker", 1, 2)
+
+		def indexed():
+			for v1, v2 in pairs:
+				haggler.versionDifferences("maker", v1, v2)
+
+		def full():
+			for v1, v2 in pairs:
+				_fullDifferences(history, v1, v2)
+
+		for method, function in (("indexed", indexed), ("full", full)):
+			gc.collect()
+			_, seconds = _timed(function)
+			results.append({"benchmark": "diffs", "history": len(history), "method": method, "query": "range", "us": 1e6 * seconds / queries})
+
+		gc.collect()
+		_, seconds = _timed(haggler.consecutiveDifferences, "maker")
+		results.append({"benchmark": "diffs", "history": len(history), "method": "indexed", "query": "consecutive", "us": 1e6 * seconds})
+		gc.collect()
+		_, seconds = _timed(lambda: [_fullDifferences(history, v, v + 1) for v in range(1, len(history))])
+		results.append({"benchmark": "diffs", "history": len(history), "method": "full", "query": "consecutive", "us": 1e6 * seconds})
+	return results
+
+
+def _scanJointState(haggler, step):
+	# walk both histories from the start, as a caller without the timeline would
+	history_1, history_2 = [user.offer_history for user in haggler.users.values()]
+	i = j = 0
+	for code in haggler.steps[:step]:
+		if code != 2:
+			i += 1
+		if code != 1:
+			j += 1
+	return history_1[i - 1] if i else None, history_2[j - 1] if j else None
+
+
+def benchTimeline(histories, queries=1000):
+	"""
+	jointState and mapVersion at random points of a negotiation, against walking
+	the steps from the start. Half of the actions are UpdatePrivateData, so the two
+	histories drift apart.
+
+	Args:
+	    histories (list): history lengths
+	    queries (int): random steps per length
+
+	Returns:
+	    list: a result dict per (length, method)
+	"""
+	results = []
+	rng = random.Random(1)
+	for length in histories:
+		haggler = Haggler("maker", "taker", errors="return")
+		haggler.submit("maker", "taker", Offer("widget", 100, 10))
+		users = ("taker", "maker")
+		for n in range(1, length):
+			if n % 2:
+				haggler.updatePrivateData(users[n % 4 // 2], {"round": n})
+			else:
+				haggler.proposeUpdate(users[n % 4 // 2], Offer("widget", 100 - n % 50, 10))
+		steps = [rng.randint(0, len(haggler.steps)) for _ in range(queries)]
+		versions = [rng.randint(1, len(haggler.users["maker"].offer_history)) for _ in range(queries)]
+		# build the checkpoints outside the timings, as the first query would
+		haggler.versionsAt(0)
+
+		def joint():
+			for step in steps:
+				haggler.jointState(step)
+
+		def mapped():
+			for version in versions:
+				haggler.mapVersion("maker", version)
+
+		def scan():
+			for step in steps:
+				_scanJointState(haggler, step)
+
+		for method, query, function in (("timeline", "jointState", joint), ("timeline", "mapVersion", mapped), ("scan", "jointState", scan)):
+			gc.collect()
+			_, seconds = _timed(function)
+			results.append({"benchmark": "timeline", "steps": len(haggler.steps), "method": method, "query": query, "us": 1e6 * seconds / queries})
+	return results
+
+
+def _loopAnalytics(pool):
+	# what the analytics cost looping over Offer objects in Python
+	totals, counts, outcomes = {}, {}, {}
+	for haggler in list(pool.hagglers.values()) + list(pool.archive.values()):
+		history = next(iter(haggler.users.values())).offer_history
+		opening = None
+		round = 0
+		for offer in history:
+			if offer.action in ("Submit", "ProposeUpdate"):
+				if opening is None:
+					opening = offer.price
+				totals[round] = totals.get(round, 0) + (opening - offer.price) / opening
+				counts[round] = counts.get(round, 0) + 1
+				round += 1
+		last = history[-1]
+		outcome = outcomes.setdefault(last.product, [0, 0, 0])
+		outcome[0] += 1
+		outcome[1] += last.state == "Accepted"
+		outcome[2] += last.state == "Cancelled"
+	return [totals[r] / counts[r] for r in sorted(totals)], outcomes
+
+
+def benchArrays(negotiations, rounds):
+	"""
+	HagglerPool.historyArrays and the HistoryArrays analytics (mean concession per
+	round, time to accept, outcomes by product) against the same analytics looping
+	over the Offer objects. Needs NumPy.
+
+	Args:
+	    negotiations (int): number of negotiations
+	    rounds (int): counter offers per negotiation, each followed by an
+	        UpdatePrivateData
+
+	Returns:
+	    list: a result dict per step
+	"""
+	rng = random.Random(1)
+	pool = HagglerPool(errors="return")
+	users = ("seller", "buyer")
+	for n in range(negotiations):
+		pool.create(n, "buyer", "seller")
+		product = "product{0}".format(n % 20)
+		pool.submit(n, "seller", "buyer", Offer(product, 100, 10))
+		for r in range(rng.randint(1, rounds)):
+			pool.proposeUpdate(n, users[(r + 1) % 2], Offer(product, 100 - r, 10))
+			pool.updatePrivateData(n, "seller", {"round": r})
+		ending = rng.random()
+		if ending < 0.4:
+			haggler = pool.get(n)
+			pool.accept(n, next(user_id for user_id in users if haggler.can(user_id, "accept")))
+		elif ending < 0.7:
+			pool.cancel(n, "buyer")
+
+	def analytics(arrays):
+		arrays.meanConcessionByRound()
+		arrays.timeToAccept()
+		arrays.outcomesByProduct()
+
+	results = []
+	gc.collect()
+	arrays, seconds = _timed(pool.historyArrays)
+	versions = len(arrays)
+	results.append({"benchmark": "arrays", "versions": versions, "step": "historyArrays", "seconds": seconds})
+	gc.collect()
+	_, seconds = _timed(analytics, arrays)
+	results.append({"benchmark": "arrays", "versions": versions, "step": "vectorised analytics", "seconds": seconds})
+	gc.collect()
+	_, seconds = _timed(_loopAnalytics, pool)
+	results.append({"benchmark": "arrays", "versions": versions, "step": "loop analytics", "seconds": seconds})
+	return results
+
+
+def _scanQuery(pool, product, state, low, high):
+	# the same question answered by looking at every open negotiation
+	matches = set()
+	for negotiation_id, haggler in pool.hagglers.items():
+		users = haggler.users.values()
+		offer = next(iter(users)).current_offer
+		if offer is None or offer.product != product or not low <= offer.price <= high:
+			continue
+		if any(user.state == state for user in users):
+			matches.add(negotiation_id)
+	return matches
+
+
+def benchIndex(sizes, queries=1000):
+	"""
+	HagglerPool.query at each pool size against scanning every open negotiation, and
+	the cost the NegotiationIndex adds to an action. Each negotiation is for one of
+	1000 products at a random price, and half of them have a counter offer.
+
+	Args:
+	    sizes (list): numbers of open negotiations
+	    queries (int): queries timed per kind
+
+	Returns:
+	    list: a result dict per (size, query)
+	"""
+	results = []
+	rng = random.Random(1)
+	for size in sizes:
+		timings = {}
+		for indexed in (False, True):
+			pool = HagglerPool(errors="return", indexed=indexed)
+			pool.createMany((n, "buyer{0}".format(n % 1000), "seller{0}".format(n % 997)) for n in range(size))
+			gc.collect()
+			start = time.perf_counter()
+			for n in range(size):
+				pool.submit(n, "seller{0}".format(n % 997), "buyer{0}".format(n % 1000),
+					Offer("product{0}".format(n % 1000), rng.randint(1, 100000), 10))
+				if n % 2:
+					pool.proposeUpdate(n, "buyer{0}".format(n % 1000), Offer("product{0}".format(n % 1000), rng.randint(1, 100000), 10))
+			timings[indexed] = (time.perf_counter() - start) / (size * 1.5)
+		results.append({"benchmark": "index", "negotiations": size, "query": "action overhead", "us": 1e6 * (timings[True] - timings[False])})
+
+		products = ["product{0}".format(rng.randrange(1000)) for _ in range(queries)]
+		lows = [rng.randint(1, 99000) for _ in range(queries)]
+		kinds = (
+			("product+state", lambda i: pool.query(product=products[i], state="AwaitingMyAcceptance")),
+			("user+state", lambda i: pool.query(user_id="buyer{0}".format(i % 1000), state="AwaitingMyAcceptance")),
+			("price range", lambda i: pool.query(price=(lows[i], lows[i] + 100))),
+			("product+price", lambda i: pool.query(product=products[i], price=(lows[i], lows[i] + 10000))),
+		)
+		for name, query in kinds:
+			gc.collect()
+			_, seconds = _timed(lambda: [query(i) for i in range(queries)])
+			results.append({"benchmark": "index", "negotiations": size, "query": name, "us": 1e6 * seconds / queries})
+		scans = max(1, queries // 100)
+		gc.collect()
+		_, seconds = _timed(lambda: [_scanQuery(pool, products[i], "AwaitingMyAcceptance", lows[i], lows[i] + 10000) for i in range(scans)])
+		results.append({"benchmark": "index", "negotiations": size, "query": "full scan", "us": 1e6 * seconds / scans})
+	return results
+
+
+def _spamHistory(haggler, length, private_infos):
+	# an automated maker that updates private data four times per counter offer
+	haggler.submit("maker", "taker", Offer("widget", 100, 10))
+	haggler.updatePrivateData("maker", {"key{0}".format(k): 0 for k in range(private_infos)})
+	users = ("taker", "maker")
+	for n in range(1, length):
+		if n % 5:
+			haggler.updatePrivateData("maker", {"key{0}".format(n % private_infos): n})
+		else:
+			haggler.proposeUpdate(users[n // 5 % 2], Offer("widget", 100 - n % 50, 10))
+
+
+def benchRetention(histories, private_infos, reads=1000):
+	"""
+	Offer histories kept whole in memory against a HistoryRetention spilling all but
+	the last 1000 versions, with and without compaction. The maker of a negotiation
+	holds private_infos keys of private_info and updates one of them four times per
+	counter offer. Reports the time per action, the heap held once the history is
+	built (from a separate run under tracemalloc), the segment bytes per spilled
+	version, and returnVersion on random and on consecutive versions.
+
+	Args:
+	    histories (list): history lengths
+	    private_infos (int): keys of the maker's private_info
+	    reads (int): versions read per access pattern
+
+	Returns:
+	    list: a result dict per (length, retention)
+	"""
+	results = []
+	rng = random.Random(1)
+	policies = (
+		("none", lambda: None),
+		("spill", lambda: HistoryRetention(compact=False)),
+		("spill+compact", lambda: HistoryRetention()),
+	)
+	for length in histories:
+		for name, policy in policies:
+			retention = policy()
+			gc.collect()
+			tracemalloc.start()
+			haggler = Haggler("maker", "taker", errors="return", retention=retention)
+			_spamHistory(haggler, length, private_infos)
+			heap = tracemalloc.get_traced_memory()[0]
+			tracemalloc.stop()
+			del haggler
+			if retention is not None:
+				retention.close()
+
+			retention = policy()
+			haggler = Haggler("maker", "taker", errors="return", retention=retention)
+			gc.collect()
+			_, seconds = _timed(_spamHistory, haggler, length, private_infos)
+			versions = len(haggler.users["maker"].offer_history)
+			random_versions = [rng.randint(1, versions) for _ in range(reads)]
+			start = rng.randint(1, max(1, versions - reads))
+			gc.collect()
+			_, random_seconds = _timed(lambda: [haggler.returnVersion("maker", v) for v in random_versions])
+			_, consecutive_seconds = _timed(lambda: [haggler.returnVersion("maker", v) for v in range(start, min(versions, start + reads) + 1)])
+			results.append({
+				"benchmark": "retention",
+				"versions": versions,
+				"retention": name,
+				"us/action": 1e6 * seconds / length,
+				"heap MB": heap / 1e6,
+				"segment B/version": retention.size / retention.spilled if retention is not None and retention.spilled else 0.0,
+				"random read us": 1e6 * random_seconds / reads,
+				"consecutive read us": 1e6 * consecutive_seconds / reads,
+			})
+			if retention is not None:
+				retention.close()
+	return results
+
+
+def _cronScan(deadlines, now):
+	# the cron job: look at every deadline on every run
+	return [key for key, deadline in deadlines.items() if deadline <= now]
+
+
+def benchExpiry(sizes, negotiations=100000, ticks=600):
+	"""
+	TimingWheel against a cron style scan of every deadline, with sizes timers
+	pending at random deadlines over the next hour of a 1 second tick. Times
+	scheduling, re-arming and advancing one tick at a time for ticks ticks, against
+	one scan. Then the cost an ExpiryScheduler adds to each action of a HagglerPool
+	of negotiations negotiations, and HagglerPool.expire firing a 10 second offer
+	timeout for all of them.
+
+	Args:
+	    sizes (list): numbers of pending timers
+	    negotiations (int): negotiations in the pool
+	    ticks (int): ticks advanced
+
+	Returns:
+	    list: a result dict per (timers, operation)
+	"""
+	results = []
+	rng = random.Random(1)
+	now = [0.0]
+	clock = lambda: now[0]
+	for size in sizes:
+		now[0] = 0.0
+		deadlines = {n: rng.uniform(1, 3600) for n in range(size)}
+		wheel = TimingWheel(clock=clock)
+		gc.collect()
+		_, seconds = _timed(lambda: [wheel.schedule(n, deadline) for n, deadline in deadlines.items()])
+		results.append({"benchmark": "expiry", "timers": size, "operation": "schedule", "us": 1e6 * seconds / size})
+		keys = [rng.randrange(size) for _ in range(100000)]
+		_, seconds = _timed(lambda: [wheel.schedule(n, deadlines[n]) for n in keys])
+		results.append({"benchmark": "expiry", "timers": size, "operation": "re-arm", "us": 1e6 * seconds / len(keys)})
+
+		fired = []
+		gc.collect()
+		start = time.perf_counter()
+		for tick in range(1, ticks + 1):
+			fired.extend(wheel.advance(tick))
+		seconds = time.perf_counter() - start
+		results.append({"benchmark": "expiry", "timers": size, "operation": "advance 1 tick", "us": 1e6 * seconds / ticks})
+		results.append({"benchmark": "expiry", "timers": size, "operation": "per timer fired", "us": 1e6 * seconds / max(1, len(fired))})
+		_, seconds = _timed(_cronScan, deadlines, ticks)
+		results.append({"benchmark": "expiry", "timers": size, "operation": "cron scan 1 tick", "us": 1e6 * seconds})
+
+	timings = {}
+	for expiry in (None, ExpiryScheduler(offer_ttl=10, idle_ttl=3600, clock=clock)):
+		now[0] = 0.0
+		pool = HagglerPool(errors="return", expiry=expiry)
+		pool.createMany((n, "buyer{0}".format(n % 1000), "seller{0}".format(n % 997)) for n in range(negotiations))
+		gc.collect()
+		start = time.perf_counter()
+		for n in range(negotiations):
+			pool.submit(n, "seller{0}".format(n % 997), "buyer{0}".format(n % 1000), Offer("widget", 100, 10))
+			pool.proposeUpdate(n, "buyer{0}".format(n % 1000), Offer("widget", 90, 10))
+		timings[expiry is None] = (time.perf_counter() - start) / (2 * negotiations)
+	results.append({"benchmark": "expiry", "timers": 2 * negotiations, "operation": "action overhead", "us": 1e6 * (timings[False] - timings[True])})
+	now[0] = 11.0
+	gc.collect()
+	taken, seconds = _timed(pool.expire)
+	results.append({"benchmark": "expiry", "timers": 2 * negotiations, "operation": "expire per withdraw", "us": 1e6 * seconds / max(1, len(taken))})
+	return results
+
+
+def printResults(results):
+	"""
+	Prints a list of result dicts as a table, one row per result.
+
+	Args:
+	    results (list): result dicts with the same keys
+	"""
+	if not results:
+		return
+	keys = list(results[0].keys())
+	rows = []
+	for result in results:
+		cells = []
+		for k in keys:
+			value = result[k]
+			if isinstance(value, float):
+				value = "{0:.3f}".format(value)
+			cells.append(str(value))
+		rows.append(cells)
+	widths = [max(18, len(k) + 2, max(len(row[i]) + 2 for row in rows)) for i, k in enumerate(keys)]
+	print("".join("{0:>{1}}".format(k, w) for k, w in zip(keys, widths)))
+	for cells in rows:
+		print("".join("{0:>{1}}".format(cell, w) for cell, w in zip(cells, widths)))
+
+
+def main():
+	parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+	parser.add_argument("--json", help="write results to this file as JSON")
+	commands = parser.add_subparsers(dest="benchmark", required=True)
+
+	pool = commands.add_parser("pool", help="HagglerPool scaling")
+	pool.add_argument("--sizes", type=int, nargs="+", default=[10000, 100000, 1000000])
+	pool.add_argument("--event-sourced", action="store_true")
+	pool.add_argument("--memory", action="store_true", help="report bytes per deal (slower)")
+
+	batch = commands.add_parser("batch", help="HagglerPool.applyBatch against single calls")
+	batch.add_argument("--negotiations", type=int, default=10000)
+	batch.add_argument("--rounds", type=int, default=10)
+
+	wal = commands.add_parser("wal", help="WriteAheadLog write throughput and recovery time")
+	wal.add_argument("--negotiations", type=int, nargs="+", default=[1000, 10000, 100000])
+	wal.add_argument("--rounds", type=int, default=5)
+	wal.add_argument("--fsync", nargs="+", default=list(FSYNC_POLICIES), choices=FSYNC_POLICIES)
+
+	snapshot = commands.add_parser("snapshot", help="HagglerPool snapshot/restore against pickle")
+	snapshot.add_argument("--sizes", type=int, nargs="+", default=[10000, 100000, 1000000])
+	snapshot.add_argument("--rounds", type=int, default=2)
+	snapshot.add_argument("--no-pickle", action="store_true", help="skip the pickle comparison")
+
+	archive = commands.add_parser("archive", help="dict archive against ColumnarArchive")
+	archive.add_argument("--sizes", type=int, nargs="+", default=[10000, 100000, 1000000])
+	archive.add_argument("--rounds", type=int, default=2)
+
+	service = commands.add_parser("async", help="AsyncHagglerPool load test")
+	service.add_argument("--negotiations", type=int, nargs="+", default=[10000, 50000])
+	service.add_argument("--rounds", type=int, default=5)
+	service.add_argument("--queue-size", type=int, default=4)
+
+	contention = commands.add_parser("threads", help="ThreadSafeHaggler contention")
+	contention.add_argument("--threads", type=int, nargs="+", default=[1, 2, 4, 8, 16])
+	contention.add_argument("--negotiations", type=int, default=16)
+	contention.add_argument("--operations", type=int, default=20000)
+
+	shards = commands.add_parser("shards", help="ShardedHagglerPool throughput against worker count")
+	shards.add_argument("--workers", type=int, nargs="+", default=[0, 1, 2, 4, 8])
+	shards.add_argument("--negotiations", type=int, default=100000)
+	shards.add_argument("--rounds", type=int, default=5)
+	shards.add_argument("--batch-size", type=int, default=10000)
+
+	suite = commands.add_parser("suite", help="every action and query across history, private_info and live negotiations")
+	suite.add_argument("--histories", type=int, nargs="+", default=[10, 100, 1000, 10000, 100000])
+	suite.add_argument("--private-infos", type=int, nargs="+", default=[1, 10, 100, 1000])
+	suite.add_argument("--lives", type=int, nargs="+", default=[1, 1000, 100000])
+	suite.add_argument("--samples", type=int, default=200)
+
+	instrumentation = commands.add_parser("metrics", help="cost of enabling metrics")
+	instrumentation.add_argument("--pairs", type=int, default=100000)
+
+	export = commands.add_parser("export", help="HagglerPool.exportHistories throughput")
+	export.add_argument("--negotiations", type=int, default=50000)
+	export.add_argument("--rounds", type=int, default=10)
+	export.add_argument("--formats", nargs="+", default=list(EXPORT_FORMATS), choices=EXPORT_FORMATS)
+	export.add_argument("--memory", action="store_true", help="report peak memory against one joined string (slower)")
+
+	tail = commands.add_parser("tail", help="polling for new versions with a cursor against reading the whole history")
+	tail.add_argument("--histories", type=int, nargs="+", default=[10, 1000, 100000])
+	tail.add_argument("--polls", type=int, default=1000)
+
+	changes = commands.add_parser("feed", help="cost of publishing to a ChangeFeed")
+	changes.add_argument("--negotiations", type=int, default=10000)
+	changes.add_argument("--rounds", type=int, default=10)
+	changes.add_argument("--subscribers", type=int, default=1000)
+
+	diffs = commands.add_parser("diffs", help="versionDifferences and consecutiveDifferences against comparing every attribute")
+	diffs.add_argument("--histories", type=int, nargs="+", default=[100, 10000, 100000])
+	diffs.add_argument("--private-infos", type=int, default=100)
+	diffs.add_argument("--queries", type=int, default=1000)
+
+	timeline = commands.add_parser("timeline", help="jointState and mapVersion against walking every step")
+	timeline.add_argument("--histories", type=int, nargs="+", default=[100, 10000, 100000])
+	timeline.add_argument("--queries", type=int, default=1000)
+
+	arrays = commands.add_parser("arrays", help="HistoryArrays analytics against looping over Offers (needs numpy)")
+	arrays.add_argument("--negotiations", type=int, default=100000)
+	arrays.add_argument("--rounds", type=int, default=10)
+
+	index = commands.add_parser("index", help="HagglerPool.query against scanning every negotiation")
+	index.add_argument("--sizes", type=int, nargs="+", default=[10000, 100000, 1000000])
+	index.add_argument("--queries", type=int, default=1000)
+
+	retention = commands.add_parser("retention", help="HistoryRetention memory, spill cost and cold reads against whole histories")
+	retention.add_argument("--histories", type=int, nargs="+", default=[10000, 100000, 1000000])
+	retention.add_argument("--private-infos", type=int, default=100)
+	retention.add_argument("--reads", type=int, default=1000)
+
+	expiry = commands.add_parser("expiry", help="TimingWheel and HagglerPool.expire against scanning every deadline")
+	expiry.add_argument("--sizes", type=int, nargs="+", default=[100000, 1000000, 3000000])
+	expiry.add_argument("--negotiations", type=int, default=100000)
+	expiry.add_argument("--ticks", type=int, default=600)
+
+	compare = commands.add_parser("compare", help="report regressions between two suite --json files")
+	compare.add_argument("old")
+	compare.add_argument("new")
+	compare.add_argument("--threshold", type=float, default=0.25)
+
+	args = parser.parse_args()
+
+	if args.benchmark == "pool":
+		results = benchPool(args.sizes, args.event_sourced, args.memory)
+	elif args.benchmark == "batch":
+		results = benchBatch(args.negotiations, args.rounds)
+	elif args.benchmark == "wal":
+		results = benchWal(args.negotiations, args.rounds, args.fsync)
+	elif args.benchmark == "snapshot":
+		results = benchSnapshot(args.sizes, args.rounds, not args.no_pickle)
+	elif args.benchmark == "archive":
+		results = benchArchive(args.sizes, args.rounds)
+	elif args.benchmark == "async":
+		results = benchAsync(args.negotiations, args.rounds, args.queue_size)
+	elif args.benchmark == "threads":
+		results = benchThreads(args.threads, args.negotiations, args.operations)
+	elif args.benchmark == "shards":
+		results = benchShards(args.workers, args.negotiations, args.rounds, args.batch_size)
+	elif args.benchmark == "metrics":
+		results = benchMetrics(args.pairs)
+	elif args.benchmark == "export":
+		results = benchExport(args.negotiations, args.rounds, args.formats, args.memory)
+	elif args.benchmark == "tail":
+		results = benchTail(args.histories, args.polls)
+	elif args.benchmark == "feed":
+		results = benchFeed(args.negotiations, args.rounds, args.subscribers)
+	elif args.benchmark == "diffs":
+		results = benchDiffs(args.histories, args.private_infos, args.queries)
+	elif args.benchmark == "timeline":
+		results = benchTimeline(args.histories, args.queries)
+	elif args.benchmark == "arrays":
+		results = benchArrays(args.negotiations, args.rounds)
+	elif args.benchmark == "index":
+		results = benchIndex(args.sizes, args.queries)
+	elif args.benchmark == "retention":
+		results = benchRetention(args.histories, args.private_infos, args.reads)
+	elif args.benchmark == "expiry":
+		results = benchExpiry(args.sizes, args.negotiations, args.ticks)
+	elif args.benchmark == "suite":
+		results = benchSuite(args.histories, args.private_infos, args.lives, args.samples)
+	elif args.benchmark == "compare":
+		with open(args.old) as old, open(args.new) as new:
+			results = compareResults(json.load(old), json.load(new), args.threshold)
+		printResults(results)
+		sys.exit(1 if results else 0)
+
+	printResults(results)
+	if args.json:
+		with open(args.json, "w") as f:
+			json.dump(results, f, indent=2)
+
+
+if __name__ == '__main__':
+	main()
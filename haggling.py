@@ -5,8 +5,318 @@ Module implementing haggling between two users.
 
 """
 
+import asyncio
+import contextlib
 import copy
+import csv
+import gc
+import json
+import mmap
+import multiprocessing
+import operator
+import os
+import pickle
+import struct
+import sys
+import tempfile
+import threading
+import time
+import weakref
 import yaml
+import zlib
+from array import array
+from bisect import bisect_left, bisect_right
+from collections import OrderedDict, deque
+from collections.abc import Mapping, MutableMapping, Sequence
+from itertools import repeat
+
+# result codes returned by the Haggler actions (and HagglerPool.applyBatch)
+RESULT_OK = 0
+RESULT_UNKNOWN_USER = 1
+RESULT_ENDED = 2
+RESULT_INVALID_STATE = 3
+RESULT_INVALID_PRIVATE_INFO = 4
+RESULT_UNKNOWN_NEGOTIATION = 5
+RESULT_UNKNOWN_ACTION = 6
+RESULT_UNKNOWN_VERSION = 7
+RESULT_NEGOTIATION_EXISTS = 8
+
+RESULT_NAMES = (
+	"OK",
+	"UnknownUser",
+	"Ended",
+	"InvalidState",
+	"InvalidPrivateInfo",
+	"UnknownNegotiation",
+	"UnknownAction",
+	"UnknownVersion",
+	"NegotiationExists",
+)
+
+# how Haggler and HagglerPool report errors
+ERRORS_PRINT = "print"   # print the error and return the RESULT_* code
+ERRORS_RETURN = "return" # just return the RESULT_* code, no I/O
+ERRORS_RAISE = "raise"   # raise the HagglingError subclass for the RESULT_* code
+ERROR_MODES = (ERRORS_PRINT, ERRORS_RETURN, ERRORS_RAISE)
+
+# states a User can be in - None until the first offer is submitted
+STATE_NONE = 0
+STATE_AWAITING_MY_ACCEPTANCE = 1
+STATE_AWAITING_THEIR_ACCEPTANCE = 2
+STATE_WITHDRAWN_BY_ME = 3
+STATE_WITHDRAWN_BY_THEM = 4
+STATE_ACCEPTED = 5
+STATE_CANCELLED = 6
+
+STATES = (
+	None,
+	"AwaitingMyAcceptance",
+	"AwaitingTheirAcceptance",
+	"WithdrawnByMe",
+	"WithdrawnByThem",
+	"Accepted",
+	"Cancelled",
+)
+STATE_CODES = {state: code for code, state in enumerate(STATES)}
+
+# actions, named as in Offer.action and as the Haggler methods that take them
+ACTION_SUBMIT = 0
+ACTION_PROPOSE_UPDATE = 1
+ACTION_WITHDRAW = 2
+ACTION_ACCEPT = 3
+ACTION_CANCEL = 4
+ACTION_UPDATE_PRIVATE_DATA = 5
+
+ACTIONS = (
+	"Submit",
+	"ProposeUpdate",
+	"Withdraw",
+	"Accept",
+	"Cancel",
+	"UpdatePrivateData",
+)
+ACTION_METHODS = (
+	"submit",
+	"proposeUpdate",
+	"withdraw",
+	"accept",
+	"cancel",
+	"updatePrivateData",
+)
+ACTION_CODES = {name: code for names in (ACTIONS, ACTION_METHODS) for code, name in enumerate(names)}
+
+_OPEN_STATES = STATES[:STATE_ACCEPTED]
+
+# action -> {state of the user taking it: (their new state, other users new state, ends negotiation)}
+# Any state not listed is an invalid state for the action. UpdatePrivateData is one
+# sided and leaves the state as it is.
+_TRANSITION_RULES = {
+	"Submit": {state: ("AwaitingTheirAcceptance", "AwaitingMyAcceptance", False) for state in _OPEN_STATES},
+	"ProposeUpdate": {
+		"AwaitingMyAcceptance": ("AwaitingTheirAcceptance", "AwaitingMyAcceptance", False),
+		"WithdrawnByMe": ("AwaitingTheirAcceptance", "AwaitingMyAcceptance", False),
+	},
+	"Withdraw": {
+		"AwaitingTheirAcceptance": ("WithdrawnByMe", "WithdrawnByThem", False),
+	},
+	"Accept": {
+		"AwaitingMyAcceptance": ("Accepted", "Accepted", True),
+	},
+	"Cancel": {state: ("Cancelled", "Cancelled", True) for state in _OPEN_STATES[1:]},
+	"UpdatePrivateData": {state: (state, None, False) for state in STATES[1:]},
+}
+
+# TRANSITIONS[action code][state code] -> transition tuple, or None if invalid
+TRANSITIONS = tuple(
+	tuple(_TRANSITION_RULES[action].get(state) for state in STATES)
+	for action in ACTIONS
+)
+# whether each action ends the negotiation when it succeeds
+ACTION_ENDS = tuple(any(t is not None and t[2] for t in row) for row in TRANSITIONS)
+
+class HagglingError(ValueError):
+
+	"""
+	Base class of the errors raised by Hagglers and HagglerPools with errors="raise".
+	
+	Attributes:
+	    result (int): RESULT_* code of the error
+	"""
+
+	result = None
+
+
+class UnknownUserError(HagglingError):
+	"""The user id is not a user in the Haggler."""
+	result = RESULT_UNKNOWN_USER
+
+
+class NegotiationEndedError(HagglingError):
+	"""The offer has been accepted or cancelled - no more actions possible."""
+	result = RESULT_ENDED
+
+
+class InvalidStateError(HagglingError):
+	"""The user is not in a state the action can be taken from."""
+	result = RESULT_INVALID_STATE
+
+
+class InvalidPrivateInfoError(HagglingError, TypeError):
+	"""private_info is not a dict."""
+	result = RESULT_INVALID_PRIVATE_INFO
+
+
+class UnknownNegotiationError(HagglingError):
+	"""The negotiation id is not in the HagglerPool."""
+	result = RESULT_UNKNOWN_NEGOTIATION
+
+
+class UnknownActionError(HagglingError):
+	"""The action name is not a Haggler action."""
+	result = RESULT_UNKNOWN_ACTION
+
+
+class UnknownVersionError(HagglingError):
+	"""The version is not in the users offer history."""
+	result = RESULT_UNKNOWN_VERSION
+
+
+class NegotiationExistsError(HagglingError):
+	"""The negotiation id is already in use in the HagglerPool."""
+	result = RESULT_NEGOTIATION_EXISTS
+
+
+class BatchError(HagglingError):
+
+	"""
+	Raised by HagglerPool.applyBatch with errors="raise" at the first rejected action,
+	from the HagglingError its action method would have raised. The actions after
+	it are not applied.
+	
+	Attributes:
+	    error (HagglingError): the error of the rejected action
+	    index (int): position of the rejected action in the batch
+	    result (int): RESULT_* code of the rejected action
+	    results (array): a RESULT_* code per action up to and including the rejected one
+	"""
+
+	def __init__(self, error, index, results):
+		super().__init__("action {0} of the batch was rejected: {1}".format(index, error))
+		self.error = error
+		self.index = index
+		self.result = error.result
+		self.results = results
+
+	def __reduce__(self):
+		return (BatchError, (self.error, self.index, self.results))
+
+
+# RESULT_* code -> error raised for it
+RESULT_ERRORS = (
+	None,
+	UnknownUserError,
+	NegotiationEndedError,
+	InvalidStateError,
+	InvalidPrivateInfoError,
+	UnknownNegotiationError,
+	UnknownActionError,
+	UnknownVersionError,
+	NegotiationExistsError,
+)
+
+
+class RejectionCounters:
+
+	"""
+	RejectionCounters Class - running counts of rejected actions by action and
+	reason. The module level rejections instance is shared by every Haggler and
+	HagglerPool, whatever their errors mode.
+	
+	Attributes:
+	    counts (list): counts[action code][result code], with two extra rows - for
+	        actions with an unknown name, then for creating negotiations
+	"""
+
+	def __init__(self):
+		self.reset()
+
+	def reset(self):
+		"""
+		Sets every count back to zero.
+		"""
+		self.counts = [[0] * len(RESULT_NAMES) for _ in range(len(ACTIONS) + 2)]
+
+	def add(self, action, result):
+		"""
+		Counts a rejection.
+		
+		Args:
+		    action (int): ACTION_* code, WAL_CREATE for creating a negotiation, or None
+		        if the action name was unknown
+		    result (int): RESULT_* code of the rejection
+		"""
+		# WAL_CREATE is -1, which indexes the last row
+		self.counts[len(ACTIONS) if action is None else action][result] += 1
+
+	@property
+	def total(self):
+		"""
+		int: number of rejections counted
+		"""
+		return sum(sum(row) for row in self.counts)
+
+	def asDict(self):
+		"""
+		Returns the non zero counts as {action name: {reason name: count}}.
+		
+		Returns:
+		    dict: rejection counts
+		"""
+		counts = {}
+		for action, row in zip(ACTIONS + ("Unknown", "Create"), self.counts):
+			reasons = {RESULT_NAMES[result]: n for result, n in enumerate(row) if n}
+			if reasons:
+				counts[action] = reasons
+		return counts
+
+
+rejections = RejectionCounters()
+
+
+def _reportError(errors, result, message, *args):
+	"""
+	Reports an error according to the errors mode. The message is only
+	formatted if it is going to be used.
+	
+	Args:
+	    errors (string): errors mode
+	    result (int): RESULT_* code of the error
+	    message (string): message format string
+	    *args: arguments for message.format
+	
+	Returns:
+	    int: result
+	
+	Raises:
+	    HagglingError: the RESULT_ERRORS subclass for result, if errors is "raise"
+	"""
+	if errors == ERRORS_RETURN:
+		return result
+	if errors == ERRORS_RAISE:
+		raise RESULT_ERRORS[result](message.format(*args))
+
+	try:
+		raise ValueError(message.format(*args))
+	except ValueError as error:
+		print(error)
+	return result
+
+
+def _intern(value):
+	# strings are shared through the interpreter's table of interned strings, so
+	# equal ids and products made in different places are held once
+	return sys.intern(value) if type(value) is str else value
+
 
 class Offer:
 
@@ -17,11 +327,19 @@ class Offer:
 	
 	Offer is added to each users history using addOfferHistory method of User
 	
+	Offers are immutable once created. A new version is made with replace, which
+	copies the slot references across so unchanged data (including private_info)
+	is shared between versions rather than deep copied.
+	
+	product and the user ids are interned, and action and state are always the
+	ACTIONS and STATES strings, so every version refers to one shared copy of each.
+	action_code and state_code give them as ACTION_* and STATE_* codes.
+	
 	Attributes:
 	    action (string): the action that user_action took for this version
 	    buyer (string): user id of the buyer
 	    price (int): price of one unit of product
-	    private_info (dict): private meta data
+	    private_info (PrivateInfo): private meta data
 	    product (string): name of product
 	    quantity (int): number of units of product
 	    seller (string): user id of seller
@@ -31,6 +349,20 @@ class Offer:
 	    version (int): the iteration of this offer in the offer history
 	"""
 
+	__slots__ = (
+		"user_id",
+		"version",
+		"action",
+		"user_action",
+		"state",
+		"buyer",
+		"seller",
+		"product",
+		"price",
+		"quantity",
+		"private_info",
+	)
+
 	def __init__(self, product, price, quantity):
 		"""
 		init for Offer class
@@ -46,23 +378,390 @@ class Offer:
 		    buyer (string): user id of the buyer
 		    seller (string): user id of the seller
 		"""
-		self.user_id = None # set when added to a Users offer_history
-		self.version = None # set when added to a Users offer_history
-		self.action = None # set on action
-		self.user_action = None # set on action
-		self.state = None  # set when added to a Users offer_history
-		self.buyer = None # set on submit
-		self.seller = None # set on submit
-		self.product = product
-		self.price = price
-		self.quantity = quantity
-		self.private_info = None  # set when added to a Users offer_history
+		_set = object.__setattr__
+		_set(self, "user_id", None) # set when added to a Users offer_history
+		_set(self, "version", None) # set when added to a Users offer_history
+		_set(self, "action", None) # set on action
+		_set(self, "user_action", None) # set on action
+		_set(self, "state", None)  # set when added to a Users offer_history
+		_set(self, "buyer", None) # set on submit
+		_set(self, "seller", None) # set on submit
+		_set(self, "product", _intern(product))
+		_set(self, "price", price)
+		_set(self, "quantity", quantity)
+		_set(self, "private_info", None)  # set when added to a Users offer_history
+
+	def __setattr__(self, name, value):
+		raise AttributeError("Offer is immutable - use replace to create a new version")
+
+	@property
+	def action_code(self):
+		"""
+		ACTION_* code of action, None before the Offer is in a history.
+		"""
+		return ACTION_CODES.get(self.action)
+
+	@property
+	def state_code(self):
+		"""
+		STATE_* code of state.
+		"""
+		return STATE_CODES[self.state]
+
+	def __delattr__(self, name):
+		raise AttributeError("Offer is immutable - use replace to create a new version")
+
+	def __getstate__(self):
+		return tuple([slot.__get__(self) for _, slot in _OFFER_SLOTS])
+
+	def __setstate__(self, state):
+		for (_, slot), value in zip(_OFFER_SLOTS, state):
+			slot.__set__(self, value)
+
+	@property
+	def __dict__(self):
+		"""
+		Attribute name -> value mapping so vars(offer) keeps working without
+		a per instance __dict__.
+		"""
+		return self.asdict()
+
+	def asdict(self):
+		"""
+		Returns the attributes of this Offer as a new dict, in declaration order.
+		
+		Returns:
+		    dict: attribute name -> value
+		"""
+		return {name: slot.__get__(self) for name, slot in _OFFER_SLOTS}
+
+	def replace(self, **changes):
+		"""
+		Creates a new Offer with the given attributes replaced. Everything else
+		is shared with this Offer - nothing is copied.
+		
+		Args:
+		    **changes: attribute name -> new value
+		
+		Returns:
+		    Offer: the new version
+		
+		Raises:
+		    AttributeError: if a name in changes is not an Offer attribute
+		"""
+		offer = _new_offer(Offer)
+		for name, slot in _OFFER_SLOTS:
+			if name in changes:
+				slot.__set__(offer, changes.pop(name))
+			else:
+				slot.__set__(offer, slot.__get__(self))
+		if changes:
+			raise AttributeError("Offer has no attribute(s) {0}".format(", ".join(changes)))
+		return offer
 
 	def pretty(self):
 		"""Summary
 		"""
 		print(yaml.dump(vars(self)))
 
+# slot descriptors used to build/copy Offers without going through __setattr__
+_OFFER_SLOTS = tuple((name, vars(Offer)[name]) for name in Offer.__slots__)
+_new_offer = object.__new__
+
+# history export formats, see Haggler.exportHistory
+EXPORT_TABLE = "table" # the printHistory table
+EXPORT_CSV = "csv"     # a row of EXPORT_FIELDS per version
+EXPORT_JSONL = "jsonl" # a JSON object of EXPORT_FIELDS per version
+EXPORT_FORMATS = (EXPORT_TABLE, EXPORT_CSV, EXPORT_JSONL)
+
+EXPORT_FIELDS = Offer.__slots__
+
+_TABLE_HEADER = "{0:>10}{1:>20}{2:>15}{3:>24}{4:>10}{5:>15}{6:>15}{7:>15}\n" \
+	.format("Version","Action","User ID","State","Product","Buyer","Seller","Full Price")
+_TABLE_ROW = "{0:>10}{1:>20}{2:>15}{3:>24}{4:>10}{5:>15}{6:>15}{7:>15}\n"
+
+_EXPORT_FIELDS = operator.attrgetter(*EXPORT_FIELDS)
+_JSON_ENCODE = json.JSONEncoder(default=str).encode
+
+# lines joined into one write by _writeLines
+_EXPORT_CHUNK = 1024
+
+# fields of the NumPy structured arrays made by historyArrays. negotiation, user
+# and product index HistoryArrays.negotiation_ids, user_ids and products, and slot
+# is 0 for the first User of a Haggler and 1 for the second
+HISTORY_ARRAY_FIELDS = (
+	("negotiation", "u4"),
+	("user", "u4"),
+	("slot", "u1"),
+	("version", "u4"),
+	("action", "u1"),
+	("state", "u1"),
+	("product", "u4"),
+	("price", "f8"),
+	("quantity", "f8"),
+	("full_price", "f8"),
+)
+# array typecodes the fields are collected in, before NumPy takes over the buffers
+_ARRAY_TYPECODES = {"u4": "I", "u1": "B", "f8": "d"}
+
+_ARRAY_VALUES = {name: operator.attrgetter(name) for name in ("version", "action", "state", "product", "price", "quantity")}
+
+class _HamtNode:
+
+	"""
+	Bitmap indexed node of the hash trie backing PrivateInfo. entries holds,
+	in bit order, either leaves (key, value, hash) or child nodes.
+	"""
+
+	__slots__ = ("bitmap", "entries")
+
+	def __init__(self, bitmap, entries):
+		self.bitmap = bitmap
+		self.entries = entries
+
+
+class _HamtCollision:
+
+	"""
+	Leaves whose 64 bit hashes are identical, once the trie has run out of hash bits.
+	"""
+
+	__slots__ = ("leaves",)
+
+	def __init__(self, leaves):
+		self.leaves = leaves
+
+
+_HAMT_BITS = 5
+_HAMT_MASK = (1 << _HAMT_BITS) - 1
+_HASH_BITS = 64
+_HASH_MASK = (1 << _HASH_BITS) - 1
+
+
+def _hamtFind(node, key, h):
+	"""
+	Returns the leaf for key in the trie rooted at node, or None.
+	"""
+	shift = 0
+	while node is not None:
+		if type(node) is _HamtCollision:
+			for leaf in node.leaves:
+				if leaf[0] is key or leaf[0] == key:
+					return leaf
+			return None
+		bit = 1 << ((h >> shift) & _HAMT_MASK)
+		if not node.bitmap & bit:
+			return None
+		entry = node.entries[(node.bitmap & (bit - 1)).bit_count()]
+		if type(entry) is tuple:
+			if entry[2] == h and (entry[0] is key or entry[0] == key):
+				return entry
+			return None
+		node = entry
+		shift += _HAMT_BITS
+	return None
+
+
+def _hamtJoin(leaf_1, leaf_2, shift):
+	"""
+	Returns the smallest subtree holding two leaves with different keys.
+	"""
+	if shift >= _HASH_BITS:
+		return _HamtCollision((leaf_1, leaf_2))
+	frag_1 = (leaf_1[2] >> shift) & _HAMT_MASK
+	frag_2 = (leaf_2[2] >> shift) & _HAMT_MASK
+	if frag_1 == frag_2:
+		return _HamtNode(1 << frag_1, [_hamtJoin(leaf_1, leaf_2, shift + _HAMT_BITS)])
+	if frag_1 < frag_2:
+		return _HamtNode((1 << frag_1) | (1 << frag_2), [leaf_1, leaf_2])
+	return _HamtNode((1 << frag_1) | (1 << frag_2), [leaf_2, leaf_1])
+
+
+def _hamtAssoc(node, leaf, shift):
+	"""
+	Returns (new node, added) where new node is node with leaf set. Only the
+	nodes on the path to the leaf are copied, the rest are shared with node.
+	"""
+	if node is None:
+		return _HamtNode(1 << ((leaf[2] >> shift) & _HAMT_MASK), [leaf]), True
+
+	if type(node) is _HamtCollision:
+		leaves = list(node.leaves)
+		for i, old in enumerate(leaves):
+			if old[0] is leaf[0] or old[0] == leaf[0]:
+				leaves[i] = leaf
+				return _HamtCollision(tuple(leaves)), False
+		leaves.append(leaf)
+		return _HamtCollision(tuple(leaves)), True
+
+	bit = 1 << ((leaf[2] >> shift) & _HAMT_MASK)
+	idx = (node.bitmap & (bit - 1)).bit_count()
+	entries = node.entries
+
+	if not node.bitmap & bit:
+		return _HamtNode(node.bitmap | bit, entries[:idx] + [leaf] + entries[idx:]), True
+
+	entry = entries[idx]
+	if type(entry) is tuple:
+		if entry[2] == leaf[2] and (entry[0] is leaf[0] or entry[0] == leaf[0]):
+			child, added = leaf, False
+		else:
+			child, added = _hamtJoin(entry, leaf, shift + _HAMT_BITS), True
+	else:
+		child, added = _hamtAssoc(entry, leaf, shift + _HAMT_BITS)
+
+	entries = list(entries)
+	entries[idx] = child
+	return _HamtNode(node.bitmap, entries), added
+
+
+def _hamtLeaves(node):
+	"""
+	Yields every leaf in the trie rooted at node.
+	"""
+	if node is None:
+		return
+	stack = [node]
+	while stack:
+		node = stack.pop()
+		entries = node.leaves if type(node) is _HamtCollision else node.entries
+		for entry in entries:
+			if type(entry) is tuple:
+				yield entry
+			else:
+				stack.append(entry)
+
+
+def _hamtEqual(node_1, node_2):
+	"""
+	Returns whether two tries hold the same items. Without removals the shape of a
+	trie only depends on its keys, so tries of different shape differ, and subtrees
+	shared between versions are equal without being walked.
+	"""
+	if node_1 is node_2:
+		return True
+	if type(node_1) is not type(node_2) or node_1 is None:
+		return False
+	if type(node_1) is _HamtCollision:
+		leaves = {leaf[0]: leaf[1] for leaf in node_2.leaves}
+		return len(node_1.leaves) == len(leaves) and all(
+			leaf[0] in leaves and leaves[leaf[0]] == leaf[1] for leaf in node_1.leaves)
+	if node_1.bitmap != node_2.bitmap:
+		return False
+	for entry_1, entry_2 in zip(node_1.entries, node_2.entries):
+		if entry_1 is entry_2:
+			continue
+		if type(entry_1) is tuple:
+			if type(entry_2) is not tuple or not (entry_1[0] is entry_2[0] or entry_1[0] == entry_2[0]) \
+					or not (entry_1[1] is entry_2[1] or entry_1[1] == entry_2[1]):
+				return False
+		elif not _hamtEqual(entry_1, entry_2):
+			return False
+	return True
+
+
+# values stored in a PrivateInfo as they are, rather than deep copied
+_IMMUTABLE_VALUES = frozenset((str, int, float, bool, bytes, complex, type(None)))
+
+
+class PrivateInfo(Mapping):
+
+	"""
+	PrivateInfo class - persistent (immutable) mapping used for User private meta data.
+	
+	Setting keys returns a new PrivateInfo that shares every unchanged entry with
+	the old one, so each offer version can keep its own private_info without copying
+	the whole mapping. Only the trie nodes on the path to a changed key are allocated.
+	Values other than strings, numbers, bytes and None are deep copied as they are
+	set, so changing a dict or list after passing it in does not change any version.
+	
+	Compares equal to a dict with the same items.
+	"""
+
+	__slots__ = ("_root", "_len")
+
+	def __init__(self, data=None):
+		"""
+		Initialise PrivateInfo, optionally from a dict (or other mapping).
+		
+		Args:
+		    data (dict): initial key -> value pairs
+		"""
+		self._root = None
+		self._len = 0
+		if data:
+			self._root, self._len = self._assocAll(data.items())
+
+	def _assocAll(self, items):
+		root = self._root
+		length = self._len
+		for k, v in items:
+			if type(v) not in _IMMUTABLE_VALUES and type(v) is not PrivateInfo:
+				v = copy.deepcopy(v)
+			root, added = _hamtAssoc(root, (k, v, hash(k) & _HASH_MASK), 0)
+			if added:
+				length += 1
+		return root, length
+
+	def merge(self, private_info):
+		"""
+		Returns a new PrivateInfo with the key->val pairs from private_info added,
+		replacing any existing values for those keys.
+		
+		Args:
+		    private_info (dict): private meta data
+		
+		Returns:
+		    PrivateInfo: the updated mapping. self is unchanged.
+		"""
+		merged = PrivateInfo()
+		merged._root, merged._len = self._assocAll(private_info.items())
+		return merged
+
+	def set(self, key, value):
+		"""
+		Returns a new PrivateInfo with key set to value.
+		"""
+		return self.merge({key: value})
+
+	def __getitem__(self, key):
+		leaf = _hamtFind(self._root, key, hash(key) & _HASH_MASK)
+		if leaf is None:
+			raise KeyError(key)
+		return leaf[1]
+
+	def __contains__(self, key):
+		return _hamtFind(self._root, key, hash(key) & _HASH_MASK) is not None
+
+	def __iter__(self):
+		for leaf in _hamtLeaves(self._root):
+			yield leaf[0]
+
+	def __len__(self):
+		return self._len
+
+	def items(self):
+		return [(leaf[0], leaf[1]) for leaf in _hamtLeaves(self._root)]
+
+	def __eq__(self, other):
+		# versions share unchanged subtrees, so only the changed paths are compared
+		if isinstance(other, PrivateInfo):
+			return self._len == other._len and _hamtEqual(self._root, other._root)
+		return Mapping.__eq__(self, other)
+
+	__hash__ = None
+
+	def __reduce__(self):
+		return (PrivateInfo, (dict(self.items()),))
+
+	def __repr__(self):
+		return "PrivateInfo({0!r})".format(dict(self.items()))
+
+
+_EMPTY_PRIVATE_INFO = PrivateInfo()
+
+yaml.add_representer(PrivateInfo, lambda dumper, data: dumper.represent_dict(dict(data.items())))
+
 class User:
 
     """
@@ -75,15 +774,31 @@ class User:
     Attributes:
         curr_version (int): count to keep track of current version for offer history
         current_offer (Offer): the most recent Offer created 
+        deltas (DeltaIndex): delta index of offer_history, None until a diff needs it
         end (bool): whether offer has been accepted or cancelled
-        offer_history (list): list of Offer instances
+        offer_history (list): list of Offer instances (a projection of the EventLog if event sourced)
         other (string): the id of the other user in the transaction
-        private_info (dict): private meta data
+        private_info (PrivateInfo): private meta data
         role (string): is seller buyer or seller?
         state (string): state of this user
+        state_code (int): STATE_* code of state
         user_id (string): id of this user
     """
 
+    __slots__ = (
+    	"user_id",
+    	"role",
+    	"state",
+    	"state_code",
+    	"offer_history",
+    	"private_info",
+    	"curr_version",
+    	"end",
+    	"current_offer",
+    	"other",
+    	"deltas",
+    )
+
     def __init__(self, user_id):
     	"""
     	Initialises User. Called by Haggler.__init__ method.
@@ -95,30 +810,33 @@ class User:
     	self.user_id = user_id
     	self.role = None
     	self.state = None
+    	self.state_code = STATE_NONE
     	self.offer_history = []
-    	self.private_info = {}
+    	self.private_info = _EMPTY_PRIVATE_INFO
     	self.curr_version = 1
     	self.end = False # set to true on Accept or Cancel
     	self.current_offer = None
     	self.other = None
+    	self.deltas = None
 
     def addOfferHistory(self, offer):
     	"""
-    	Adds User specific info to Offer instance then adds it to the 
+    	Creates a new version of the Offer with User specific info then adds it to the 
     	offer history, updates the current offer and increments the current version.
+    	The offer passed in is not modified and unchanged attributes are shared.
     	
     	Args:
     	    offer (Offer): Offer instance being added to the history
     	"""
-    	offer = copy.deepcopy(offer)
-    	# set the state to this users state at time of version/action
-    	offer.state = self.state
-    	# update private info if user has it
-    	offer.private_info = copy.deepcopy(self.private_info)
-    	# set the user_id of Offer to this users id
-    	offer.user_id = self.user_id
-    	# set offer version to current version then increment curr_version
-    	offer.version = self.curr_version
+    	offer = offer.replace(
+    		# the state of this user at time of version/action
+    		state=self.state,
+    		# private info is never mutated in place so it can be shared
+    		private_info=self.private_info,
+    		user_id=self.user_id,
+    		# set offer version to current version then increment curr_version
+    		version=self.curr_version,
+    	)
     	
     	self.offer_history.append(offer)
     	self.current_offer = offer
@@ -139,12 +857,13 @@ class User:
 		Data only visible to this User.
 		Preserves previous data unless explicitly replaced
     	
+    	private_info is a PrivateInfo, so the update makes a new mapping sharing
+    	unchanged entries with the one held by earlier versions in the offer history.
+    	
     	Args:
     	    private_info (dict): private meta data
     	"""
-    	for k, v in private_info.items():
-
-    		self.private_info[k] = v
+    	self.private_info = self.private_info.merge(private_info)
 
     def setEnd(self):
     	"""
@@ -160,6 +879,7 @@ class User:
     	    state (string): new state of User
     	"""
     	self.state = state
+    	self.state_code = STATE_CODES[state]
 
     def setOther(self, other):
     	"""
@@ -171,397 +891,1219 @@ class User:
     	self.other = other
 
 
-class Haggler:
+class EventLog:
 
 	"""
-	Haggler Class - This class stores the two Users in the transaction in a 
-	self.users dict. Has all methods related to taking actions and retrieving/printing
-	data.
+	EventLog Class - single shared log of the actions taken in an event sourced Haggler.
+	
+	Each action is stored once, as one row across a set of columns. Only state
+	and private_info differ between the two Users so those are the only per-user
+	columns. UpdatePrivateData is one sided, so the other User has STATE_NONE and
+	None in its columns for that row.
+	
+	Actions and states are stored as their codes, and user_action, buyer and seller
+	as the column of the User in user_ids, each a byte in an array.
+	
+	The offer history of each User is a _Projection over the log, worked out on
+	demand and memoised.
 	
 	Attributes:
-	    users (TYPE): Description
+	    user_ids (tuple): ids of the two Users, in column order
+	    action (array): ACTION_* code column
+	    user_action (array): user_action column, as User columns
+	    buyer (array): buyer column, as User columns
+	    seller (array): seller column, as User columns
+	    product (list): product column
+	    price (list): price column
+	    quantity (list): quantity column
+	    state (tuple): a STATE_* code column per User
+	    private_info (tuple): a private_info column per User
 	"""
-	
+
 	def __init__(self, user_id_1, user_id_2):
 		"""
-		Initialise the Haggler. Two Users are created and attached to the Haggler
-		instance.
+		Initialise an empty EventLog for the two Users of a Haggler.
 		
 		Args:
-		    user_id_1 (string): id of first User to be created
-		    user_id_2 (string): id of second User to be created
-		
-		Raises:
-		    TypeError: If the user ids supplied are not str, exception is raised.
+		    user_id_1 (string): id of first User
+		    user_id_2 (string): id of second User
 		"""
-		# check ids are both strings
-
-		str_chk1 = isinstance(user_id_1, str)
-		str_chk2 = isinstance(user_id_2, str)
+		self.user_ids = (user_id_1, user_id_2)
+		self.action = array("B")
+		self.user_action = array("B")
+		self.buyer = array("B")
+		self.seller = array("B")
+		self.product = []
+		self.price = []
+		self.quantity = []
+		self.state = (array("B"), array("B"))
+		self.private_info = ([], [])
 
-		if str_chk1 and str_chk2:
+	def __len__(self):
+		return len(self.action)
 
-			# init each user
+	def projection(self, user_id):
+		"""
+		Returns the offer history of user_id as a lazily computed view of this log.
+		
+		Args:
+		    user_id (string): id of the User
+		
+		Returns:
+		    _Projection: sequence of Offer instances, one per version
+		"""
+		return _Projection(self, self.user_ids.index(user_id))
 
-			user_1 = User(user_id_1)
-			user_2 = User(user_id_2)
+	def record(self, slot, offer):
+		"""
+		Records a version of offer for the User in column slot.
+		
+		Joint actions are added to the history of both Users back to back, so
+		if the last row is a joint action still missing this Users columns the
+		record completes that row rather than appending a new one.
+		
+		Args:
+		    slot (int): column of the User (0 or 1)
+		    offer (Offer): versioned Offer from User.addOfferHistory
+		"""
+		state = self.state[slot]
+		private_info = self.private_info[slot]
+		action = ACTION_CODES[offer.action]
+		user_action = self.user_ids.index(offer.user_action)
 
-			self.users = {
-				user_id_1: user_1,
-				user_id_2: user_2,
-			}
-		else:
-			try:
-				raise TypeError("User IDs must be type string")
-			except TypeError as error:
-				print(error)
+		if(self.action and len(state) == len(self.action) - 1
+			and self.action[-1] == action and action != ACTION_UPDATE_PRIVATE_DATA
+			and self.user_action[-1] == user_action):
+			state.append(STATE_CODES[offer.state])
+			private_info.append(offer.private_info)
 			return
 
+		# rows a User took no part in are STATE_NONE and None in its columns
+		rows = len(self.action)
+		for slot_state, slot_private_info in zip(self.state, self.private_info):
+			while len(slot_state) < rows:
+				slot_state.append(STATE_NONE)
+				slot_private_info.append(None)
 
-	def submit(self, user_id, other_id, offer):
+		self.action.append(action)
+		self.user_action.append(user_action)
+		self.buyer.append(self.user_ids.index(offer.buyer))
+		self.seller.append(self.user_ids.index(offer.seller))
+		self.product.append(offer.product)
+		self.price.append(offer.price)
+		self.quantity.append(offer.quantity)
+
+		state.append(STATE_CODES[offer.state])
+		private_info.append(offer.private_info)
+
+	def event(self, position):
 		"""
-		Submits the first offer. This establishes who the seller and buyer are and their
-		relationship to each other, what the first offer is etc.
+		Returns a row of the log as a dict, with a per User dict under "users".
 		
 		Args:
-		    user_id (string): user id of user performing the action
-		    other_id (string): user id of recipient of action
-		    offer (Offer): Offer instance containing info on current offer
+		    position (int): row index
 		
-		Raises:
-		    ValueError: if the user ids supplied are not present in the Haggler.users dict
+		Returns:
+		    dict: the action taken and the state/private_info of each User it applied to
 		"""
-		if user_id in self.users.keys() and other_id in self.users.keys():
-			seller = self.users[user_id]
-			buyer = self.users[other_id]
+		users = {}
+		user_ids = self.user_ids
+		for slot, user_id in enumerate(user_ids):
+			if position < len(self.state[slot]) and self.state[slot][position] != STATE_NONE:
+				users[user_id] = {
+					"state": STATES[self.state[slot][position]],
+					"private_info": self.private_info[slot][position],
+				}
+		return {
+			"action": ACTIONS[self.action[position]],
+			"user_action": user_ids[self.user_action[position]],
+			"buyer": user_ids[self.buyer[position]],
+			"seller": user_ids[self.seller[position]],
+			"product": self.product[position],
+			"price": self.price[position],
+			"quantity": self.quantity[position],
+			"users": users,
+		}
 
-			# check if endpoint has been reached already
-			if seller.end:
-				try:
-					raise ValueError("Offer has been {0} - no more actions possible.".format(u1.state))
-				except ValueError as error:
-					print(error)
-				return
+	def __iter__(self):
+		for position in range(len(self.action)):
+			yield self.event(position)
+
+	@classmethod
+	def rebuild(cls, user_id_1, user_id_2, history_1, history_2):
+		"""
+		Builds an EventLog from the offer histories of its two Users.
+		
+		UpdatePrivateData versions are one sided, every other version is in both
+		histories. When both Users have an UpdatePrivateData next, which came first
+		is not known from the histories, so the first User's is taken first. The two
+		are independent so the projections are the same either way.
+		
+		Args:
+		    user_id_1 (string): id of first User
+		    user_id_2 (string): id of second User
+		    history_1 (sequence): Offer versions of first User
+		    history_2 (sequence): Offer versions of second User
+		
+		Returns:
+		    EventLog: log whose projections give back history_1 and history_2
+		"""
+		log = cls(user_id_1, user_id_2)
+		i = j = 0
+		while i < len(history_1) or j < len(history_2):
+			if i < len(history_1) and (j == len(history_2) or history_1[i].action == "UpdatePrivateData"):
+				log.record(0, history_1[i])
+				i += 1
+			elif j < len(history_2) and (i == len(history_1) or history_2[j].action == "UpdatePrivateData"):
+				log.record(1, history_2[j])
+				j += 1
+			else:
+				log.record(0, history_1[i])
+				log.record(1, history_2[j])
+				i += 1
+				j += 1
+		return log
+
+
+class _Projection(Sequence):
 
-			# set up relationship for other actions
-			seller.setOther(buyer)
-			buyer.setOther(seller)
+	"""
+	Offer history of one User derived from an EventLog. Used as User.offer_history
+	by event sourced Hagglers.
+	
+	The row index of each of the Users versions is memoised and brought up to date
+	from the rows added since the last query. Offer instances are built on access.
+	"""
 
-			# add info to offer
+	def __init__(self, log, slot):
+		self.log = log
+		self.slot = slot
+		self.user_id = log.user_ids[slot]
+		self._positions = array("L")
+		self._seen = 0
 
-			offer.action = "Submit"
-			offer.user_action = user_id
-			offer.seller = user_id
-			offer.buyer = other_id
+	def _sync(self):
+		state = self.log.state[self.slot]
+		positions = self._positions
+		for position in range(self._seen, len(state)):
+			if state[position] != STATE_NONE:
+				positions.append(position)
+		self._seen = len(state)
+		return positions
 
-			# update roles and states
-			seller.setRole("seller")
-			seller.setState("AwaitingTheirAcceptance")
+	def append(self, offer):
+		self.log.record(self.slot, offer)
 
-			buyer.setRole("buyer")
-			buyer.setState("AwaitingMyAcceptance")
+	def _offer(self, position, version):
+		log = self.log
+		user_ids = log.user_ids
+		offer = _new_offer(Offer)
+		offer.__setstate__((
+			self.user_id,
+			version,
+			ACTIONS[log.action[position]],
+			user_ids[log.user_action[position]],
+			STATES[log.state[self.slot][position]],
+			user_ids[log.buyer[position]],
+			user_ids[log.seller[position]],
+			log.product[position],
+			log.price[position],
+			log.quantity[position],
+			log.private_info[self.slot][position],
+		))
+		return offer
 
-			# add the offer to respective histories
-			seller.addOfferHistory(offer)
-			buyer.addOfferHistory(offer)
-			return
+	def __len__(self):
+		return len(self._sync())
 
-		else:
-			try:
-				raise ValueError("Error: {0} or {1} is not a valid user in this Haggler.".format(user_id,  other_id))
-			except ValueError as error:
-				print(error)
-			return
+	def __getitem__(self, index):
+		positions = self._sync()
+		if isinstance(index, slice):
+			return [self._offer(positions[i], i + 1) for i in range(*index.indices(len(positions)))]
+		if index < 0:
+			index += len(positions)
+		return self._offer(positions[index], index + 1)
 
-	def accept(self, user_id):
+	def __iter__(self):
+		for i, position in enumerate(self._sync()):
+			yield self._offer(position, i + 1)
+
+
+# attributes tracked by DeltaIndex - user_id is the same for the whole history and
+# version changes on every step
+_DELTA_FIELDS = Offer.__slots__[2:]
+_DELTA_VALUES = operator.attrgetter(*_DELTA_FIELDS)
+
+
+class DeltaIndex:
+
+	"""
+	Delta index of one User's offer history: for each Offer attribute but user_id and
+	version, the versions at which it differs from the version before. Consecutive versions
+	share unchanged attribute objects, so most comparisons are identity checks.
+	
+	The index is built on first use and extended with the versions added since, so
+	each version is compared with its predecessor once. A diff between two versions
+	then only compares the attributes that changed somewhere between them, found by
+	bisecting their change lists.
+	
+	Attributes:
+	    changes (dict): attribute name -> array of the versions it changed at, None
+	        until the first version is indexed
+	    length (int): number of versions indexed
+	    lock (threading.Lock): guards extending the index, which the views of a
+	        ThreadSafeHaggler share
+	"""
+
+	__slots__ = ("changes", "length", "lock", "_last")
+
+	def __init__(self):
+		self.changes = None
+		self.length = 0
+		self.lock = threading.Lock()
+		self._last = None
+
+	def __getstate__(self):
+		return (self.changes, self.length, self._last)
+
+	def __setstate__(self, state):
+		self.changes, self.length, self._last = state
+		self.lock = threading.Lock()
+
+	def extend(self, history):
 		"""
-		Accepts the current offer. user_id must be in state "AwaitingMyAcceptance".
-		Results in an end state.
+		Indexes the versions of history not indexed yet.
 		
 		Args:
-		    user_id (string): user id of user performing the action
-		
-		Raises:
-		    ValueError: if the user id supplied is not present in the Haggler.users dict
+		    history (sequence): the offer history this index belongs to
 		"""
-		if user_id in self.users.keys():
-			u1 = self.users[user_id]
-			u2 = u1.other
+		if self.length >= len(history):
+			return
+		with self.lock:
+			if self.changes is None:
+				self.changes = {name: array("L") for name in _DELTA_FIELDS}
+			changes = [self.changes[name] for name in _DELTA_FIELDS]
+			last = self._last
+			for index in range(self.length, len(history)):
+				values = _DELTA_VALUES(history[index])
+				if last is not None:
+					version = index + 1
+					for column, old, new in zip(changes, last, values):
+						if old is not new and old != new:
+							column.append(version)
+				last = values
+			self._last = last
+			self.length = len(history)
 
-			# check if endpoint has been reached already
-			if u1.end:
-				try:
-					raise ValueError("Offer has been {0} - no more actions possible.".format(u1.state))
-				except ValueError as error:
-					print(error)
-				return
+	def changed(self, name, v1, v2):
+		"""
+		Returns whether attribute name changed between versions v1 and v2, v1 <= v2.
+		"""
+		column = self.changes[name]
+		i = bisect_right(column, v1)
+		return i < len(column) and column[i] <= v2
+
+	def differences(self, history, v1, v2):
+		"""
+		Returns versionDifferences for versions v1 and v2 of history, which must have
+		been indexed.
+		"""
+		if v1 == v2:
+			return {}
+		a = history[v1 - 1]
+		b = history[v2 - 1]
+		diffs = {"version": [a.version, b.version]}
+		low, high = (v1, v2) if v1 < v2 else (v2, v1)
+		changed = self.changed
+		for name in _DELTA_FIELDS:
+			if changed(name, low, high):
+				old = getattr(a, name)
+				new = getattr(b, name)
+				# an attribute can change and change back
+				if old != new:
+					diffs[name] = [old, new]
+		return diffs
 
-			# check state of u1
+	def consecutive(self, history):
+		"""
+		Returns the differences between each version of history and the next, which
+		must have been indexed, in one pass over the change lists. The index can be
+		longer than history, when it is shared with a view of an earlier version.
+		"""
+		n = min(self.length, len(history))
+		steps = [{"version": [v, v + 1]} for v in range(1, n)]
+		for name in _DELTA_FIELDS:
+			for version in self.changes[name]:
+				if version > n:
+					break
+				steps[version - 2][name] = None
+		previous = None
+		for version, offer in enumerate(history, 1):
+			if version > n:
+				break
+			if previous is not None:
+				step = steps[version - 2]
+				for name in step:
+					if name != "version":
+						step[name] = [getattr(previous, name), getattr(offer, name)]
+			previous = offer
+		return steps
+
+
+def _deltaIndex(user):
+	"""
+	Returns the DeltaIndex of user, brought up to date with its offer history.
+	"""
+	deltas = user.deltas
+	if deltas is None:
+		deltas = user.deltas = DeltaIndex()
+	deltas.extend(user.offer_history)
+	return deltas
 
-			if u1.state == "AwaitingMyAcceptance":
 
-				offer = copy.deepcopy(u1.current_offer)
-				offer.action = "Accept"
-				offer.user_action = user_id
+# attributes of a spilled row besides user_id, version and private_info
+_SPILL_FIELDS = operator.attrgetter(*Offer.__slots__[2:-1])
 
-				# update states
-				u1.setState("Accepted")
-				u2.setState("Accepted")
+# how a spilled row stores its private_info
+_SPILL_SAME = 0    # the private_info of the row before
+_SPILL_VALUE = 1   # the private_info itself
+_SPILL_CHANGES = 2 # the items changed since the row before, merged onto its private_info
 
-				u1.setEnd()
-				u2.setEnd()
+# length prefix of a chunk in the segment
+_SPILL_LENGTH = struct.Struct("<I")
 
-				# add the offer to respective histories
-				u1.addOfferHistory(offer)
-				u2.addOfferHistory(offer)
-				return
+
+def _hamtChangedLeaves(node_1, node_2):
+	"""
+	Yields the leaves of the trie rooted at node_2 whose key or value is not in the
+	trie rooted at node_1. Subtrees shared by the two are skipped.
+	"""
+	stack = [] if node_1 is node_2 else [(node_1, node_2)]
+	while stack:
+		entry_1, entry_2 = stack.pop()
+		if type(entry_1) is _HamtNode and type(entry_2) is _HamtNode and entry_1.bitmap == entry_2.bitmap:
+			for child_1, child_2 in zip(entry_1.entries, entry_2.entries):
+				if child_1 is not child_2:
+					stack.append((child_1, child_2))
+			continue
+		# the shapes differ, so compare the leaves below
+		old = {leaf[0]: leaf[1] for leaf in ((entry_1,) if type(entry_1) is tuple else _hamtLeaves(entry_1))}
+		for leaf in ((entry_2,) if type(entry_2) is tuple else _hamtLeaves(entry_2)):
+			if leaf[0] not in old or not (old[leaf[0]] is leaf[1] or old[leaf[0]] == leaf[1]):
+				yield leaf
+
+
+def _privateInfoChanges(old, new):
+	"""
+	Returns the items of PrivateInfo new that old.merge needs to make it, or None if
+	new lacks some of old's keys. Subtrees the two share are skipped.
+	"""
+	changes = {leaf[0]: leaf[1] for leaf in _hamtChangedLeaves(old._root, new._root)}
+	added = sum(1 for key in changes if key not in old)
+	if old._len + added != new._len:
+		return None
+	return changes
+
+
+def _spillRows(offers, compact):
+	"""
+	Returns the rows a chunk of versions is spilled as: (fields, kind, private_info)
+	where kind is a _SPILL_* code. When compact, fields is None if they equal those
+	of the row before, and a private_info changed by an UpdatePrivateData is stored
+	as the items it changed.
+	"""
+	rows = []
+	previous_fields = previous = None
+	for offer in offers:
+		fields = _SPILL_FIELDS(offer)
+		private_info = offer.private_info
+		kind = _SPILL_VALUE
+		if compact:
+			if fields == previous_fields:
+				fields = None
 			else:
-				try:
-					raise ValueError("Error: State {0} invalid for Accept by {1}.".format(u1.state, user_id))
-				except ValueError as error:
-					print(error)
-				return
+				previous_fields = fields
+			if private_info is previous:
+				kind, private_info = _SPILL_SAME, None
+			elif type(previous) is PrivateInfo and type(private_info) is PrivateInfo:
+				changes = _privateInfoChanges(previous, private_info)
+				if changes is not None:
+					kind = _SPILL_CHANGES
+			previous = offer.private_info
+			if kind == _SPILL_CHANGES:
+				private_info = changes
+		rows.append((fields, kind, private_info))
+	return rows
 
-		else:
-			try:
-				raise ValueError("Error: {0} is not a valid user in this Haggler.".format(user_id))
-			except ValueError as error:
-				print(error)
-			return
 
-	def cancel(self, user_id):
+class HistoryRetention:
+
+	"""
+	Retention policy for very long offer histories, given to a Haggler or HagglerPool.
+	
+	Each history keeps its last keep versions in memory. Once it has spill versions
+	more than that, the oldest spill of them are written as one chunk to a segment
+	file shared by every history using the policy. Spilled versions are still read
+	through the history, so returnVersion, printVersion, versionDifferences and the
+	exports work as before: a read decodes the chunk holding the version, and the
+	last cache chunks decoded are kept in a LRU.
+	
+	With compact, a chunk row leaves out the attributes that equal those of the
+	version before, and the private_info of an UpdatePrivateData is stored as the
+	items it changed, so runs of private data updates shrink to their updates.
+	
+	The segment is only scratch space for the process: chunks are not removed when
+	their negotiation ends, and close deletes the file. Use a WriteAheadLog or a
+	snapshot for durability.
+	
+	Attributes:
+	    cache (int): most decoded chunks kept in memory
+	    compact (bool): store chunk rows as the changes from the row before
+	    keep (int): versions of each history kept in memory
+	    path (string): path of the segment file, None for an anonymous temporary file
+	    reads (int): count of chunks read back from the segment
+	    size (int): bytes written to the segment
+	    spill (int): versions per chunk
+	    spilled (int): count of versions written to the segment
+	"""
+
+	def __init__(self, keep=1000, spill=256, cache=64, compact=True, path=None):
 		"""
-		Cancels the current offer. user_id can be in any state that isn't an end state.
-		Results in an end state.
+		Initialise a HistoryRetention and open its segment file.
 		
 		Args:
-		    user_id (string): user id of user performing the action
+		    keep (int): versions of each history kept in memory
+		    spill (int): versions written to the segment at a time
+		    cache (int): most decoded chunks kept in memory
+		    compact (bool): store chunk rows as the changes from the row before
+		    path (string): path of the segment file, replaced if it exists. An
+		        anonymous temporary file if None.
 		
 		Raises:
-		    ValueError: if the user id supplied is not present in the Haggler.users dict
+		    ValueError: if keep or cache is negative, or spill is not positive
 		"""
-		if user_id in self.users.keys():
-			u1 = self.users[user_id]
-			u2 = u1.other
+		if keep < 0 or cache < 0 or spill < 1:
+			raise ValueError("keep and cache must be >= 0 and spill >= 1, not {0}, {1} and {2}".format(keep, cache, spill))
+		self.keep = keep
+		self.spill = spill
+		self.cache = cache
+		self.compact = compact
+		self.path = path
+		self.file = tempfile.TemporaryFile() if path is None else open(path, "w+b")
+		self.size = 0
+		self.spilled = 0
+		self.reads = 0
+		self._chunks = OrderedDict()
 
-			# check if endpoint has been reached already
-			if u1.end:
-				try:
-					raise ValueError("Offer has been {0} - no more actions possible.".format(u1.state))
-				except ValueError as error:
-					print(error)
-				return
+	def history(self, user_id, versions=()):
+		"""
+		Returns an empty offer history for user_id that follows this policy, then
+		appends versions to it.
+		
+		Args:
+		    user_id (string): id of the User the history belongs to
+		    versions (iterable): Offers already in the history
+		
+		Returns:
+		    sequence: the history, to use as User.offer_history
+		"""
+		history = _SpilledHistory(self, user_id)
+		for offer in versions:
+			history.append(offer)
+		return history
 
-			offer = copy.deepcopy(u1.current_offer)
-			offer.action = "Cancel"
-			offer.user_action = user_id
+	def _write(self, offers):
+		"""
+		Appends a chunk of versions to the segment and returns its offset.
+		"""
+		data = pickle.dumps(_spillRows(offers, self.compact), pickle.HIGHEST_PROTOCOL)
+		offset = self.size
+		self.file.seek(offset)
+		self.file.write(_SPILL_LENGTH.pack(len(data)) + data)
+		self.size += _SPILL_LENGTH.size + len(data)
+		self.spilled += len(offers)
+		return offset
 
-			# update states
-			u1.setState("Cancelled")
-			u2.setState("Cancelled")
+	def _read(self, offset, user_id, version, cached=True):
+		"""
+		Returns the Offers of the chunk at offset, the first of which is version.
+		"""
+		chunks = self._chunks
+		offers = chunks.get(offset)
+		if offers is not None:
+			chunks.move_to_end(offset)
+			return offers
 
-			u1.setEnd()
-			u2.setEnd()
+		self.file.seek(offset)
+		length, = _SPILL_LENGTH.unpack(self.file.read(_SPILL_LENGTH.size))
+		rows = pickle.loads(self.file.read(length))
+		self.reads += 1
 
-			# add the offer to respective histories
-			u1.addOfferHistory(offer)
-			u2.addOfferHistory(offer)
-			return
+		offers = []
+		fields = private_info = None
+		for row_fields, kind, value in rows:
+			if row_fields is not None:
+				fields = row_fields
+			if kind == _SPILL_VALUE:
+				private_info = value
+			elif kind == _SPILL_CHANGES:
+				private_info = private_info.merge(value)
+			offer = _new_offer(Offer)
+			offer.__setstate__((user_id, version) + fields + (private_info,))
+			offers.append(offer)
+			version += 1
 
-		else:
-			try:
-				raise ValueError("Error: {0} is not a valid user in this Haggler.".format(user_id))
-			except ValueError as error:
-				print(error)
-			return
+		if cached and self.cache:
+			chunks[offset] = offers
+			if len(chunks) > self.cache:
+				chunks.popitem(last=False)
+		return offers
 
-	def withdraw(self, user_id):
+	def close(self):
 		"""
-		Withdraws the current offer. user_id must be in "AwaitingTheirAcceptance" state.
-		
-		Args:
-		    user_id (string): user id of user performing the action
-		
-		Raises:
-		    ValueError: if the user id supplied is not present in the Haggler.users dict
+		Closes the segment file, deleting it. Spilled versions can no longer be read.
 		"""
-		if user_id in self.users.keys():
-			u1 = self.users[user_id]
-			u2 = u1.other
+		self._chunks.clear()
+		self.file.close()
+		if self.path is not None and os.path.exists(self.path):
+			os.remove(self.path)
 
-			# check if endpoint has been reached already
-			if u1.end:
-				try:
-					raise ValueError("Offer has been {0} - no more actions possible.".format(u1.state))
-				except ValueError as error:
-					print(error)
-				return
 
-			# check if u1 state
-			if u1.state == "AwaitingTheirAcceptance":
-				
-				offer = copy.deepcopy(u1.current_offer)
-				offer.action = "Withdraw"
-				offer.user_action = user_id
+class _SpilledHistory(Sequence):
+
+	"""
+	Offer history of one User under a HistoryRetention. hot holds the versions in
+	memory, after the offsets[k] chunks of spill versions each in the segment.
+	
+	Pickles as a plain list of every version.
+	"""
 
-				# update states
-				u1.setState("WithdrawnByMe")
-				u2.setState("WithdrawnByThem")
+	__slots__ = ("retention", "user_id", "hot", "offsets")
 
-				# add the offer to respective histories
-				u1.addOfferHistory(offer)
-				u2.addOfferHistory(offer)
-				return
-			else:
-				try:
-					raise ValueError("Error: State {0} invalid for Withdraw by {1}.".format(u1.state, user_id))
-				except ValueError as error:
-					print(error)
-				return
+	def __init__(self, retention, user_id):
+		self.retention = retention
+		self.user_id = user_id
+		self.hot = []
+		self.offsets = array("Q")
+
+	def append(self, offer):
+		hot = self.hot
+		hot.append(offer)
+		retention = self.retention
+		if len(hot) >= retention.keep + retention.spill:
+			self.offsets.append(retention._write(hot[:retention.spill]))
+			del hot[:retention.spill]
+
+	def _chunk(self, k, cached=True):
+		spill = self.retention.spill
+		return self.retention._read(self.offsets[k], self.user_id, k * spill + 1, cached)
+
+	def __len__(self):
+		return len(self.offsets) * self.retention.spill + len(self.hot)
+
+	def __getitem__(self, index):
+		if isinstance(index, slice):
+			return [self[i] for i in range(*index.indices(len(self)))]
+		spilled = len(self.offsets) * self.retention.spill
+		if index < 0:
+			index += spilled + len(self.hot)
+		if index >= spilled:
+			return self.hot[index - spilled]
+		if index < 0:
+			raise IndexError("history index out of range")
+		k, i = divmod(index, self.retention.spill)
+		return self._chunk(k)[i]
+
+	def __iter__(self):
+		# a full scan would only push every other chunk out of the cache
+		for k in range(len(self.offsets)):
+			yield from self._chunk(k, False)
+		yield from self.hot
+
+	def __reduce__(self):
+		return (list, (list(self),))
+
+
+# Haggler.steps codes - which Users an action added a version for
+_STEP_BOTH = 0
+_STEP_FIRST = 1  # UpdatePrivateData by the first User
+_STEP_SECOND = 2 # UpdatePrivateData by the second User
+
+# steps between the checkpoints of a _Timeline
+_TIMELINE_BLOCK = 64
+
+
+def _reconstructSteps(users):
+	"""
+	Works the steps of a negotiation out from its two offer histories, for Hagglers
+	made without them, e.g. from an older snapshot. One sided versions between the same two
+	two sided ones are taken to be the first User's then the second's.
+	"""
+	history_1, history_2 = [user.offer_history for user in users.values()]
+	steps = bytearray()
+	i = j = 0
+	while i < len(history_1) or j < len(history_2):
+		if i < len(history_1) and history_1[i].action == "UpdatePrivateData":
+			steps.append(_STEP_FIRST)
+			i += 1
+		elif j < len(history_2) and history_2[j].action == "UpdatePrivateData":
+			steps.append(_STEP_SECOND)
+			j += 1
 		else:
-			try:
-				raise ValueError("Error: {0} is not a valid user in this Haggler.".format(user_id))
-			except ValueError as error:
-				print(error)
-			return
+			steps.append(_STEP_BOTH)
+			i += 1
+			j += 1
+	return steps
 
-	def proposeUpdate(self, user_id, offer):
+
+def _savedSteps(haggler):
+	"""
+	Returns the steps of haggler to save with it - its own if they match its offer
+	histories, otherwise worked out from them.
+	"""
+	steps = haggler.steps
+	lengths = [len(user.offer_history) for user in haggler.users.values()]
+	if lengths != [len(steps) - steps.count(_STEP_SECOND), len(steps) - steps.count(_STEP_FIRST)]:
+		return _reconstructSteps(haggler.users)
+	return steps
+
+
+class _Timeline:
+
+	"""
+	Checkpoints over the steps of a Haggler: versions[slot][k] is the number of
+	versions the User in slot had after the first k * _TIMELINE_BLOCK steps. Counting
+	from the checkpoint before a step only scans one block, and the checkpoints are
+	bisected to find the step of a version.
+	"""
+
+	__slots__ = ("steps", "versions")
+
+	def __init__(self, steps):
+		self.steps = steps
+		self.versions = (array("L", [0]), array("L", [0]))
+
+	def extend(self):
 		"""
-		Proposes an update to the offer. user_id must be in "WithdrawnByMe" or "AwaitingMyAcceptance"
-		state.
-		
-		Args:
-		    user_id (string): user id of user performing the action
-		    offer (Offer): new Offer instance containing info on updated offer
-		
-		Raises:
-		    ValueError: if the user ids supplied are not present in the Haggler.users dict
+		Adds the checkpoints of the blocks completed since the last call.
 		"""
-		if user_id in self.users.keys():
-			u1 = self.users[user_id]
-			u2 = u1.other
+		steps = self.steps
+		first, second = self.versions
+		for k in range(len(first), len(steps) // _TIMELINE_BLOCK + 1):
+			start = (k - 1) * _TIMELINE_BLOCK
+			end = start + _TIMELINE_BLOCK
+			first.append(first[-1] + _TIMELINE_BLOCK - steps.count(_STEP_SECOND, start, end))
+			second.append(second[-1] + _TIMELINE_BLOCK - steps.count(_STEP_FIRST, start, end))
 
-			# check if endpoint has been reached already
-			if u1.end:
-				try:
-					raise ValueError("Offer has been {0} - no more actions possible.".format(u1.state))
-				except ValueError as error:
-					print(error)
-				return
+	def versionsAt(self, step):
+		"""
+		Returns (versions of the first User, versions of the second) after step steps.
+		"""
+		k = step // _TIMELINE_BLOCK
+		start = k * _TIMELINE_BLOCK
+		first, second = self.versions
+		steps = self.steps
+		return (
+			first[k] + step - start - steps.count(_STEP_SECOND, start, step),
+			second[k] + step - start - steps.count(_STEP_FIRST, start, step),
+		)
 
-			# check if u1 state
-			if u1.state in ["WithdrawnByMe", "AwaitingMyAcceptance"]:
-				# update states
-				u1.setState("AwaitingTheirAcceptance")
-				u2.setState("AwaitingMyAcceptance")
-
-				# add the offer to respective histories
-				#offer = copy.deepcopy(offer)
-				offer.action = "ProposeUpdate"
-				offer.user_action = user_id
-				offer.seller = u1.current_offer.seller
-				offer.buyer = u1.current_offer.buyer
-				u1.addOfferHistory(offer)
-				u2.addOfferHistory(offer)
-				return
-			else:
-				try:
-					raise ValueError("Error: State {0} invalid for ProposeUpdate by {1}.".format(u1.state, user_id))
-				except ValueError as error:
-					print(error)
-				return
-		else:
-			try:
-				raise ValueError("Error: {0} is not a valid user in this Haggler.".format(user_id))
-			except ValueError as error:
-				print(error)
-			return
+	def stepOf(self, slot, version):
+		"""
+		Returns the step that added version to the history of the User in slot.
+		"""
+		versions = self.versions[slot]
+		# the last checkpoint with fewer versions, then scan its block
+		k = bisect_left(versions, version) - 1
+		count = versions[k]
+		skip = _STEP_SECOND if slot == 0 else _STEP_FIRST
+		steps = self.steps
+		step = k * _TIMELINE_BLOCK
+		while count < version:
+			if steps[step] != skip:
+				count += 1
+			step += 1
+		return step
 
 
-	def updatePrivateData(self, user_id, private_info):
+class Haggler:
+
+	"""
+	Haggler Class - This class stores the two Users in the transaction in a 
+	self.users dict. Has all methods related to taking actions and retrieving/printing
+	data.
+	
+	In event sourced mode each action is appended once to a shared EventLog and
+	the offer history of each User is a projection of that log, instead of each
+	User keeping a full list of Offers.
+	
+	Every action returns a RESULT_* code. How errors are reported depends on the
+	errors mode: "print" prints them (the default), "return" only returns the code
+	with no I/O at all, and "raise" raises the matching HagglingError. Rejected
+	actions are counted in rejections in every mode.
+	
+	Each action also appends a byte to steps saying which Users it added a version
+	for, so the joint state of both Users can be looked up at any step.
+	
+	With a HistoryRetention, only the latest versions of each offer history are kept
+	in memory and older ones are spilled to its segment file.
+	
+	Attributes:
+	    errors (string): errors mode - ERRORS_PRINT, ERRORS_RETURN or ERRORS_RAISE
+	    log (EventLog): shared log of actions if event sourced, otherwise None
+	    steps (bytearray): a _STEP_* code per successful action, in order
+	    timeline (_Timeline): checkpoints over steps, None until a query needs them
+	    users (TYPE): Description
+	"""
+
+	__slots__ = ("users", "log", "errors", "steps", "timeline", "__weakref__")
+	
+	def __init__(self, user_id_1, user_id_2, event_sourced=False, errors=ERRORS_PRINT, retention=None):
 		"""
-		Updates private data of user_id. Can be in any state including end state. Update is only visible in
-		history of User with user_id. Preserves current private info unless explicitly overridden with key->val pair.
+		Initialise the Haggler. Two Users are created and attached to the Haggler
+		instance.
 		
 		Args:
-		    user_id (string): user id of user performing the action
-		    private_info (dict): private_info meta data
+		    user_id_1 (string): id of first User to be created
+		    user_id_2 (string): id of second User to be created
+		    event_sourced (bool): store history as a single EventLog shared by both Users
+		    errors (string): errors mode - "print", "return" or "raise"
+		    retention (HistoryRetention): policy the offer histories follow, or None
+		        to keep every version in memory
 		
 		Raises:
-		    ValueError: if the user ids supplied are not present in the Haggler.users dict
-		    AttributeError/TypeError: if private_info not a dict
+		    TypeError: If the user ids supplied are not str, exception is raised.
+		        Only printed in "print" mode.
+		    ValueError: if errors is not a known errors mode, or retention is given
+		        for an event sourced Haggler
 		"""
-		if user_id in self.users.keys():
-			# want to check if private_info is actually a dict
-			try:
-				private_info.keys()
-			except(AttributeError, TypeError) as error:
-				print(error)
-			else:
+		if errors not in ERROR_MODES:
+			raise ValueError("errors must be one of {0}, not {1!r}".format(ERROR_MODES, errors))
+		if retention is not None and event_sourced:
+			raise ValueError("an event sourced Haggler cannot have a HistoryRetention")
+		self.errors = errors
+		self.steps = bytearray()
+		self.timeline = None
+
+		# check ids are both strings
+
+		str_chk1 = isinstance(user_id_1, str)
+		str_chk2 = isinstance(user_id_2, str)
+
+		if str_chk1 and str_chk2:
 
-				# private data update one sided - no need for u2/other
-				u1 = self.users[user_id]
+			user_id_1 = sys.intern(user_id_1)
+			user_id_2 = sys.intern(user_id_2)
 
-				# dont care about endpoint or current state
+			# init each user
 
-				offer = copy.deepcopy(u1.current_offer)
-				offer.action = "UpdatePrivateData"
-				offer.user_action = user_id
+			user_1 = User(user_id_1)
+			user_2 = User(user_id_2)
 
-				u1.updatePrivateInfo(private_info)
+			self.log = None
+			if event_sourced:
+				self.log = EventLog(user_id_1, user_id_2)
+				user_1.offer_history = self.log.projection(user_id_1)
+				user_2.offer_history = self.log.projection(user_id_2)
+			elif retention is not None:
+				user_1.offer_history = retention.history(user_id_1)
+				user_2.offer_history = retention.history(user_id_2)
 
-				u1.addOfferHistory(offer)
-				return
+			self.users = {
+				user_id_1: user_1,
+				user_id_2: user_2,
+			}
 		else:
+			if errors != ERRORS_PRINT:
+				raise TypeError("User IDs must be type string")
 			try:
-				raise ValueError("Error: {0} is not a valid user in this Haggler.".format(user_id))
-			except ValueError as error:
+				raise TypeError("User IDs must be type string")
+			except TypeError as error:
 				print(error)
 			return
 
-	def printHistory(self, user_id):
+
+	def can(self, user_id, action):
 		"""
-		Prints offer history for user_id in vaguely formatted table. 
-		Full price is printed == price * quantity
+		Checks whether user_id can take action now, without taking it.
 		
 		Args:
-		    user_id (string): user id of user whose offer history is being tabulated
+		    user_id (string): user id of user who would perform the action
+		    action (string/int): action name ("Accept"), method name ("accept") or ACTION_* code
 		
-		Raises:
-		    ValueError: if the user id supplied is not present in the Haggler.users dict
+		Returns:
+		    bool: True if the action would be accepted by the transition table
 		"""
-		if user_id in self.users.keys():
-			# private data update one sided - no need for u2/other
-			u1 = self.users[user_id]
-
-			table_text = "{0:>10}{1:>20}{2:>15}{3:>24}{4:>10}{5:>15}{6:>15}{7:>15}" \
-			              .format("Version","Action","User ID","State","Product","Buyer","Seller","Full Price")
-			table_text += "\n"
-
-			for o in u1.offer_history:
-				line_text = []
-				line_text.append("{0:>10}".format(str(o.version)))
-				line_text.append("{0:>20}".format(o.action))
-				line_text.append("{0:>15}".format(o.user_action))
-				line_text.append("{0:>24}".format(o.state))
-				line_text.append("{0:>10}".format(o.product))
-				line_text.append("{0:>15}".format(o.buyer))
-				line_text.append("{0:>15}".format(o.seller))
-				full_price = o.quantity * o.price
-				line_text.append("{0:>15}".format(str(full_price)))
-
-				table_text += "".join(line_text) + "\n"
-
-			print(table_text)
-			return
-		else:
-			try:
-				raise ValueError("Error: {0} is not a valid user in this Haggler.".format(user_id))
-			except ValueError as error:
-				print(error)
-			return
+		u1 = self.users.get(user_id)
+		if u1 is None:
+			return False
+		if not isinstance(action, int):
+			action = ACTION_CODES[action]
+		return TRANSITIONS[action][u1.state_code] is not None
 
-	def printVersion(self, user_id, version):
+	def submit(self, user_id, other_id, offer):
+		"""
+		Submits the first offer. This establishes who the seller and buyer are and their
+		relationship to each other, what the first offer is etc.
+		
+		Args:
+		    user_id (string): user id of user performing the action
+		    other_id (string): user id of recipient of action
+		    offer (Offer): Offer instance containing info on current offer
+		
+		Returns:
+		    int: RESULT_* code, RESULT_OK if the action was taken
+		
+		Raises:
+		    ValueError: if the user ids supplied are not present in the Haggler.users dict
+		"""
+		result = self._submit(user_id, other_id, offer)
+		if result:
+			return self._reject(result, ACTION_SUBMIT, user_id, other_id)
+		return result
+
+	def accept(self, user_id):
+		"""
+		Accepts the current offer. user_id must be in state "AwaitingMyAcceptance".
+		Results in an end state.
+		
+		Args:
+		    user_id (string): user id of user performing the action
+		
+		Returns:
+		    int: RESULT_* code, RESULT_OK if the action was taken
+		
+		Raises:
+		    ValueError: if the user id supplied is not present in the Haggler.users dict
+		"""
+		result = self._transition(ACTION_ACCEPT, user_id)
+		if result:
+			return self._reject(result, ACTION_ACCEPT, user_id)
+		return result
+
+	def cancel(self, user_id):
+		"""
+		Cancels the current offer. user_id can be in any state that isn't an end state.
+		Results in an end state.
+		
+		Args:
+		    user_id (string): user id of user performing the action
+		
+		Returns:
+		    int: RESULT_* code, RESULT_OK if the action was taken
+		
+		Raises:
+		    ValueError: if the user id supplied is not present in the Haggler.users dict
+		"""
+		result = self._transition(ACTION_CANCEL, user_id)
+		if result:
+			return self._reject(result, ACTION_CANCEL, user_id)
+		return result
+
+	def withdraw(self, user_id):
+		"""
+		Withdraws the current offer. user_id must be in "AwaitingTheirAcceptance" state.
+		
+		Args:
+		    user_id (string): user id of user performing the action
+		
+		Returns:
+		    int: RESULT_* code, RESULT_OK if the action was taken
+		
+		Raises:
+		    ValueError: if the user id supplied is not present in the Haggler.users dict
+		"""
+		result = self._transition(ACTION_WITHDRAW, user_id)
+		if result:
+			return self._reject(result, ACTION_WITHDRAW, user_id)
+		return result
+
+	def proposeUpdate(self, user_id, offer):
+		"""
+		Proposes an update to the offer. user_id must be in "WithdrawnByMe" or "AwaitingMyAcceptance"
+		state.
+		
+		Args:
+		    user_id (string): user id of user performing the action
+		    offer (Offer): new Offer instance containing info on updated offer
+		
+		Returns:
+		    int: RESULT_* code, RESULT_OK if the action was taken
+		
+		Raises:
+		    ValueError: if the user ids supplied are not present in the Haggler.users dict
+		"""
+		result = self._transition(ACTION_PROPOSE_UPDATE, user_id, offer)
+		if result:
+			return self._reject(result, ACTION_PROPOSE_UPDATE, user_id)
+		return result
+
+	def updatePrivateData(self, user_id, private_info):
+		"""
+		Updates private data of user_id. Can be in any state including end state. Update is only visible in
+		history of User with user_id. Preserves current private info unless explicitly overridden with key->val pair.
+		
+		Args:
+		    user_id (string): user id of user performing the action
+		    private_info (dict): private_info meta data
+		
+		Returns:
+		    int: RESULT_* code, RESULT_OK if the action was taken
+		
+		Raises:
+		    ValueError: if the user ids supplied are not present in the Haggler.users dict
+		    AttributeError/TypeError: if private_info not a dict
+		"""
+		result = self._updatePrivateData(user_id, private_info)
+		if result:
+			return self._reject(result, ACTION_UPDATE_PRIVATE_DATA, user_id, private_info=private_info)
+		return result
+
+	def _apply(self, action, user_id, payload):
+		"""
+		Takes action with a single payload argument, as HagglerPool.applyBatch does.
+		
+		Args:
+		    action (int): ACTION_* code
+		    user_id (string): user id of user performing the action
+		    payload: (other_id, offer) for Submit, offer for ProposeUpdate,
+		        private_info for UpdatePrivateData, otherwise ignored
+		
+		Returns:
+		    int: RESULT_* code
+		"""
+		if action == ACTION_SUBMIT:
+			return self._submit(user_id, payload[0], payload[1])
+		if action == ACTION_UPDATE_PRIVATE_DATA:
+			return self._updatePrivateData(user_id, payload)
+		if action == ACTION_PROPOSE_UPDATE:
+			return self._transition(action, user_id, payload)
+		return self._transition(action, user_id)
+
+	def _submit(self, user_id, other_id, offer):
+		users = self.users
+		if user_id not in users or other_id not in users:
+			return RESULT_UNKNOWN_USER
+
+		seller = users[user_id]
+		buyer = users[other_id]
+
+		transition = TRANSITIONS[ACTION_SUBMIT][seller.state_code]
+		if transition is None:
+			return RESULT_ENDED if seller.end else RESULT_INVALID_STATE
+
+		# set up relationship for other actions
+		seller.setOther(buyer)
+		buyer.setOther(seller)
+
+		# add info to offer
+		offer = offer.replace(
+			action="Submit",
+			user_action=seller.user_id,
+			seller=seller.user_id,
+			buyer=buyer.user_id,
+		)
+
+		# update roles and states
+		seller.setRole("seller")
+		seller.setState(transition[0])
+
+		buyer.setRole("buyer")
+		buyer.setState(transition[1])
+
+		# add the offer to respective histories
+		seller.addOfferHistory(offer)
+		buyer.addOfferHistory(offer)
+		self.steps.append(_STEP_BOTH)
+		return RESULT_OK
+
+	def _transition(self, action, user_id, offer=None):
+		"""
+		Takes one of the two sided actions after Submit (ProposeUpdate, Withdraw,
+		Accept, Cancel) as laid out in TRANSITIONS.
+		
+		Args:
+		    action (int): ACTION_* code
+		    user_id (string): user id of user performing the action
+		    offer (Offer): new offer for ProposeUpdate, otherwise the current offer is used
+		
+		Returns:
+		    int: RESULT_* code
+		"""
+		u1 = self.users.get(user_id)
+		if u1 is None:
+			return RESULT_UNKNOWN_USER
+
+		transition = TRANSITIONS[action][u1.state_code]
+		if transition is None:
+			return RESULT_ENDED if u1.end else RESULT_INVALID_STATE
+
+		u2 = u1.other
+		current = u1.current_offer
+		if offer is None:
+			offer = current.replace(action=ACTIONS[action], user_action=u1.user_id)
+		else:
+			offer = offer.replace(
+				action=ACTIONS[action],
+				user_action=u1.user_id,
+				seller=current.seller,
+				buyer=current.buyer,
+			)
+
+		# update states
+		my_state, their_state, ends = transition
+		u1.setState(my_state)
+		u2.setState(their_state)
+
+		if ends:
+			u1.setEnd()
+			u2.setEnd()
+
+		# add the offer to respective histories
+		u1.addOfferHistory(offer)
+		u2.addOfferHistory(offer)
+		self.steps.append(_STEP_BOTH)
+		return RESULT_OK
+
+	def _updatePrivateData(self, user_id, private_info):
+		# private data update one sided - no need for u2/other
+		u1 = self.users.get(user_id)
+		if u1 is None:
+			return RESULT_UNKNOWN_USER
+
+		# want to check if private_info is actually a dict
+		if not hasattr(private_info, "keys"):
+			return RESULT_INVALID_PRIVATE_INFO
+
+		# dont care about endpoint or current state, but there must be an offer to update
+		if TRANSITIONS[ACTION_UPDATE_PRIVATE_DATA][u1.state_code] is None:
+			return RESULT_INVALID_STATE
+
+		offer = u1.current_offer.replace(action="UpdatePrivateData", user_action=u1.user_id)
+
+		u1.updatePrivateInfo(private_info)
+
+		u1.addOfferHistory(offer)
+		self.steps.append(_STEP_FIRST if next(iter(self.users.values())) is u1 else _STEP_SECOND)
+		return RESULT_OK
+
+	def _reject(self, result, action, user_id, other_id=None, private_info=None):
+		"""
+		Counts an action that was rejected with result code result and reports
+		it according to the errors mode.
+		
+		Args:
+		    result (int): RESULT_* code returned by the action
+		    action (int): ACTION_* code of the action
+		    user_id (string): user id of user performing the action
+		    other_id (string): user id of recipient of a Submit
+		    private_info: private_info passed to UpdatePrivateData
+		
+		Returns:
+		    int: result
+		"""
+		rejections.add(action, result)
+		if self.errors == ERRORS_RETURN:
+			return result
+
+		if result == RESULT_UNKNOWN_USER:
+			if other_id is None:
+				return self._error(result, "Error: {0} is not a valid user in this Haggler.", user_id)
+			return self._error(result, "Error: {0} or {1} is not a valid user in this Haggler.", user_id, other_id)
+		if result == RESULT_ENDED:
+			return self._error(result, "Offer has been {0} - no more actions possible.", self.users[user_id].state)
+		if result == RESULT_INVALID_STATE:
+			return self._error(result, "Error: State {0} invalid for {1} by {2}.", self.users[user_id].state, ACTIONS[action], user_id)
+		if result == RESULT_INVALID_PRIVATE_INFO:
+			return self._error(result, "Error: private_info must be a dict, not {0}.", type(private_info).__name__)
+		return self._error(result, "Error: {0} by {1} failed ({2}).", ACTIONS[action], user_id, RESULT_NAMES[result])
+
+	def _error(self, result, message, *args):
+		"""
+		Reports an error according to the errors mode of this Haggler, see _reportError.
+		"""
+		return _reportError(self.errors, result, message, *args)
+
+	def printHistory(self, user_id):
+		"""
+		Prints offer history for user_id in vaguely formatted table. 
+		Full price is printed == price * quantity
+		
+		The table is written to stdout a chunk of rows at a time, see exportHistory.
+		
+		Args:
+		    user_id (string): user id of user whose offer history is being tabulated
+		
+		Raises:
+		    ValueError: if the user id supplied is not present in the Haggler.users dict
+		"""
+		if self.exportHistory(sys.stdout, user_id) is not None:
+			sys.stdout.write("\n")
+
+	def iterHistory(self, user_id, format=EXPORT_TABLE, header=True):
+		"""
+		Returns an iterator over the lines of the offer history of user_id in an
+		export format. Versions are formatted as they are reached, so memory use does
+		not grow with the length of the history.
+		
+		Args:
+		    user_id (string): user id of user whose offer history is being exported
+		    format (string): one of EXPORT_FORMATS
+		    header (bool): start with the table or CSV header line
+		
+		Returns:
+		    iterator: lines ending in a newline, or None if user_id is not in the Haggler
+		
+		Raises:
+		    ValueError: if format is not one of EXPORT_FORMATS
+		"""
+		_exportFormatter(format)
+		user = self.users.get(user_id)
+		if user is None:
+			self._error(RESULT_UNKNOWN_USER, "Error: {0} is not a valid user in this Haggler.", user_id)
+			return None
+		return _historyLines(user.offer_history, format, header)
+
+	def exportHistory(self, file, user_id, format=EXPORT_TABLE, header=True):
+		"""
+		Writes the offer history of user_id to a file-like object in an export format,
+		see iterHistory. The table format is the printHistory layout.
+		
+		Args:
+		    file (file-like): text stream with a write method
+		    user_id (string): user id of user whose offer history is being exported
+		    format (string): one of EXPORT_FORMATS
+		    header (bool): start with the table or CSV header line
+		
+		Returns:
+		    int: number of versions written, or None if user_id is not in the Haggler
+		
+		Raises:
+		    ValueError: if format is not one of EXPORT_FORMATS
+		"""
+		lines = self.iterHistory(user_id, format, header)
+		if lines is None:
+			return None
+		_writeLines(file, lines)
+		return len(self.users[user_id].offer_history)
+
+	def historyArrays(self, user_ids=None):
+		"""
+		Returns the offer histories of this Haggler as NumPy arrays, see HistoryArrays.
+		Needs NumPy.
+		
+		Args:
+		    user_ids (iterable): users to include, None for both
+		
+		Returns:
+		    HistoryArrays: the versions, with None as the negotiation id
+		
+		Raises:
+		    ImportError: if NumPy is not installed
+		"""
+		return _historyArrays([(None, self)], user_ids)
+
+	def printVersion(self, user_id, version):
 		"""
 		Prints offer version from offer history for user_id as a YAML formatted object. 
 		
@@ -582,16 +2124,10 @@ class Haggler:
 				u1.offer_history[version-1].pretty()
 				return
 			else:
-				try:
-					raise ValueError("Error: Version {0} not in {1} order history.".format(version, user_id))
-				except ValueError as error:
-					print(error)
+				self._error(RESULT_UNKNOWN_VERSION, "Error: Version {0} not in {1} order history.", version, user_id)
 				return
 		else:
-			try:
-				raise ValueError("Error: {0} is not a valid user in this Haggler.".format(user_id))
-			except ValueError as error:
-				print(error)
+			self._error(RESULT_UNKNOWN_USER, "Error: {0} is not a valid user in this Haggler.", user_id)
 			return
 
 	def returnVersion(self, user_id, version):
@@ -617,17 +2153,12 @@ class Haggler:
 			if(version <= len(u1.offer_history) and version > 0):
 				return(u1.offer_history[version-1])
 			else:
-				print("Error: Version {0} not in {1} order history.".format(version, user_id))
-				try:
-					raise ValueError("Error: Version {0} not in {1} order history.".format(version, user_id))
-				except ValueError as error:
-					print(error)
+				if self.errors == ERRORS_PRINT:
+					print("Error: Version {0} not in {1} order history.".format(version, user_id))
+				self._error(RESULT_UNKNOWN_VERSION, "Error: Version {0} not in {1} order history.", version, user_id)
 				return
 		else:
-			try:
-				raise ValueError("Error: {0} is not a valid user in this Haggler.".format(user_id))
-			except ValueError as error:
-				print(error)
+			self._error(RESULT_UNKNOWN_USER, "Error: {0} is not a valid user in this Haggler.", user_id)
 			return
 
 	def versionDifferences(self, user_id, v1, v2):
@@ -636,6 +2167,9 @@ class Haggler:
 		v1 and v2 are version numbers. For each attribute where a difference is found a list
 		with two values is returned. First value is v1 value, second value is v2 value.
 		
+		Uses the User's DeltaIndex, so only attributes that changed somewhere between
+		v1 and v2 are compared, however far apart they are.
+		
 		Args:
 		    user_id (string): user_id of user whose offer history is being queried
 		    v1 (int): comparing differences from version v1... 
@@ -658,28 +2192,4228 @@ class Haggler:
 				if(v1 == v2):
 					return({})
 
-				v1_offer = vars(u1.offer_history[v1-1])
-				v2_offer = vars(u1.offer_history[v2-1])
-
-				#
-				diffs = {}
-				for k in v1_offer.keys():
-					if(v1_offer[k] != v2_offer[k]):
-						diffs[k]=[v1_offer[k], v2_offer[k]]
-
-				return(diffs)
+				# only the attributes the delta index has changing between v1 and v2 are compared
+				return(_deltaIndex(u1).differences(u1.offer_history, v1, v2))
 			else:
-				try:
-					raise ValueError("Error: Version {0} or {1} not in {2} order history.".format(v1, v2, user_id))
-				except ValueError as error:
-					print(error)
+				self._error(RESULT_UNKNOWN_VERSION, "Error: Version {0} or {1} not in {2} order history.", v1, v2, user_id)
 				return({})
 		else:
-			try:
-				raise ValueError("Error: {0} is not a valid user in this Haggler.".format(user_id))
-			except ValueError as error:
-				print(error)
+			self._error(RESULT_UNKNOWN_USER, "Error: {0} is not a valid user in this Haggler.", user_id)
 			return({})
 
+	def consecutiveDifferences(self, user_id):
+		"""
+		Returns versionDifferences between every version of the offer history of user_id
+		and the next, in one pass.
+		
+		Args:
+		    user_id (string): user_id of user whose offer history is being queried
+		
+		Returns:
+		    list: dicts as returned by versionDifferences, item i for versions i + 1 and
+		        i + 2 - empty if user_id is not in the Haggler
+		"""
+		user = self.users.get(user_id)
+		if user is None:
+			self._error(RESULT_UNKNOWN_USER, "Error: {0} is not a valid user in this Haggler.", user_id)
+			return []
+		return _deltaIndex(user).consecutive(user.offer_history)
+
+	def historySince(self, user_id, cursor=0):
+		"""
+		Returns the versions appended to the offer history of user_id since cursor,
+		and the cursor to pass next time. A cursor is the number of versions already
+		seen, so 0 gives the whole history. Only the new versions are read, so polling
+		costs O(new versions) rather than O(history length).
+		
+		Args:
+		    user_id (string): user id of user whose offer history is being queried
+		    cursor (int): cursor returned by the previous call, or 0
+		
+		Returns:
+		    tuple: (list of the Offers with version > cursor, new cursor), or ([], cursor)
+		        if user_id is not in the Haggler or cursor is past the end of the history
+		"""
+		user = self.users.get(user_id)
+		if user is None:
+			self._error(RESULT_UNKNOWN_USER, "Error: {0} is not a valid user in this Haggler.", user_id)
+			return [], cursor
+		history = user.offer_history
+		length = len(history)
+		if cursor < 0 or cursor > length:
+			self._error(RESULT_UNKNOWN_VERSION, "Error: Version {0} not in {1} order history.", cursor, user_id)
+			return [], cursor
+		return [history[i] for i in range(cursor, length)], length
+
+	def _timeline(self):
+		"""
+		Returns the _Timeline of this Haggler, brought up to date with steps.
+		"""
+		timeline = self.timeline
+		if timeline is None or timeline.steps is not self.steps:
+			steps = self.steps
+			lengths = [len(user.offer_history) for user in self.users.values()]
+			if lengths != [len(steps) - steps.count(_STEP_SECOND), len(steps) - steps.count(_STEP_FIRST)]:
+				# Hagglers made without their steps
+				steps = self.steps = _reconstructSteps(self.users)
+			timeline = self.timeline = _Timeline(steps)
+		timeline.extend()
+		return timeline
+
+	def _stepCount(self, timeline):
+		return len(timeline.steps)
+
+	def versionsAt(self, step):
+		"""
+		Returns how many versions each User had after the first step actions.
+		
+		Args:
+		    step (int): number of actions, from 0 up to the number taken so far
+		
+		Returns:
+		    dict: user id -> number of versions, {} if step is out of range
+		"""
+		timeline = self._timeline()
+		if not 0 <= step <= self._stepCount(timeline):
+			self._error(RESULT_UNKNOWN_VERSION, "Error: Step {0} not in the history of this Haggler.", step)
+			return {}
+		return dict(zip(self.users, timeline.versionsAt(step)))
+
+	def jointState(self, step):
+		"""
+		Returns what both Users had after the first step actions - the latest version
+		in the offer history of each. Found from the checkpoint before step, so the
+		cost does not grow with the length of the histories.
+		
+		Args:
+		    step (int): number of actions, from 0 up to the number taken so far
+		
+		Returns:
+		    dict: user id -> Offer, None for a User without a version yet, or {} if
+		        step is out of range
+		"""
+		versions = self.versionsAt(step)
+		return {user_id: self.users[user_id].offer_history[n - 1] if n else None for user_id, n in versions.items()}
+
+	def stepOf(self, user_id, version):
+		"""
+		Returns the step (1 for the first action) that added version to the offer
+		history of user_id. jointState(stepOf(user_id, version)) is what both Users
+		had at that version.
+		
+		Args:
+		    user_id (string): user id of user whose offer history is being queried
+		    version (int): the version number
+		
+		Returns:
+		    int: the step, or None if user_id or version is unknown
+		"""
+		if user_id not in self.users:
+			self._error(RESULT_UNKNOWN_USER, "Error: {0} is not a valid user in this Haggler.", user_id)
+			return None
+		if not 0 < version < self.users[user_id].curr_version:
+			self._error(RESULT_UNKNOWN_VERSION, "Error: Version {0} not in {1} order history.", version, user_id)
+			return None
+		slot = 0 if next(iter(self.users)) == user_id else 1
+		return self._timeline().stepOf(slot, version)
+
+	def mapVersion(self, user_id, version):
+		"""
+		Maps a version number of user_id to the version number the other User was on
+		when it was added.
+		
+		Args:
+		    user_id (string): user id of user whose version is being mapped
+		    version (int): the version number
+		
+		Returns:
+		    int: version of the other User, 0 if it had none yet, or None if user_id or
+		        version is unknown
+		"""
+		step = self.stepOf(user_id, version)
+		if step is None:
+			return None
+		for other_id, n in self.versionsAt(step).items():
+			if other_id != user_id:
+				return n
+
+
+class _Line:
+
+	"""
+	File-like object whose write returns what it is given, so csv.writer.writerow
+	returns the formatted row instead of buffering it.
+	"""
+
+	@staticmethod
+	def write(line):
+		return line
+
+
+def _tableLines(history, header, key):
+	if header:
+		yield _TABLE_HEADER
+	row = _TABLE_ROW.format
+	for o in history:
+		yield row(str(o.version), o.action, o.user_action, o.state, o.product,
+			o.buyer, o.seller, str(o.quantity * o.price))
+
+
+def _privateInfoJson(history):
+	"""
+	Generator of (offer fields, private_info as JSON) for the versions of history.
+	Consecutive versions usually share their PrivateInfo, so it is only encoded again
+	when it changes.
+	"""
+	fields = _EXPORT_FIELDS
+	encode = _JSON_ENCODE
+	last = encoded = None
+	for o in history:
+		values = fields(o)
+		private_info = values[-1]
+		if encoded is None or private_info is not last:
+			last = private_info
+			encoded = encode(None if private_info is None else dict(private_info))
+		yield values, encoded
+
+
+def _csvLines(history, header, key):
+	writerow = csv.writer(_Line(), lineterminator="\n").writerow
+	if header:
+		yield writerow(tuple(name for name, value in key) + EXPORT_FIELDS)
+	key = tuple(value for name, value in key)
+	for values, private_info in _privateInfoJson(history):
+		yield writerow(key + values[:-1] + ("" if private_info == "null" else private_info,))
+
+
+def _jsonlLines(history, header, key):
+	names = tuple(name for name, value in key) + EXPORT_FIELDS[:-1]
+	key = tuple(value for name, value in key)
+	encode = _JSON_ENCODE
+	for values, private_info in _privateInfoJson(history):
+		# private_info is the last field - splice in its cached encoding
+		yield "".join((encode(dict(zip(names, key + values[:-1])))[:-1], ', "private_info": ', private_info, "}\n"))
+
+
+_EXPORT_FORMATTERS = {EXPORT_TABLE: _tableLines, EXPORT_CSV: _csvLines, EXPORT_JSONL: _jsonlLines}
+
+
+def _exportFormatter(format):
+	formatter = _EXPORT_FORMATTERS.get(format)
+	if formatter is None:
+		raise ValueError("format must be one of {0}, not {1!r}".format(EXPORT_FORMATS, format))
+	return formatter
+
+
+def _historyLines(history, format, header, key=()):
+	"""
+	Generator of the export lines of one offer history. key holds (name, value) pairs
+	of leading fields for the CSV and JSONL rows, e.g. the negotiation id.
+	"""
+	return _exportFormatter(format)(history, header, key)
+
+
+def _writeLines(file, lines):
+	"""
+	Writes lines to file, joining up to _EXPORT_CHUNK of them per write call.
+	
+	Returns:
+	    int: number of lines written
+	"""
+	write = file.write
+	chunk = []
+	count = 0
+	for line in lines:
+		chunk.append(line)
+		if len(chunk) == _EXPORT_CHUNK:
+			write("".join(chunk))
+			count += len(chunk)
+			chunk.clear()
+	if chunk:
+		write("".join(chunk))
+		count += len(chunk)
+	return count
+
+
+def _numpy():
+	"""
+	Imports NumPy, which only the history arrays need.
+	
+	Raises:
+	    ImportError: if NumPy is not installed
+	"""
+	try:
+		import numpy
+	except ImportError:
+		raise ImportError("numpy is needed for history arrays (pip install numpy)") from None
+	return numpy
+
+
+class _Codes(dict):
+
+	"""
+	value -> code dict that gives each new value the next code, so codes can be
+	looked up with map(codes.__getitem__, values).
+	"""
+
+	def __missing__(self, value):
+		code = self[value] = len(self)
+		return code
+
+
+def _historyArrays(hagglers, user_ids=None):
+	"""
+	Builds HistoryArrays from (negotiation_id, Haggler) pairs. Each field of a
+	history is read into a typed array column with map, which NumPy then reads
+	without converting each value.
+	
+	Args:
+	    hagglers (iterable): (negotiation_id, Haggler) pairs
+	    user_ids (iterable): users to include from each Haggler, None for both
+	
+	Returns:
+	    HistoryArrays: the versions of every history, in order
+	"""
+	numpy = _numpy()
+	negotiation_ids = []
+	users = _Codes()
+	products = _Codes()
+	columns = {name: array(_ARRAY_TYPECODES[dtype]) for name, dtype in HISTORY_ARRAY_FIELDS[:-1]}
+	negotiations, user_codes, slots = columns["negotiation"], columns["user"], columns["slot"]
+	fields = [
+		(columns["version"], _ARRAY_VALUES["version"], None),
+		(columns["action"], _ARRAY_VALUES["action"], ACTION_CODES.__getitem__),
+		(columns["state"], _ARRAY_VALUES["state"], STATE_CODES.__getitem__),
+		(columns["product"], _ARRAY_VALUES["product"], products.__getitem__),
+		(columns["price"], _ARRAY_VALUES["price"], None),
+		(columns["quantity"], _ARRAY_VALUES["quantity"], None),
+	]
+
+	for negotiation_id, haggler in hagglers:
+		negotiation = len(negotiation_ids)
+		negotiation_ids.append(negotiation_id)
+		for slot, (user_id, user) in enumerate(haggler.users.items()):
+			if user_ids is not None and user_id not in user_ids:
+				continue
+			history = user.offer_history
+			if type(history) is not list:
+				# event sourced and archived histories make their Offers on access
+				history = list(history)
+			count = len(history)
+			negotiations.extend(repeat(negotiation, count))
+			user_codes.extend(repeat(users[user_id], count))
+			slots.extend(repeat(slot, count))
+			for column, getter, code in fields:
+				values = map(getter, history)
+				column.extend(values if code is None else map(code, values))
+
+	offers = numpy.empty(len(columns["version"]), dtype=list(HISTORY_ARRAY_FIELDS))
+	for name, dtype in HISTORY_ARRAY_FIELDS[:-1]:
+		offers[name] = numpy.frombuffer(columns[name], dtype=dtype)
+	offers["full_price"] = offers["price"] * offers["quantity"]
+	return HistoryArrays(offers, negotiation_ids, list(users), list(products))
+
+
+class HistoryArrays:
+
+	"""
+	Offer histories as one NumPy structured array, with vectorised analytics over
+	them. Made by Haggler.historyArrays and HagglerPool.historyArrays.
+	
+	Rows are grouped by negotiation, then by user, in version order. Joint actions
+	are in the history of both Users, so the analytics of a negotiation use the
+	rows of its first User (slot 0).
+	
+	Attributes:
+	    offers (numpy.ndarray): a row of HISTORY_ARRAY_FIELDS per version
+	    negotiation_ids (list): negotiation ids, indexed by the negotiation field
+	    user_ids (list): user ids, indexed by the user field
+	    products (list): products, indexed by the product field
+	"""
+
+	def __init__(self, offers, negotiation_ids, user_ids, products):
+		self.offers = offers
+		self.negotiation_ids = negotiation_ids
+		self.user_ids = user_ids
+		self.products = products
+
+	def __len__(self):
+		return len(self.offers)
+
+	def _negotiationRows(self, actions=None):
+		"""
+		Returns a mask of the slot 0 rows, only those with an action in actions if given.
+		"""
+		offers = self.offers
+		mask = offers["slot"] == 0
+		if actions is not None:
+			action = offers["action"]
+			mask &= _numpy().logical_or.reduce([action == a for a in actions])
+		return mask
+
+	def concessions(self):
+		"""
+		Returns the concession of each offer made in a negotiation - how far its price
+		has come down from the opening (Submit) price, as a fraction of it.
+		
+		Returns:
+		    tuple: (round, concession) arrays, round 0 being the opening offer and each
+		        ProposeUpdate the next round
+		"""
+		numpy = _numpy()
+		mask = self._negotiationRows([ACTION_SUBMIT, ACTION_PROPOSE_UPDATE])
+		negotiations = self.offers["negotiation"][mask]
+		prices = self.offers["price"][mask]
+		# index of the first row of each run of rows from the same negotiation
+		positions = numpy.arange(len(prices))
+		starts = numpy.ones(len(prices), dtype=bool)
+		starts[1:] = negotiations[1:] != negotiations[:-1]
+		first = numpy.maximum.accumulate(numpy.where(starts, positions, 0))
+		opening = prices[first]
+		with numpy.errstate(divide="ignore", invalid="ignore"):
+			concession = numpy.where(opening != 0, (opening - prices) / opening, 0.0)
+		return positions - first, concession
+
+	def meanConcessionByRound(self):
+		"""
+		Returns the mean concession at each round, over the negotiations that got that
+		far. See concessions.
+		
+		Returns:
+		    numpy.ndarray: mean concession, indexed by round
+		"""
+		numpy = _numpy()
+		rounds, concession = self.concessions()
+		counts = numpy.bincount(rounds)
+		totals = numpy.bincount(rounds, weights=concession)
+		return totals / numpy.maximum(counts, 1)
+
+	def timeToAccept(self):
+		"""
+		Returns the version at which each accepted negotiation was accepted, in the
+		history of its first User.
+		
+		Returns:
+		    tuple: (negotiation, version) arrays, one entry per accepted negotiation
+		"""
+		mask = self._negotiationRows([ACTION_ACCEPT])
+		return self.offers["negotiation"][mask], self.offers["version"][mask]
+
+	def outcomesByProduct(self):
+		"""
+		Returns how negotiations for each product ended, by the product of their last
+		version.
+		
+		Returns:
+		    dict: product -> {"negotiations": count, "accepted": ratio, "cancelled": ratio}
+		"""
+		numpy = _numpy()
+		mask = self._negotiationRows()
+		negotiations = self.offers["negotiation"][mask]
+		if not len(negotiations):
+			return {}
+		# the last row of each negotiation
+		last = numpy.ones(len(negotiations), dtype=bool)
+		last[:-1] = negotiations[1:] != negotiations[:-1]
+		products = self.offers["product"][mask][last]
+		states = self.offers["state"][mask][last]
+
+		length = len(self.products)
+		totals = numpy.bincount(products, minlength=length)
+		accepted = numpy.bincount(products[states == STATE_ACCEPTED], minlength=length)
+		cancelled = numpy.bincount(products[states == STATE_CANCELLED], minlength=length)
+		return {
+			self.products[code]: {
+				"negotiations": int(totals[code]),
+				"accepted": float(accepted[code] / totals[code]),
+				"cancelled": float(cancelled[code] / totals[code]),
+			}
+			for code in numpy.flatnonzero(totals)
+		}
+
+
+class _HistoryView(Sequence):
+
+	"""
+	The first length versions of an offer history, which later actions never change.
+	Projections are read from the positions they have already synced, so reading
+	never writes to the projection.
+	"""
+
+	__slots__ = ("history", "length")
+
+	def __init__(self, history, length):
+		self.history = history
+		self.length = length
+
+	def __len__(self):
+		return self.length
+
+	def __getitem__(self, index):
+		if isinstance(index, slice):
+			return [self[i] for i in range(*index.indices(self.length))]
+		if index < 0:
+			index += self.length
+		if not 0 <= index < self.length:
+			raise IndexError("history index out of range")
+		history = self.history
+		if isinstance(history, _Projection):
+			return history._offer(history._positions[index], index + 1)
+		return history[index]
+
+
+class UserView:
+
+	"""
+	Copy of the state of a User at one point, see HagglerView. Not to be modified.
+	
+	Attributes:
+	    curr_version (int): count to keep track of current version for offer history
+	    current_offer (Offer): the most recent Offer created
+	    deltas (DeltaIndex): delta index shared with the User
+	    end (bool): whether offer has been accepted or cancelled
+	    offer_history (sequence): the versions up to this point
+	    other (UserView): view of the other user in the transaction
+	    private_info (PrivateInfo): private meta data
+	    role (string): is seller buyer or seller?
+	    state (string): state of this user
+	    state_code (int): STATE_* code of state
+	    user_id (string): id of this user
+	"""
+
+	__slots__ = ("user_id", "role", "state", "state_code", "offer_history", "private_info", "curr_version", "end", "current_offer", "other", "deltas")
+
+	def __init__(self, published):
+		(self.user_id, self.role, self.state, self.state_code, offer_history, self.private_info,
+			self.curr_version, self.end, self.current_offer, self.deltas, _) = published
+		self.offer_history = _HistoryView(offer_history, self.curr_version - 1)
+		self.other = None
+
+
+class HagglerView:
+
+	"""
+	Consistent read only view of a ThreadSafeHaggler between two actions. Has the
+	query methods of Haggler.
+	
+	Attributes:
+	    errors (string): errors mode of the Haggler
+	    users (dict): user id -> UserView
+	"""
+
+	__slots__ = ("users", "errors", "_haggler")
+
+	def __init__(self, errors, published, haggler):
+		"""
+		Args:
+		    errors (string): errors mode of the Haggler
+		    published (tuple): ThreadSafeHaggler.published
+		    haggler (ThreadSafeHaggler): the Haggler, whose steps and timeline are shared
+		"""
+		self.errors = errors
+		self._haggler = haggler
+		self.users = users = {}
+		for user in published:
+			users[user[0]] = UserView(user)
+		for user in published:
+			if user[-1] is not None:
+				users[user[0]].other = users[user[-1]]
+
+	_error = Haggler._error
+	printHistory = Haggler.printHistory
+	iterHistory = Haggler.iterHistory
+	exportHistory = Haggler.exportHistory
+	historyArrays = Haggler.historyArrays
+	printVersion = Haggler.printVersion
+	returnVersion = Haggler.returnVersion
+	versionDifferences = Haggler.versionDifferences
+	consecutiveDifferences = Haggler.consecutiveDifferences
+	historySince = Haggler.historySince
+	versionsAt = Haggler.versionsAt
+	jointState = Haggler.jointState
+	stepOf = Haggler.stepOf
+	mapVersion = Haggler.mapVersion
+
+	def _timeline(self):
+		# steps and histories only grow, so the Haggler's timeline serves every view.
+		# The Haggler extends it as it publishes, so it always covers this view
+		return self._haggler.timeline
+
+	def _stepCount(self, timeline):
+		# the step of the last version in this view - later steps are not visible
+		count = 0
+		for slot, user in enumerate(self.users.values()):
+			if user.curr_version > 1:
+				count = max(count, timeline.stepOf(slot, user.curr_version - 1))
+		return count
+
+
+class ThreadSafeHaggler(Haggler):
+
+	"""
+	Haggler that can be shared between threads.
+	
+	Each action holds the Haggler's lock while it updates both Users, then
+	publishes a tuple of the new state of both Users before releasing it.
+	Offers are immutable and histories only grow, so a history's length is all
+	that is needed to pin it. The query methods read the latest published state
+	through a HagglerView without taking the lock, so readers never wait for
+	writers and never see one User updated and the other not. Reading users
+	directly is not protected - use view for a consistent copy.
+	
+	Attributes:
+	    lock (threading.Lock): held by each action
+	    published (tuple): state of each User after the last action taken
+	"""
+
+	__slots__ = ("lock", "published")
+
+	def __init__(self, user_id_1, user_id_2, event_sourced=False, errors=ERRORS_PRINT, retention=None):
+		"""
+		See Haggler.__init__.
+		
+		Raises:
+		    ValueError: if retention is given - spilling moves versions that readers
+		        may be reading without the lock
+		"""
+		if retention is not None:
+			raise ValueError("a ThreadSafeHaggler cannot have a HistoryRetention")
+		Haggler.__init__(self, user_id_1, user_id_2, event_sourced, errors)
+		self.lock = threading.Lock()
+		if hasattr(self, "users"):
+			self._publish()
+
+	def _publish(self):
+		if self.log is not None:
+			# sync the projections here, under the lock, as readers never do
+			for user in self.users.values():
+				len(user.offer_history)
+		for user in self.users.values():
+			if user.deltas is None:
+				# made here so every view shares it
+				user.deltas = DeltaIndex()
+		# extended here, so readers never need the lock to bring it up to date
+		Haggler._timeline(self)
+		self.published = tuple([
+			(u.user_id, u.role, u.state, u.state_code, u.offer_history, u.private_info,
+				u.curr_version, u.end, u.current_offer, u.deltas, None if u.other is None else u.other.user_id)
+			for u in self.users.values()
+		])
+
+	@property
+	def view(self):
+		"""
+		HagglerView of the state after the last action taken.
+		"""
+		return HagglerView(self.errors, self.published, self)
+
+	def _submit(self, user_id, other_id, offer):
+		with self.lock:
+			result = Haggler._submit(self, user_id, other_id, offer)
+			if result == RESULT_OK:
+				self._publish()
+		return result
+
+	def _transition(self, action, user_id, offer=None):
+		with self.lock:
+			result = Haggler._transition(self, action, user_id, offer)
+			if result == RESULT_OK:
+				self._publish()
+		return result
+
+	def _updatePrivateData(self, user_id, private_info):
+		with self.lock:
+			result = Haggler._updatePrivateData(self, user_id, private_info)
+			if result == RESULT_OK:
+				self._publish()
+		return result
+
+	def printHistory(self, user_id):
+		return self.view.printHistory(user_id)
+
+	def iterHistory(self, user_id, format=EXPORT_TABLE, header=True):
+		return self.view.iterHistory(user_id, format, header)
+
+	def exportHistory(self, file, user_id, format=EXPORT_TABLE, header=True):
+		return self.view.exportHistory(file, user_id, format, header)
+
+	def historyArrays(self, user_ids=None):
+		return self.view.historyArrays(user_ids)
+
+	def printVersion(self, user_id, version):
+		return self.view.printVersion(user_id, version)
+
+	def returnVersion(self, user_id, version):
+		return self.view.returnVersion(user_id, version)
+
+	def versionDifferences(self, user_id, v1, v2):
+		return self.view.versionDifferences(user_id, v1, v2)
+
+	def consecutiveDifferences(self, user_id):
+		return self.view.consecutiveDifferences(user_id)
+
+	def versionsAt(self, step):
+		return self.view.versionsAt(step)
+
+	def jointState(self, step):
+		return self.view.jointState(step)
+
+	def stepOf(self, user_id, version):
+		return self.view.stepOf(user_id, version)
+
+	def mapVersion(self, user_id, version):
+		return self.view.mapVersion(user_id, version)
+
+	def historySince(self, user_id, cursor=0):
+		return self.view.historySince(user_id, cursor)
+
+
+# fsync policies for WriteAheadLog
+FSYNC_ALWAYS = "always" # fsync every record before the action returns
+FSYNC_BATCH = "batch"   # group commit - fsync once per group of records
+FSYNC_NEVER = "never"   # write groups to the file but leave syncing to the OS
+FSYNC_POLICIES = (FSYNC_ALWAYS, FSYNC_BATCH, FSYNC_NEVER)
+
+# WriteAheadLog record op for HagglerPool.create - actions use their ACTION_* code
+WAL_CREATE = -1
+
+_WAL_HEADER = struct.Struct("<II")
+
+
+class WriteAheadLog:
+
+	"""
+	WriteAheadLog Class - durable, append-only log of the actions taken in a HagglerPool.
+	
+	Each record is a (op, negotiation_id, user_id, payload) tuple where op is an ACTION_*
+	code, or WAL_CREATE for a new negotiation with payload (user_id_1, user_id_2). It is
+	stored pickled, after a header of its length and crc32 so a torn write at the end
+	of the file is detected and dropped on recovery.
+	
+	Records are group committed: they are buffered and written (and fsynced, depending
+	on the fsync policy) together once group_size records are waiting, or when an
+	append or tick() finds group_interval seconds have passed since the last commit.
+	FSYNC_ALWAYS commits every record.
+	
+	The log has no timer of its own, so with FSYNC_BATCH or FSYNC_NEVER a log that
+	goes quiet keeps its last group in the buffer until the next append, tick() or
+	commit(), and a crash loses everything buffered. Records are only lost within
+	about group_interval of being appended if something ticks the log that often:
+	AsyncHagglerPool commits on a timer of its event loop and HagglerPool.expire
+	ticks it, otherwise call tick() (or HagglerPool.flush) periodically.
+	
+	Attributes:
+	    fsync (string): fsync policy - FSYNC_ALWAYS, FSYNC_BATCH or FSYNC_NEVER
+	    group_interval (float): max seconds between commits while the log is ticked
+	    group_size (int): max records waiting in the buffer
+	    path (string): path of the log file
+	    records (int): number of records appended since opening
+	"""
+
+	def __init__(self, path, fsync=FSYNC_BATCH, group_size=256, group_interval=0.01):
+		"""
+		Opens the log at path for appending, creating it if needed. A torn or corrupt
+		tail left by a crash is truncated first.
+		
+		Args:
+		    path (string): path of the log file
+		    fsync (string): fsync policy - "always", "batch" or "never"
+		    group_size (int): max records per group commit
+		    group_interval (float): max seconds between group commits
+		
+		Raises:
+		    ValueError: if fsync is not an fsync policy
+		"""
+		if fsync not in FSYNC_POLICIES:
+			raise ValueError("fsync must be one of {0}, not {1!r}".format(FSYNC_POLICIES, fsync))
+
+		self.path = path
+		self.fsync = fsync
+		self.group_size = 1 if fsync == FSYNC_ALWAYS else group_size
+		self.group_interval = group_interval
+		self.records = 0
+		self._buffer = []
+		self._last_commit = time.monotonic()
+
+		end = 0
+		if os.path.exists(path):
+			for end, _ in WriteAheadLog._scan(path):
+				pass
+		self._file = open(path, "ab")
+		self._file.truncate(end)
+
+	@staticmethod
+	def _scan(path):
+		"""
+		Yields (end offset, record) for every intact record in the log at path,
+		stopping at the first torn or corrupt one.
+		"""
+		header_size = _WAL_HEADER.size
+		with open(path, "rb") as f:
+			data = f.read()
+		offset = 0
+		while offset + header_size <= len(data):
+			size, crc = _WAL_HEADER.unpack_from(data, offset)
+			start = offset + header_size
+			body = data[start:start + size]
+			if len(body) < size or zlib.crc32(body) != crc:
+				return
+			offset = start + size
+			yield offset, pickle.loads(body)
+
+	@staticmethod
+	def read(path):
+		"""
+		Yields the intact records of the log at path in order.
+		
+		Args:
+		    path (string): path of the log file
+		"""
+		for _, record in WriteAheadLog._scan(path):
+			yield record
+
+	def append(self, record):
+		"""
+		Adds a record to the log, committing the group if it is full or old enough.
+		
+		Args:
+		    record (tuple): (op, negotiation_id, user_id, payload)
+		"""
+		body = pickle.dumps(record, pickle.HIGHEST_PROTOCOL)
+		self._buffer.append(_WAL_HEADER.pack(len(body), zlib.crc32(body)))
+		self._buffer.append(body)
+		self.records += 1
+
+		if(len(self._buffer) >= 2 * self.group_size
+			or time.monotonic() - self._last_commit >= self.group_interval):
+			self.commit()
+
+	@property
+	def pending(self):
+		"""
+		Number of records buffered and not yet committed.
+		"""
+		return len(self._buffer) // 2
+
+	def tick(self):
+		"""
+		Commits the buffered records if group_interval seconds have passed since the
+		last commit. Call it periodically to bound how long a record stays buffered
+		when no more are appended.
+		"""
+		if self._buffer and time.monotonic() - self._last_commit >= self.group_interval:
+			self.commit()
+
+	def commit(self):
+		"""
+		Writes the buffered records to the file and fsyncs it unless the policy is FSYNC_NEVER.
+		"""
+		if self._buffer:
+			self._file.write(b"".join(self._buffer))
+			self._buffer.clear()
+			self._file.flush()
+			if self.fsync != FSYNC_NEVER:
+				os.fsync(self._file.fileno())
+		self._last_commit = time.monotonic()
+
+	def close(self):
+		"""
+		Commits anything buffered and closes the file.
+		"""
+		if not self._file.closed:
+			self.commit()
+			self._file.close()
+
+	def __enter__(self):
+		return self
+
+	def __exit__(self, *exc_info):
+		self.close()
+
+
+# HagglerPool snapshot file format - see HagglerPool.snapshot
+_SNAPSHOT_MAGIC = b"HAGS"
+_SNAPSHOT_VERSION = 2
+_SNAPSHOT_PREAMBLE = struct.Struct("<4sH")
+_SNAPSHOT_LENGTH = struct.Struct("<Q")
+# archived, event sourced, number of steps - the Haggler.steps bytes follow the offers
+_SNAPSHOT_NEGOTIATION = struct.Struct("<BBI")
+# user id, role, state, end, has other, curr_version, private_info, history length
+_SNAPSHOT_USER = struct.Struct("<IBBBBIII")
+# version, action, user_action, state, buyer, seller, product,
+# price kind, price, quantity kind, quantity, private_info
+_SNAPSHOT_OFFER = struct.Struct("<IBIBIIIBqBqI")
+_SNAPSHOT_ROLES = (None, "seller", "buyer")
+_SNAPSHOT_ROLE_CODES = {role: code for code, role in enumerate(_SNAPSHOT_ROLES)}
+# symbol indexes with this bit set point into the table of non string values
+_SNAPSHOT_VALUE_BIT = 1 << 31
+# kinds of stored price/quantity
+_NUMBER_INT = 0
+_NUMBER_FLOAT = 1
+_NUMBER_VALUE = 2
+_INT64 = struct.Struct("<q")
+_FLOAT64 = struct.Struct("<d")
+_INT64_MIN = -(1 << 63)
+_INT64_MAX = (1 << 63) - 1
+
+
+class _SnapshotWriter:
+
+	"""
+	Interns the strings and values of a HagglerPool snapshot and packs its records.
+	"""
+
+	def __init__(self):
+		self.symbols = {None: 0}
+		self.strings = [None]
+		self.values = []
+		self.private_infos = {}
+		self.private_info_objects = []
+		self.records = bytearray()
+
+	def symbol(self, value):
+		if value.__class__ is str or value is None:
+			index = self.symbols.get(value)
+			if index is None:
+				index = self.symbols[value] = len(self.strings)
+				self.strings.append(value)
+			return index
+		self.values.append(value)
+		return (len(self.values) - 1) | _SNAPSHOT_VALUE_BIT
+
+	def number(self, value):
+		if value.__class__ is int and _INT64_MIN <= value <= _INT64_MAX:
+			return _NUMBER_INT, value
+		if value.__class__ is float:
+			return _NUMBER_FLOAT, _INT64.unpack(_FLOAT64.pack(value))[0]
+		return _NUMBER_VALUE, self.symbol(value)
+
+	def privateInfo(self, private_info):
+		# versions share PrivateInfo objects, so each one is stored once
+		index = self.private_infos.get(id(private_info))
+		if index is None:
+			index = self.private_infos[id(private_info)] = len(self.private_info_objects)
+			self.private_info_objects.append(private_info)
+		return index
+
+	def haggler(self, haggler, archived):
+		users = list(haggler.users.values())
+		steps = _savedSteps(haggler)
+		self.records += _SNAPSHOT_NEGOTIATION.pack(archived, haggler.log is not None, len(steps))
+		histories = []
+		for user in users:
+			history = user.offer_history
+			histories.append(history)
+			self.records += _SNAPSHOT_USER.pack(
+				self.symbol(user.user_id),
+				_SNAPSHOT_ROLE_CODES[user.role],
+				user.state_code,
+				user.end,
+				user.other is not None,
+				user.curr_version,
+				self.privateInfo(user.private_info),
+				len(history),
+			)
+		symbol = self.symbol
+		number = self.number
+		private_info = self.privateInfo
+		pack = _SNAPSHOT_OFFER.pack
+		action_codes = ACTION_CODES
+		records = self.records
+		for history in histories:
+			for o in history:
+				price_kind, price = number(o.price)
+				quantity_kind, quantity = number(o.quantity)
+				records += pack(
+					o.version,
+					action_codes[o.action],
+					symbol(o.user_action),
+					STATE_CODES[o.state],
+					symbol(o.buyer),
+					symbol(o.seller),
+					symbol(o.product),
+					price_kind,
+					price,
+					quantity_kind,
+					quantity,
+					private_info(o.private_info),
+				)
+		records += steps
+
+	def write(self, f, header, negotiation_ids):
+		f.write(_SNAPSHOT_PREAMBLE.pack(_SNAPSHOT_MAGIC, _SNAPSHOT_VERSION))
+		private_infos = [dict(p.items()) for p in self.private_info_objects]
+		for table in (header, self.strings, self.values, negotiation_ids, private_infos):
+			data = pickle.dumps(table, pickle.HIGHEST_PROTOCOL)
+			f.write(_SNAPSHOT_LENGTH.pack(len(data)))
+			f.write(data)
+		f.write(_SNAPSHOT_LENGTH.pack(len(self.records)))
+		f.write(self.records)
+
+
+def _readSnapshotTable(data, offset):
+	size, = _SNAPSHOT_LENGTH.unpack_from(data, offset)
+	offset += _SNAPSHOT_LENGTH.size
+	return pickle.loads(data[offset:offset + size]), offset + size
+
+
+def _snapshotNumber(kind, value, values):
+	if kind == _NUMBER_INT:
+		return value
+	if kind == _NUMBER_FLOAT:
+		return _FLOAT64.unpack(_INT64.pack(value))[0]
+	return values[value]
+
+
+# ColumnarArchive file format - see ColumnarArchive
+_MAPPED_VERSION = 2
+# magic, version, byte order of the columns (0 little, 1 big), bytes used
+_MAPPED_HEADER = struct.Struct("<4sHBxQ")
+_MAPPED_BYTE_ORDER = 0 if sys.byteorder == "little" else 1
+_MAPPED_INITIAL_SIZE = 1 << 20
+# heap entry: kind, length of the data that follows
+_HEAP_ENTRY = struct.Struct("<BI")
+_HEAP_STR = 0
+_HEAP_PICKLE = 1
+# number of strings remembered for reuse before the table starts again
+_HEAP_INTERN_LIMIT = 1 << 16
+# block: length, negotiation id, number of steps - the Haggler.steps bytes end the block
+_ARCHIVE_BLOCK = struct.Struct("<QQQ")
+# user id, private_info, curr_version, history length, role, state, end, has other
+_ARCHIVE_USER = struct.Struct("<QQIIBBBB4x")
+# heap offset columns of each User, in order
+_ARCHIVE_REFS = ("user_action", "buyer", "seller", "product", "private_info")
+# bytes per version: 5 heap offsets, price and quantity, version, then
+# action, state, price kind and quantity kind codes
+_ARCHIVE_ROW_SIZE = 8 * 5 + 8 * 2 + 4 + 4
+
+
+class _MappedFile:
+
+	"""
+	Append only file accessed through a shared mmap, grown in doubling steps.
+	
+	Growing maps the file again rather than resizing the old map, so memoryviews
+	of earlier appends stay valid.
+	"""
+
+	def __init__(self, path, magic):
+		self.magic = magic
+		exists = os.path.exists(path) and os.path.getsize(path) >= _MAPPED_HEADER.size
+		self.file = open(path, "r+b" if exists else "w+b")
+		if not exists:
+			self.file.write(_MAPPED_HEADER.pack(magic, _MAPPED_VERSION, _MAPPED_BYTE_ORDER, _MAPPED_HEADER.size))
+			self.file.truncate(_MAPPED_INITIAL_SIZE)
+			self.file.flush()
+
+		self.map = mmap.mmap(self.file.fileno(), 0)
+		file_magic, version, byte_order, self.used = _MAPPED_HEADER.unpack_from(self.map, 0)
+		if file_magic != magic or version != _MAPPED_VERSION or byte_order != _MAPPED_BYTE_ORDER:
+			self.file.close()
+			raise ValueError("{0} is not a version {1} {2} file for this platform".format(path, _MAPPED_VERSION, magic.decode()))
+
+	def append(self, data):
+		"""
+		Appends data and returns the offset it was written at.
+		"""
+		offset = self.used
+		end = offset + len(data)
+		if end > len(self.map):
+			self.file.truncate(max(end, 2 * len(self.map)))
+			self.map = mmap.mmap(self.file.fileno(), 0)
+		self.map[offset:end] = data
+		self.used = end
+		_MAPPED_HEADER.pack_into(self.map, 0, self.magic, _MAPPED_VERSION, _MAPPED_BYTE_ORDER, end)
+		return offset
+
+	def close(self):
+		self.map.flush()
+		self.file.close()
+
+
+class ColumnarArchive(MutableMapping):
+
+	"""
+	Archive of finished negotiations kept in memory mapped files rather than as
+	Haggler objects. Use it as the archive of a HagglerPool:
+	
+	    pool = HagglerPool(archive=ColumnarArchive("deals.archive"))
+	
+	Storing a Haggler appends a block with the offer histories of both Users as
+	columns - version, action and state codes, price and quantity, and offsets into a
+	heap file (path + ".heap") of strings and pickled values - followed by its steps,
+	one byte each. Reading a negotiation
+	gives an ArchivedHaggler over the mapped columns, whose query methods decode
+	only the fields they need and build no Offer objects.
+	
+	Only the negotiation id -> block offset index is held in memory. Replacing or
+	deleting a negotiation does not reclaim its space in the file. Reopening the
+	files rebuilds the index.
+	
+	Attributes:
+	    blocks (_MappedFile): block file
+	    errors (string): errors mode of the ArchivedHagglers returned, None for that of
+	        the HagglerPool the archive is given to
+	    heap (_MappedFile): heap file
+	    index (dict): negotiation id -> offset of its block
+	"""
+
+	def __init__(self, path, errors=None):
+		"""
+		Opens the archive at path, creating it if it does not exist.
+		
+		Args:
+		    path (string): path of the block file
+		    errors (string): ERRORS_* mode of the ArchivedHagglers returned. If None,
+		        that of the HagglerPool the archive is given to, or ERRORS_PRINT.
+		
+		Raises:
+		    ValueError: if the files exist but are not archive files this version can read
+		"""
+		if errors is not None and errors not in ERROR_MODES:
+			raise ValueError("errors must be one of {0}, not {1!r}".format(ERROR_MODES, errors))
+		self.errors = errors
+		self.blocks = _MappedFile(path, b"HAGC")
+		self.heap = _MappedFile(path + ".heap", b"HAGH")
+		self._interned = {}
+		self.index = {}
+
+		blocks = self.blocks.map
+		offset = _MAPPED_HEADER.size
+		while offset < self.blocks.used:
+			length, negotiation_id, _ = _ARCHIVE_BLOCK.unpack_from(blocks, offset)
+			self.index[self.value(negotiation_id)] = offset
+			offset += length
+
+	def value(self, offset):
+		"""
+		Returns the value stored in the heap at offset, None for offset 0.
+		"""
+		if not offset:
+			return None
+		heap = self.heap.map
+		kind, length = _HEAP_ENTRY.unpack_from(heap, offset)
+		start = offset + _HEAP_ENTRY.size
+		if kind == _HEAP_STR:
+			return str(heap[start:start + length], "utf-8")
+		return pickle.loads(heap[start:start + length])
+
+	def _store(self, value):
+		if value is None:
+			return 0
+		if value.__class__ is str:
+			offset = self._interned.get(value)
+			if offset is None:
+				if len(self._interned) >= _HEAP_INTERN_LIMIT:
+					self._interned.clear()
+				data = value.encode("utf-8")
+				offset = self._interned[value] = self.heap.append(_HEAP_ENTRY.pack(_HEAP_STR, len(data)) + data)
+			return offset
+		data = pickle.dumps(value, pickle.HIGHEST_PROTOCOL)
+		return self.heap.append(_HEAP_ENTRY.pack(_HEAP_PICKLE, len(data)) + data)
+
+	def _number(self, value):
+		if value.__class__ is int and _INT64_MIN <= value <= _INT64_MAX:
+			return _NUMBER_INT, value
+		if value.__class__ is float:
+			return _NUMBER_FLOAT, _INT64.unpack(_FLOAT64.pack(value))[0]
+		return _NUMBER_VALUE, self._store(value)
+
+	def __setitem__(self, negotiation_id, haggler):
+		store = self._store
+		number = self._number
+		# versions share PrivateInfo objects, so each one is stored once. They are
+		# held until the end, as spilled versions are decoded as they are read and
+		# an id could otherwise be reused by a later PrivateInfo
+		private_infos = {}
+		held = []
+		users = []
+		columns = []
+		for user in haggler.users.values():
+			history = user.offer_history
+			n = len(history)
+			refs = array("Q", bytes(8 * 5 * n))
+			numbers = array("q", bytes(8 * 2 * n))
+			versions = array("I", bytes(4 * n))
+			codes = array("B", bytes(4 * n))
+			for row, o in enumerate(history):
+				private_info = o.private_info
+				private_info_offset = private_infos.get(id(private_info))
+				if private_info_offset is None:
+					private_info_offset = private_infos[id(private_info)] = store(private_info)
+					held.append(private_info)
+				refs[row] = store(o.user_action)
+				refs[n + row] = store(o.buyer)
+				refs[2 * n + row] = store(o.seller)
+				refs[3 * n + row] = store(o.product)
+				refs[4 * n + row] = private_info_offset
+				codes[2 * n + row], numbers[row] = number(o.price)
+				codes[3 * n + row], numbers[n + row] = number(o.quantity)
+				versions[row] = o.version
+				codes[row] = ACTION_CODES[o.action]
+				codes[n + row] = STATE_CODES[o.state]
+
+			users.append(_ARCHIVE_USER.pack(
+				store(user.user_id),
+				store(user.private_info),
+				user.curr_version,
+				n,
+				_SNAPSHOT_ROLE_CODES[user.role],
+				user.state_code,
+				user.end,
+				user.other is not None,
+			))
+			columns.append(refs.tobytes() + numbers.tobytes() + versions.tobytes() + codes.tobytes())
+
+		steps = _savedSteps(haggler)
+		body = b"".join(users) + b"".join(columns) + steps
+		length = _ARCHIVE_BLOCK.size + len(body)
+		self.index[negotiation_id] = self.blocks.append(_ARCHIVE_BLOCK.pack(length, store(negotiation_id), len(steps)) + body)
+
+	def __getitem__(self, negotiation_id):
+		return ArchivedHaggler(self, self.index[negotiation_id])
+
+	def __delitem__(self, negotiation_id):
+		del self.index[negotiation_id]
+
+	def __contains__(self, negotiation_id):
+		return negotiation_id in self.index
+
+	def __iter__(self):
+		return iter(self.index)
+
+	def __len__(self):
+		return len(self.index)
+
+	def close(self):
+		"""
+		Flushes and closes the files. ArchivedHagglers already returned stay readable.
+		"""
+		self.blocks.close()
+		self.heap.close()
+
+	def __enter__(self):
+		return self
+
+	def __exit__(self, *exc_info):
+		self.close()
+
+
+class ArchivedOffer:
+
+	"""
+	Read only view of one version in a ColumnarArchive. Has the attributes of an
+	Offer, each decoded from the mapped columns when it is read.
+	"""
+
+	__slots__ = ("_history", "_row")
+
+	def __init__(self, history, row):
+		self._history = history
+		self._row = row
+
+	def __getattr__(self, name):
+		return self._history.value(name, self._row)
+
+	@property
+	def __dict__(self):
+		return self.asdict()
+
+	def asdict(self):
+		"""
+		Returns the attributes of this version as a new dict, in Offer declaration order.
+		"""
+		value = self._history.value
+		return {name: value(name, self._row) for name in Offer.__slots__}
+
+	def offer(self):
+		"""
+		Returns this version as an Offer.
+		"""
+		offer = _new_offer(Offer)
+		offer.__setstate__(tuple(self.asdict().values()))
+		return offer
+
+	action_code = Offer.action_code
+	state_code = Offer.state_code
+	pretty = Offer.pretty
+
+
+class _ArchivedHistory(Sequence):
+
+	"""
+	Offer history of an ArchivedUser. Each column is a memoryview of the mapped block.
+	"""
+
+	__slots__ = ("archive", "user_id", "length", "refs", "numbers", "versions", "codes")
+
+	def __init__(self, archive, user_id, length, columns):
+		self.archive = archive
+		self.user_id = user_id
+		self.length = n = length
+		self.refs = columns[:40 * n].cast("Q")
+		self.numbers = columns[40 * n:56 * n].cast("q")
+		self.versions = columns[56 * n:60 * n].cast("I")
+		self.codes = columns[60 * n:64 * n]
+
+	def value(self, name, row):
+		"""
+		Decodes attribute name of the version at row.
+		"""
+		n = self.length
+		if name == "version":
+			return self.versions[row]
+		if name == "action":
+			return ACTIONS[self.codes[row]]
+		if name == "state":
+			return STATES[self.codes[n + row]]
+		if name == "price" or name == "quantity":
+			column = 0 if name == "price" else 1
+			kind = self.codes[(2 + column) * n + row]
+			number = self.numbers[column * n + row]
+			if kind == _NUMBER_FLOAT:
+				return _FLOAT64.unpack(_INT64.pack(number))[0]
+			if kind == _NUMBER_VALUE:
+				return self.archive.value(number)
+			return number
+		if name == "user_id":
+			return self.user_id
+		if name in _ARCHIVE_REFS:
+			return self.archive.value(self.refs[_ARCHIVE_REFS.index(name) * n + row])
+		raise AttributeError("ArchivedOffer has no attribute {0!r}".format(name))
+
+	def raw(self, name, row):
+		"""
+		Returns what is stored for attribute name at row without decoding it - equal
+		raw values mean equal attributes.
+		"""
+		n = self.length
+		if name == "version":
+			return self.versions[row]
+		if name == "action":
+			return self.codes[row]
+		if name == "state":
+			return self.codes[n + row]
+		if name == "price":
+			return self.codes[2 * n + row], self.numbers[row]
+		if name == "quantity":
+			return self.codes[3 * n + row], self.numbers[n + row]
+		if name == "user_id":
+			return 0
+		return self.refs[_ARCHIVE_REFS.index(name) * n + row]
+
+	def __len__(self):
+		return self.length
+
+	def __getitem__(self, row):
+		if isinstance(row, slice):
+			return [ArchivedOffer(self, i) for i in range(*row.indices(self.length))]
+		if row < 0:
+			row += self.length
+		if not 0 <= row < self.length:
+			raise IndexError("history index out of range")
+		return ArchivedOffer(self, row)
+
+
+class ArchivedUser:
+
+	"""
+	Read only User of an ArchivedHaggler.
+	
+	Attributes:
+	    curr_version (int): one more than the last version
+	    deltas (DeltaIndex): delta index of offer_history, None until a diff needs it
+	    end (bool): whether offer has been accepted or cancelled
+	    offer_history (sequence): ArchivedOffer views of the versions
+	    other (ArchivedUser): the other user in the transaction
+	    role (string): is seller buyer or seller?
+	    state (string): state of this user
+	    state_code (int): STATE_* code of state
+	    user_id (string): id of this user
+	"""
+
+	__slots__ = ("user_id", "role", "state", "state_code", "offer_history", "curr_version", "end", "other", "deltas", "_private_info")
+
+	@property
+	def private_info(self):
+		return self.offer_history.archive.value(self._private_info)
+
+	@property
+	def current_offer(self):
+		history = self.offer_history
+		return history[-1] if len(history) else None
+
+
+class ArchivedHaggler:
+
+	"""
+	Read only Haggler over a negotiation in a ColumnarArchive, returned by indexing
+	the archive. The query methods are those of Haggler. Actions are rejected with
+	RESULT_ENDED (or RESULT_UNKNOWN_USER), including UpdatePrivateData which a live
+	finished Haggler accepts.
+	
+	Attributes:
+	    errors (string): errors mode, from the archive (ERRORS_PRINT if it has none)
+	    users (dict): user id -> ArchivedUser
+	"""
+
+	__slots__ = ("users", "errors", "steps", "timeline")
+
+	def __init__(self, archive, offset):
+		self.errors = archive.errors or ERRORS_PRINT
+		self.users = {}
+		self.timeline = None
+		mapped = memoryview(archive.blocks.map)
+		step_count = _ARCHIVE_BLOCK.unpack_from(mapped, offset)[2]
+		offset += _ARCHIVE_BLOCK.size
+		fields = []
+		for _ in range(2):
+			fields.append(_ARCHIVE_USER.unpack_from(mapped, offset))
+			offset += _ARCHIVE_USER.size
+
+		users = []
+		for user_id, private_info, curr_version, n, role, state, end, has_other in fields:
+			user = ArchivedUser()
+			user.user_id = archive.value(user_id)
+			user.role = _SNAPSHOT_ROLES[role]
+			user.state = STATES[state]
+			user.state_code = state
+			user.curr_version = curr_version
+			user.end = bool(end)
+			user.other = None
+			user.deltas = None
+			user._private_info = private_info
+			user.offer_history = _ArchivedHistory(archive, user.user_id, n, mapped[offset:offset + n * _ARCHIVE_ROW_SIZE])
+			offset += n * _ARCHIVE_ROW_SIZE
+			self.users[user.user_id] = user
+			users.append(user)
+
+		if fields[0][7]:
+			users[0].other = users[1]
+		if fields[1][7]:
+			users[1].other = users[0]
+		self.steps = bytearray(mapped[offset:offset + step_count])
+
+	_error = Haggler._error
+	_reject = Haggler._reject
+	printHistory = Haggler.printHistory
+	iterHistory = Haggler.iterHistory
+	exportHistory = Haggler.exportHistory
+	historyArrays = Haggler.historyArrays
+	printVersion = Haggler.printVersion
+	returnVersion = Haggler.returnVersion
+	consecutiveDifferences = Haggler.consecutiveDifferences
+	historySince = Haggler.historySince
+	_timeline = Haggler._timeline
+	_stepCount = Haggler._stepCount
+	versionsAt = Haggler.versionsAt
+	jointState = Haggler.jointState
+	stepOf = Haggler.stepOf
+	mapVersion = Haggler.mapVersion
+
+	def can(self, user_id, action):
+		"""
+		Always False - archived negotiations take no actions.
+		"""
+		return False
+
+	def _check(self, user_id, other_id=None):
+		users = self.users
+		if user_id not in users or (other_id is not None and other_id not in users):
+			return RESULT_UNKNOWN_USER
+		return RESULT_ENDED
+
+	def _apply(self, action, user_id, payload):
+		"""
+		Haggler._apply for HagglerPool.applyBatch - returns the result code of the
+		rejection.
+		"""
+		return self._check(user_id, payload[0] if action == ACTION_SUBMIT else None)
+
+	def _readOnly(self, action, user_id, other_id=None):
+		return self._reject(self._check(user_id, other_id), action, user_id, other_id)
+
+	def submit(self, user_id, other_id, offer):
+		return self._readOnly(ACTION_SUBMIT, user_id, other_id)
+
+	def proposeUpdate(self, user_id, offer):
+		return self._readOnly(ACTION_PROPOSE_UPDATE, user_id)
+
+	def withdraw(self, user_id):
+		return self._readOnly(ACTION_WITHDRAW, user_id)
+
+	def accept(self, user_id):
+		return self._readOnly(ACTION_ACCEPT, user_id)
+
+	def cancel(self, user_id):
+		return self._readOnly(ACTION_CANCEL, user_id)
+
+	def updatePrivateData(self, user_id, private_info):
+		return self._readOnly(ACTION_UPDATE_PRIVATE_DATA, user_id)
+
+	def versionDifferences(self, user_id, v1, v2):
+		"""
+		Haggler.versionDifferences, comparing the stored columns and decoding only
+		the attributes that may differ.
+		"""
+		user = self.users.get(user_id)
+		if user is None:
+			self._error(RESULT_UNKNOWN_USER, "Error: {0} is not a valid user in this Haggler.", user_id)
+			return({})
+
+		history = user.offer_history
+		l_history = len(history)
+		if not (0 < v1 <= l_history and 0 < v2 <= l_history):
+			self._error(RESULT_UNKNOWN_VERSION, "Error: Version {0} or {1} not in {2} order history.", v1, v2, user_id)
+			return({})
+		if v1 == v2:
+			return({})
+
+		diffs = {}
+		raw = history.raw
+		value = history.value
+		for k in Offer.__slots__:
+			if raw(k, v1 - 1) != raw(k, v2 - 1):
+				# strings are only interned up to a limit so equal values can be stored twice
+				a = value(k, v1 - 1)
+				b = value(k, v2 - 1)
+				if a != b:
+					diffs[k] = [a, b]
+		return(diffs)
+
+
+# stands in for the lock of a HagglerPool that is not threadsafe
+_NO_LOCK = contextlib.nullcontext()
+
+
+# kinds of ChangeFeed subscription
+EVENT_VERSION = "version" # every version added to a User's offer history
+EVENT_STATE = "state"     # only versions that changed the User's state
+EVENT_KINDS = (EVENT_VERSION, EVENT_STATE)
+
+# what a Subscription does with a new event when its buffer is full
+OVERFLOW_DROP_OLDEST = "drop_oldest" # discard the oldest buffered event
+OVERFLOW_DROP_NEWEST = "drop_newest" # discard the new event
+OVERFLOW_CLOSE = "close"             # discard the new event and close the subscription
+OVERFLOW_POLICIES = (OVERFLOW_DROP_OLDEST, OVERFLOW_DROP_NEWEST, OVERFLOW_CLOSE)
+
+
+class ChangeEvent:
+
+	"""
+	A version added to one User's offer history by an action in a HagglerPool.
+	
+	Attributes:
+	    action (string): name of the action, as Offer.action
+	    negotiation_id (hashable): id of the negotiation
+	    offer (Offer): the new version
+	    previous_state (string): state of the User before the action, None for the first version
+	    state (string): state of the User after the action
+	    user_id (string): id of the User whose history it was added to
+	    version (int): version number of offer
+	"""
+
+	__slots__ = ("negotiation_id", "user_id", "action", "version", "previous_state", "state", "offer")
+
+	def __init__(self, negotiation_id, user_id, previous_state, offer):
+		self.negotiation_id = negotiation_id
+		self.user_id = user_id
+		self.action = offer.action
+		self.version = offer.version
+		self.previous_state = previous_state
+		self.state = offer.state
+		self.offer = offer
+
+	@property
+	def state_changed(self):
+		return self.state != self.previous_state
+
+	def __repr__(self):
+		return "ChangeEvent({0!r}, {1!r}, {2}, {3}, {4} -> {5})".format(
+			self.negotiation_id, self.user_id, self.version, self.action, self.previous_state, self.state)
+
+
+class Subscription:
+
+	"""
+	Subscription to a ChangeFeed, made by ChangeFeed.subscribe. Matching events are
+	kept in a bounded buffer until they are consumed, in batches of up to batch_size,
+	with poll, or awaited with next or async iteration. With a callback, events are
+	instead passed to it in batches as soon as batch_size of them have arrived.
+	
+	Attributes:
+	    batch_size (int): most events delivered at once
+	    buffer_size (int): most events buffered
+	    callback (callable): called with each batch, or None
+	    closed (bool): whether the subscription has been closed
+	    dropped (int): events discarded because the buffer was full
+	    error (Exception): exception raised by callback, or by waking a consumer whose
+	        event loop has been closed, which closed the subscription
+	    kind (string): EVENT_VERSION or EVENT_STATE
+	    negotiation_ids (frozenset): negotiations to receive events of, None for all
+	    overflow (string): one of OVERFLOW_POLICIES
+	    user_ids (frozenset): users to receive events of, None for all
+	"""
+
+	def __init__(self, feed, user_ids, negotiation_ids, kind, batch_size, buffer_size, overflow, callback):
+		self.feed = feed
+		self.user_ids = None if user_ids is None else frozenset(user_ids)
+		self.negotiation_ids = None if negotiation_ids is None else frozenset(negotiation_ids)
+		self.kind = kind
+		self.batch_size = batch_size
+		self.buffer_size = buffer_size
+		self.overflow = overflow
+		self.callback = callback
+		self.closed = False
+		self.dropped = 0
+		self.error = None
+		self.buffer = deque()
+		self.lock = threading.Lock()
+		self._waiter = None
+
+	def _offer(self, event):
+		"""
+		Buffers event if it matches the filters, applying the overflow policy, and
+		delivers a batch to the callback or wakes an awaiting consumer.
+		"""
+		if self.kind == EVENT_STATE and event.state == event.previous_state:
+			return
+		if self.user_ids is not None and event.user_id not in self.user_ids:
+			return
+		if self.negotiation_ids is not None and event.negotiation_id not in self.negotiation_ids:
+			return
+
+		buffer = self.buffer
+		with self.lock:
+			if self.closed:
+				return
+			if len(buffer) >= self.buffer_size:
+				self.dropped += 1
+				if self.overflow == OVERFLOW_DROP_OLDEST:
+					buffer.popleft()
+				else:
+					if self.overflow == OVERFLOW_CLOSE:
+						self.closed = True
+						self.feed._remove(self)
+						self._wake()
+					return
+			buffer.append(event)
+			if self.callback is None:
+				self._wake()
+				return
+			if len(buffer) < self.batch_size:
+				return
+			batch = self._take(self.batch_size)
+		self._deliver(batch)
+
+	def _take(self, n):
+		buffer = self.buffer
+		n = min(n, len(buffer))
+		return [buffer.popleft() for _ in range(n)]
+
+	def _deliver(self, batch):
+		try:
+			self.callback(batch)
+		except Exception as e:
+			self.error = e
+			self.close()
+
+	def _wake(self):
+		# called with the lock held
+		waiter = self._waiter
+		if waiter is not None:
+			self._waiter = None
+			loop, future = waiter
+			try:
+				loop.call_soon_threadsafe(_resolve, future)
+			except RuntimeError as e:
+				# the loop awaiting next has been closed, so nothing will consume the events
+				self.error = e
+				if not self.closed:
+					self.closed = True
+					self.feed._remove(self)
+
+	def flush(self):
+		"""
+		Passes the buffered events to the callback, in batches.
+		"""
+		if self.callback is None:
+			return
+		while True:
+			with self.lock:
+				batch = self._take(self.batch_size)
+			if not batch:
+				return
+			self._deliver(batch)
+
+	def poll(self):
+		"""
+		Returns the next batch of buffered events without waiting.
+		
+		Returns:
+		    list: up to batch_size ChangeEvents, empty if none are buffered
+		"""
+		with self.lock:
+			return self._take(self.batch_size)
+
+	async def next(self, timeout=None):
+		"""
+		Waits for at least one event then returns the next batch. Must not be awaited
+		by more than one task at once.
+		
+		Args:
+		    timeout (float): seconds to wait, None to wait until an event arrives
+		
+		Returns:
+		    list: up to batch_size ChangeEvents, empty on timeout or if the
+		        subscription is closed and drained
+		"""
+		while True:
+			with self.lock:
+				batch = self._take(self.batch_size)
+				if batch or self.closed:
+					return batch
+				loop = asyncio.get_running_loop()
+				future = loop.create_future()
+				self._waiter = (loop, future)
+			try:
+				await asyncio.wait_for(future, timeout)
+			except asyncio.TimeoutError:
+				self._waiter = None
+				return []
+
+	def __aiter__(self):
+		return self
+
+	async def __anext__(self):
+		batch = await self.next()
+		if not batch:
+			raise StopAsyncIteration
+		return batch
+
+	def close(self):
+		"""
+		Stops buffering new events and ends async iteration once the buffer is drained.
+		"""
+		with self.lock:
+			if not self.closed:
+				self.closed = True
+				self.feed._remove(self)
+			self._wake()
+
+
+def _resolve(future):
+	if not future.done():
+		future.set_result(None)
+
+
+class ChangeFeed:
+
+	"""
+	Pushes ChangeEvents to subscribers as actions in a HagglerPool add versions to
+	offer histories, so consumers need not poll. Pass it to HagglerPool(feed=...).
+	
+	An event is published for each version added to a User's history, which carries
+	the User's state set by the action. Subscriptions can filter by user id, by
+	negotiation id and to state changes only, and are indexed by their filters so
+	publishing only visits those that may match. Publishing happens in the thread
+	that took the action, after the action has succeeded, and does nothing without
+	subscribers. Actions replayed from a WriteAheadLog are published too.
+	
+	Attributes:
+	    subscriptions (list): open Subscriptions
+	"""
+
+	def __init__(self):
+		self.subscriptions = []
+		self._everything = []
+		self._by_user = {}
+		self._by_negotiation = {}
+		self.lock = threading.Lock()
+
+	def subscribe(self, user_ids=None, negotiation_ids=None, kind=EVENT_VERSION, batch_size=64,
+	              buffer_size=4096, overflow=OVERFLOW_DROP_OLDEST, callback=None):
+		"""
+		Adds a Subscription to the feed.
+		
+		Args:
+		    user_ids (iterable): only events for these users, None for all
+		    negotiation_ids (iterable): only events of these negotiations, None for all
+		    kind (string): EVENT_VERSION for every new version, EVENT_STATE for state changes only
+		    batch_size (int): most events delivered at once
+		    buffer_size (int): most events buffered before the overflow policy applies
+		    overflow (string): one of OVERFLOW_POLICIES
+		    callback (callable): called with each batch of events instead of buffering
+		        them for poll, in the thread that took the action
+		
+		Returns:
+		    Subscription: the new subscription
+		
+		Raises:
+		    ValueError: if kind or overflow is unknown, or batch_size or buffer_size is
+		        less than 1
+		"""
+		if kind not in EVENT_KINDS:
+			raise ValueError("kind must be one of {0}, not {1!r}".format(EVENT_KINDS, kind))
+		if overflow not in OVERFLOW_POLICIES:
+			raise ValueError("overflow must be one of {0}, not {1!r}".format(OVERFLOW_POLICIES, overflow))
+		if batch_size < 1 or buffer_size < 1:
+			raise ValueError("batch_size and buffer_size must be at least 1")
+
+		subscription = Subscription(self, user_ids, negotiation_ids, kind, batch_size, buffer_size, overflow, callback)
+		with self.lock:
+			# copy on write, so publish can read the indexes without the lock
+			for index, key in self._indexes(subscription):
+				if index is None:
+					self._everything = self._everything + [subscription]
+				else:
+					index[key] = index.get(key, []) + [subscription]
+			self.subscriptions = self.subscriptions + [subscription]
+		return subscription
+
+	def _indexes(self, subscription):
+		# a subscription is indexed by its negotiation filter, else its user filter
+		if subscription.negotiation_ids is not None:
+			return [(self._by_negotiation, key) for key in subscription.negotiation_ids]
+		if subscription.user_ids is not None:
+			return [(self._by_user, key) for key in subscription.user_ids]
+		return [(None, None)]
+
+	def _remove(self, subscription):
+		with self.lock:
+			if subscription not in self.subscriptions:
+				return
+			for index, key in self._indexes(subscription):
+				if index is None:
+					self._everything = [s for s in self._everything if s is not subscription]
+				else:
+					remaining = [s for s in index[key] if s is not subscription]
+					if remaining:
+						index[key] = remaining
+					else:
+						del index[key]
+			self.subscriptions = [s for s in self.subscriptions if s is not subscription]
+
+	def publish(self, negotiation_id, haggler, user_ids):
+		"""
+		Publishes the last version of each of user_ids in haggler. Called by HagglerPool
+		after an action succeeds.
+		
+		Args:
+		    negotiation_id (hashable): id of the negotiation
+		    haggler (Haggler): the negotiation
+		    user_ids (iterable): users the action added a version for
+		"""
+		if not self.subscriptions:
+			return
+		targets = self._everything + self._by_negotiation.get(negotiation_id, [])
+		by_user = self._by_user
+		users = haggler.users
+		for user_id in user_ids:
+			subscriptions = targets + by_user[user_id] if user_id in by_user else targets
+			if not subscriptions:
+				continue
+			user = users[user_id]
+			offer = user.current_offer
+			previous_state = user.offer_history[offer.version - 2].state if offer.version > 1 else None
+			event = ChangeEvent(negotiation_id, user_id, previous_state, offer)
+			for subscription in subscriptions:
+				subscription._offer(event)
+
+	def flush(self):
+		"""
+		Passes the events buffered for callbacks to them, see Subscription.flush.
+		"""
+		for subscription in self.subscriptions:
+			subscription.flush()
+
+
+# entries per bucket of a _SortedIndex before it is split in two
+_SORTED_LOAD = 512
+
+
+class _SortedIndex:
+
+	"""
+	Keys kept in order with a value each, as a list of buckets of at most
+	2 * _SORTED_LOAD keys. Adding or removing a key moves at most one bucket, and a
+	range is found by bisecting the bucket maxima then the buckets.
+	"""
+
+	__slots__ = ("_keys", "_values", "_maxes", "_len")
+
+	def __init__(self):
+		self._keys = []
+		self._values = []
+		self._maxes = []
+		self._len = 0
+
+	def __len__(self):
+		return self._len
+
+	def add(self, key, value):
+		maxes = self._maxes
+		self._len += 1
+		if not maxes:
+			self._keys.append([key])
+			self._values.append([value])
+			maxes.append(key)
+			return
+		i = bisect_left(maxes, key)
+		if i == len(maxes):
+			i -= 1
+		keys = self._keys[i]
+		position = bisect_right(keys, key)
+		keys.insert(position, key)
+		self._values[i].insert(position, value)
+		maxes[i] = keys[-1]
+		if len(keys) > 2 * _SORTED_LOAD:
+			values = self._values[i]
+			self._keys[i:i + 1] = [keys[:_SORTED_LOAD], keys[_SORTED_LOAD:]]
+			self._values[i:i + 1] = [values[:_SORTED_LOAD], values[_SORTED_LOAD:]]
+			maxes[i:i + 1] = [keys[_SORTED_LOAD - 1], keys[-1]]
+
+	def remove(self, key, value):
+		"""
+		Removes the entry key -> value. Equal keys may span buckets, so each is
+		checked until a bigger key is found.
+		"""
+		maxes = self._maxes
+		for i in range(bisect_left(maxes, key), len(maxes)):
+			keys = self._keys[i]
+			values = self._values[i]
+			position = bisect_left(keys, key)
+			while position < len(keys) and keys[position] == key:
+				if values[position] == value:
+					del keys[position]
+					del values[position]
+					self._len -= 1
+					if keys:
+						maxes[i] = keys[-1]
+					else:
+						del self._keys[i], self._values[i], maxes[i]
+					return
+				position += 1
+			if position < len(keys):
+				break
+		raise KeyError(key)
+
+	def range(self, low, high):
+		"""
+		Generator of the values of the keys from low to high inclusive, in key order.
+		None leaves that end open.
+		"""
+		maxes = self._maxes
+		start = 0 if low is None else bisect_left(maxes, low)
+		for i in range(start, len(maxes)):
+			keys = self._keys[i]
+			values = self._values[i]
+			position = 0 if low is None else bisect_left(keys, low)
+			end = len(keys) if high is None else bisect_right(keys, high)
+			yield from values[position:end]
+			if end < len(keys):
+				return
+
+
+class NegotiationIndex:
+
+	"""
+	Secondary indexes over the open negotiations of a HagglerPool, kept up to date as
+	actions succeed. Pass indexed=True to HagglerPool and use HagglerPool.query.
+	
+	Products and states are hash indexes of sets of negotiation ids, and current
+	price and full price (price * quantity) are sorted indexes. Each negotiation's
+	indexed values are kept in entries, so an update only moves the values that
+	changed.
+	
+	Attributes:
+	    by_product (dict): product of the current offer -> set of negotiation ids
+	    by_state (dict): STATE_* code -> set of negotiation ids with a User in that state
+	    by_user_state (dict): (user id, STATE_* code) -> set of negotiation ids
+	    entries (dict): negotiation id -> (product, ((user id, STATE_* code), ...),
+	        price, full price), with None for the product and prices before a submit
+	    full_price (_SortedIndex): full price -> negotiation id
+	    price (_SortedIndex): price -> negotiation id
+	"""
+
+	__slots__ = ("by_product", "by_state", "by_user_state", "entries", "full_price", "price")
+
+	def __init__(self):
+		self.by_product = {}
+		self.by_state = {}
+		self.by_user_state = {}
+		self.entries = {}
+		self.price = _SortedIndex()
+		self.full_price = _SortedIndex()
+
+	def __len__(self):
+		return len(self.entries)
+
+	def update(self, negotiation_id, haggler):
+		"""
+		Indexes the current offer and states of a negotiation, replacing what was
+		indexed for it before.
+		
+		Args:
+		    negotiation_id (hashable): id of the negotiation
+		    haggler (Haggler): its Haggler, or a HagglerView
+		"""
+		users = haggler.users
+		user_states = tuple([(user_id, user.state_code) for user_id, user in users.items()])
+		offer = next(iter(users.values())).current_offer
+		if offer is None:
+			entry = (None, user_states, None, None)
+		else:
+			entry = (offer.product, user_states, offer.price, offer.price * offer.quantity)
+		old = self.entries.get(negotiation_id)
+		if old == entry:
+			return
+		self.entries[negotiation_id] = entry
+		if old is None:
+			old = (None, (), None, None)
+
+		if old[0] != entry[0]:
+			_unindex(self.by_product, old[0], negotiation_id)
+			_index(self.by_product, entry[0], negotiation_id)
+		old_states = old[1]
+		if old_states != user_states:
+			by_user_state = self.by_user_state
+			for key in old_states:
+				if key not in user_states:
+					_unindex(by_user_state, key, negotiation_id)
+			for key in user_states:
+				if key not in old_states:
+					_index(by_user_state, key, negotiation_id)
+			# the two Users usually just swap states, which leaves by_state as it is
+			old_codes = [state for _, state in old_states]
+			codes = [state for _, state in user_states]
+			for state in old_codes:
+				if state not in codes:
+					_unindex(self.by_state, state, negotiation_id)
+			for state in codes:
+				if state not in old_codes:
+					_index(self.by_state, state, negotiation_id)
+		for column, sorted_index in ((2, self.price), (3, self.full_price)):
+			if old[column] != entry[column]:
+				if old[column] is not None:
+					sorted_index.remove(old[column], negotiation_id)
+				if entry[column] is not None:
+					sorted_index.add(entry[column], negotiation_id)
+
+	def remove(self, negotiation_id):
+		"""
+		Drops a negotiation from every index.
+		
+		Args:
+		    negotiation_id (hashable): id of the negotiation
+		"""
+		entry = self.entries.pop(negotiation_id, None)
+		if entry is None:
+			return
+		product, user_states, price, full_price = entry
+		_unindex(self.by_product, product, negotiation_id)
+		for key in user_states:
+			_unindex(self.by_user_state, key, negotiation_id)
+			_unindex(self.by_state, key[1], negotiation_id)
+		if price is not None:
+			self.price.remove(price, negotiation_id)
+			self.full_price.remove(full_price, negotiation_id)
+
+	def query(self, product=None, state=None, user_id=None, price=None, full_price=None):
+		"""
+		Returns the ids of the negotiations matching every filter given. The smallest
+		of the hash index sets is intersected with the others, then checked against
+		the price ranges, so the cost follows the size of the smallest set rather
+		than the number of negotiations. Price ranges alone are read from the sorted
+		indexes.
+		
+		Args:
+		    product: product of the current offer
+		    state (string/int): state name or STATE_* code - STATE_NONE for negotiations
+		        without a submit yet. With user_id, the state of that user, otherwise
+		        of either user.
+		    user_id (string): only negotiations of this user
+		    price (tuple): (low, high) range of the current price, inclusive. Either
+		        may be None for an open end.
+		    full_price (tuple): (low, high) range of price * quantity
+		
+		Returns:
+		    set: negotiation ids
+		
+		Raises:
+		    ValueError: if state is not a known state
+		"""
+		sets = []
+		if product is not None:
+			sets.append(self.by_product.get(product, _EMPTY_SET))
+		if state is not None:
+			code = state if isinstance(state, int) else STATE_CODES.get(state)
+			if code not in range(len(STATES)):
+				raise ValueError("unknown state {0!r}".format(state))
+			if user_id is None:
+				sets.append(self.by_state.get(code, _EMPTY_SET))
+			else:
+				sets.append(self.by_user_state.get((user_id, code), _EMPTY_SET))
+		elif user_id is not None:
+			user_sets = [self.by_user_state.get((user_id, code), _EMPTY_SET) for code in range(len(STATES))]
+			sets.append(set().union(*user_sets))
+
+		ranges = [(column, bounds) for column, bounds in ((2, price), (3, full_price)) if bounds is not None]
+		if not sets:
+			if not ranges:
+				return set(self.entries)
+			column, (low, high) = ranges.pop(0)
+			sorted_index = self.price if column == 2 else self.full_price
+			sets.append(set(sorted_index.range(low, high)))
+
+		sets.sort(key=len)
+		matches = set(sets[0])
+		for other in sets[1:]:
+			matches &= other
+		entries = self.entries
+		for column, (low, high) in ranges:
+			low = _NEGATIVE_INFINITY if low is None else low
+			high = _INFINITY if high is None else high
+			values = [entries[negotiation_id][column] for negotiation_id in matches]
+			matches = {negotiation_id for negotiation_id, value in zip(matches, values)
+				if value is not None and low <= value <= high}
+		return matches
+
+
+_EMPTY_SET = frozenset()
+_INFINITY = float("inf")
+_NEGATIVE_INFINITY = float("-inf")
+
+
+def _index(index, key, negotiation_id):
+	if key is None:
+		return
+	negotiation_ids = index.get(key)
+	if negotiation_ids is None:
+		index[key] = {negotiation_id}
+	else:
+		negotiation_ids.add(negotiation_id)
+
+
+def _unindex(index, key, negotiation_id):
+	negotiation_ids = index.get(key)
+	if negotiation_ids is not None:
+		negotiation_ids.discard(negotiation_id)
+		if not negotiation_ids:
+			del index[key]
+
+
+class TimingWheel:
+
+	"""
+	Hierarchical timing wheel of timers keyed by any hashable.
+	
+	Time is counted in ticks of tick seconds of clock. The wheel has levels levels of
+	slots slots each, a slot of level k spanning slots ** k ticks. A timer is put in
+	the lowest level whose span reaches its deadline and moved down a level each
+	time the wheel turns to its slot above, so scheduling, rescheduling and
+	cancelling are O(1) whatever the number of timers, and advancing only touches
+	the slots it turns past and the timers it fires. While the lower levels are
+	empty the wheel turns a whole slot of the level above at a time. Deadlines
+	beyond the top level wait in its last slot and are placed again when reached.
+	
+	A timer fires at the first advance to the tick holding its deadline or later -
+	up to a tick late, never early.
+	
+	Attributes:
+	    clock (callable): returns the current time in seconds
+	    levels (int): number of levels
+	    now (int): tick the wheel has been advanced to
+	    slots (int): slots per level, a power of two
+	    tick (float): seconds per tick
+	"""
+
+	def __init__(self, tick=1.0, slots=64, levels=4, clock=time.monotonic):
+		"""
+		Initialise an empty TimingWheel at the clock's current time.
+		
+		Args:
+		    tick (float): seconds per tick
+		    slots (int): slots per level, a power of two
+		    levels (int): number of levels. The wheel spans slots ** levels ticks.
+		    clock (callable): returns the current time in seconds
+		
+		Raises:
+		    ValueError: if tick is not positive, slots is not a power of two of at least
+		        2, or levels is less than 1
+		"""
+		if tick <= 0 or slots < 2 or slots & (slots - 1) or levels < 1:
+			raise ValueError("tick must be > 0, slots a power of two >= 2 and levels >= 1, not {0}, {1} and {2}".format(tick, slots, levels))
+		self.tick = tick
+		self.slots = slots
+		self.levels = levels
+		self.clock = clock
+		self.now = int(clock() // tick)
+		self._bits = slots.bit_length() - 1
+		self._mask = slots - 1
+		self._wheel = [[{} for _ in range(slots)] for _ in range(levels)]
+		self._counts = [0] * levels
+		# key -> (slot dict holding it, level), level -1 for timers already due
+		self._timers = {}
+		self._due = {}
+
+	def __len__(self):
+		return len(self._timers)
+
+	def __contains__(self, key):
+		return key in self._timers
+
+	def schedule(self, key, deadline):
+		"""
+		Arms the timer key to fire at deadline, replacing the deadline it had.
+		
+		Args:
+		    key (hashable): key of the timer
+		    deadline (float): time in clock seconds
+		"""
+		entry = self._timers.get(key)
+		if entry is not None:
+			del entry[0][key]
+			if entry[1] >= 0:
+				self._counts[entry[1]] -= 1
+		# the first tick at or after deadline
+		expiry = int(-(-deadline // self.tick))
+		if expiry <= self.now:
+			self._due[key] = expiry
+			self._timers[key] = (self._due, -1)
+		else:
+			self._place(key, expiry)
+
+	def _place(self, key, expiry):
+		# expiry >= now: the lowest level whose span reaches it
+		bits = self._bits
+		delta = expiry - self.now
+		level = 0
+		top = self.levels - 1
+		while level < top and delta >> (bits * (level + 1)):
+			level += 1
+		if level == top and delta >> (bits * (level + 1)):
+			# beyond the top level, wait in its last slot
+			slot = self._wheel[level][((self.now + (1 << (bits * (level + 1))) - 1) >> (bits * level)) & self._mask]
+		else:
+			slot = self._wheel[level][(expiry >> (bits * level)) & self._mask]
+		slot[key] = expiry
+		self._counts[level] += 1
+		self._timers[key] = (slot, level)
+
+	def cancel(self, key):
+		"""
+		Disarms the timer key.
+		
+		Args:
+		    key (hashable): key of the timer
+		
+		Returns:
+		    bool: False if there was no such timer
+		"""
+		entry = self._timers.pop(key, None)
+		if entry is None:
+			return False
+		slot, level = entry
+		del slot[key]
+		if level >= 0:
+			self._counts[level] -= 1
+		return True
+
+	def deadline(self, key):
+		"""
+		Returns the deadline of the timer key, rounded up to a tick, or None.
+		"""
+		entry = self._timers.get(key)
+		if entry is None:
+			return None
+		return entry[0][key] * self.tick
+
+	def advance(self, now=None):
+		"""
+		Turns the wheel to the tick of now and fires every timer due by then.
+		
+		Args:
+		    now (float): time in clock seconds, the clock's current time if None
+		
+		Returns:
+		    list: keys of the timers fired, in order of their deadline ticks
+		"""
+		target = int((self.clock() if now is None else now) // self.tick)
+		timers = self._timers
+		fired = list(self._due)
+		if fired:
+			for key in fired:
+				del timers[key]
+			self._due.clear()
+
+		bits = self._bits
+		mask = self._mask
+		counts = self._counts
+		first = self._wheel[0]
+		while self.now < target:
+			# skip the ticks nothing can fire or move down at
+			step = 1
+			for count in counts:
+				if count:
+					break
+				step <<= bits
+			else:
+				break
+			t = (self.now | (step - 1)) + 1
+			if t > target:
+				break
+			self.now = t
+			if not t & mask:
+				self._cascade(t)
+			index = t & mask
+			slot = first[index]
+			if slot:
+				first[index] = {}
+				counts[0] -= len(slot)
+				for key, expiry in slot.items():
+					if expiry > t:
+						# was beyond the top level
+						self._place(key, expiry)
+					else:
+						del timers[key]
+						fired.append(key)
+		self.now = max(self.now, target)
+		return fired
+
+	def _cascade(self, t):
+		"""
+		Moves the timers in the slots the wheel has turned to at tick t down a level.
+		"""
+		bits = self._bits
+		for level in range(1, self.levels):
+			index = (t >> (bits * level)) & self._mask
+			slot = self._wheel[level][index]
+			if slot:
+				self._wheel[level][index] = {}
+				self._counts[level] -= len(slot)
+				for key, expiry in slot.items():
+					self._place(key, expiry)
+			if index:
+				break
+
+
+class ExpiryScheduler:
+
+	"""
+	Deadlines for the negotiations of a HagglerPool, which arms them as actions are
+	taken and fires them with HagglerPool.expire.
+	
+	An offer expires offer_ttl seconds after a submit or proposeUpdate left one user
+	AwaitingTheirAcceptance, and is then withdrawn by that user. A negotiation
+	expires idle_ttl seconds after its last action other than updatePrivateData, and
+	is then cancelled. Every action re-arms both deadlines for the state it left,
+	so a counter offer restarts the offer's clock, a withdrawal disarms it, and
+	ended negotiations have none. Negotiations with no action yet are not timed.
+	
+	Deadlines are held in a TimingWheel each, so arming costs the same with millions
+	pending, and expire only looks at the deadlines that have passed. They are not
+	persisted: after HagglerPool.recover or restore they restart from then.
+	
+	Attributes:
+	    clock (callable): returns the current time in seconds
+	    idle (TimingWheel): negotiation id -> idle deadline
+	    idle_ttl (float): seconds a negotiation can go without an action, or None
+	    offer_ttl (float): seconds an offer can await acceptance, or None
+	    offers (TimingWheel): negotiation id -> offer deadline
+	"""
+
+	def __init__(self, offer_ttl=None, idle_ttl=None, tick=1.0, clock=time.monotonic, slots=64, levels=4):
+		"""
+		Initialise an ExpiryScheduler.
+		
+		Args:
+		    offer_ttl (float): seconds an offer can await acceptance, None for no limit
+		    idle_ttl (float): seconds a negotiation can go without an action, None for no limit
+		    tick (float): resolution of the deadlines in seconds
+		    clock (callable): returns the current time in seconds
+		    slots (int): slots per level of the timing wheels
+		    levels (int): levels of the timing wheels
+		
+		Raises:
+		    ValueError: if neither ttl is given, or the wheel arguments are invalid
+		"""
+		if offer_ttl is None and idle_ttl is None:
+			raise ValueError("an ExpiryScheduler needs an offer_ttl or an idle_ttl")
+		self.offer_ttl = offer_ttl
+		self.idle_ttl = idle_ttl
+		self.clock = clock
+		self.offers = TimingWheel(tick, slots, levels, clock)
+		self.idle = TimingWheel(tick, slots, levels, clock)
+
+	def __len__(self):
+		return len(self.offers) + len(self.idle)
+
+	def arm(self, negotiation_id, haggler):
+		"""
+		Arms, re-arms or disarms the deadlines of a negotiation for the state of haggler.
+		"""
+		now = self.clock()
+		user_1, user_2 = haggler.users.values()
+		if self.offer_ttl is not None:
+			if user_1.state_code == STATE_AWAITING_THEIR_ACCEPTANCE or user_2.state_code == STATE_AWAITING_THEIR_ACCEPTANCE:
+				self.offers.schedule(negotiation_id, now + self.offer_ttl)
+			else:
+				self.offers.cancel(negotiation_id)
+		if self.idle_ttl is not None and (user_1.state_code or user_2.state_code):
+			self.idle.schedule(negotiation_id, now + self.idle_ttl)
+
+	def disarm(self, negotiation_id):
+		"""
+		Disarms the deadlines of a negotiation.
+		"""
+		self.offers.cancel(negotiation_id)
+		self.idle.cancel(negotiation_id)
+
+	def due(self, now=None):
+		"""
+		Returns (offer negotiation ids, idle negotiation ids) whose deadlines have passed
+		by now, the clock's current time if None. Their deadlines are disarmed.
+		"""
+		if now is None:
+			now = self.clock()
+		return self.offers.advance(now), self.idle.advance(now)
+
+
+class HagglerPool:
+
+	"""
+	HagglerPool Class - in-process engine holding many negotiations, each a Haggler
+	stored under a negotiation id.
+	
+	Action methods mirror those of Haggler with the negotiation id as the first argument.
+	Open negotiations are indexed by id and by user id. Once an action sets User.end
+	(Accept or Cancel) the negotiation is removed from the open indexes and either
+	archived or evicted, so the open indexes only grow with live deals.
+	
+	Errors are reported according to the errors mode, as for Haggler, which is
+	also used for the Hagglers in the pool.
+	
+	If the pool has a WriteAheadLog, every negotiation created and every action that
+	succeeds is appended to it, and HagglerPool.recover rebuilds the pool from it.
+	
+	A threadsafe pool holds ThreadSafeHagglers and guards its indexes with a lock, so
+	any thread can act on any negotiation.
+	
+	With journal, every version added to a User's history is also recorded against
+	the user id, so historySince can return what is new for a user across all their
+	negotiations. With a ChangeFeed, each such version is published to its subscribers.
+	With indexed, open negotiations are also indexed by product, state and price in a
+	NegotiationIndex, for query. With a HistoryRetention, every Haggler's offer
+	histories follow it. With an ExpiryScheduler, each action arms the deadlines of
+	its negotiation, and expire withdraws the offers and cancels the negotiations
+	whose deadlines have passed.
+	
+	Attributes:
+	    archive (dict): negotiation id -> finished Haggler, if on_end is "archive"
+	    errors (string): errors mode - ERRORS_PRINT, ERRORS_RETURN or ERRORS_RAISE
+	    event_sourced (bool): whether new Hagglers are created in event sourced mode
+	    evicted (int): count of finished negotiations dropped from the pool
+	    expiry (ExpiryScheduler): deadlines of the open negotiations, or None
+	    feed (ChangeFeed): feed new versions are published to, or None
+	    hagglers (dict): negotiation id -> open Haggler
+	    index (NegotiationIndex): secondary indexes of the open negotiations, or None
+	    journal (dict): user id -> list of (negotiation id, version) in the order they
+	        were added, or None
+	    lock (threading.Lock): guards the indexes if threadsafe
+	    on_end (string): "archive" or "evict" - what happens to finished negotiations
+	    open_by_user (dict): user id -> set of open negotiation ids
+	    retention (HistoryRetention): policy the offer histories follow, or None
+	    threadsafe (bool): whether the pool can be shared between threads
+	    wal (WriteAheadLog): log of the actions taken, or None
+	"""
+
+	def __init__(self, event_sourced=False, on_end="archive", archive=None, errors=ERRORS_PRINT, wal=None, threadsafe=False, journal=False, feed=None, indexed=False, retention=None, expiry=None):
+		"""
+		Initialise an empty HagglerPool.
+		
+		Args:
+		    event_sourced (bool): create Hagglers in event sourced mode
+		    on_end (string): "archive" to move finished negotiations to archive, or
+		        "evict" to drop them
+		    archive (dict): mapping finished negotiations are stored in. A new dict if None.
+		        A ColumnarArchive without an errors mode takes errors.
+		    errors (string): errors mode - "print", "return" or "raise"
+		    wal (WriteAheadLog): log to append created negotiations and successful actions to
+		    threadsafe (bool): create ThreadSafeHagglers and lock the indexes
+		    journal (bool): record each user's new versions for historySince
+		    feed (ChangeFeed): feed to publish new versions to
+		    indexed (bool): keep a NegotiationIndex of the open negotiations for query
+		    retention (HistoryRetention): policy for the offer histories of every Haggler
+		    expiry (ExpiryScheduler): deadlines to arm for each action, fired by expire
+		
+		Raises:
+		    ValueError: if on_end is not "archive" or "evict", errors is not an errors
+		        mode, both wal and threadsafe are given, or retention is given with
+		        event_sourced or threadsafe
+		"""
+		if on_end not in ("archive", "evict"):
+			raise ValueError("on_end must be 'archive' or 'evict', not {0!r}".format(on_end))
+		if errors not in ERROR_MODES:
+			raise ValueError("errors must be one of {0}, not {1!r}".format(ERROR_MODES, errors))
+		if wal is not None and threadsafe:
+			# records are appended after the Haggler's lock is released, so could be out of order
+			raise ValueError("a threadsafe HagglerPool cannot have a WriteAheadLog")
+		if retention is not None and (event_sourced or threadsafe):
+			raise ValueError("an event sourced or threadsafe HagglerPool cannot have a HistoryRetention")
+
+		self.errors = errors
+		self.event_sourced = event_sourced
+		self.on_end = on_end
+		self.archive = {} if archive is None else archive
+		if isinstance(archive, ColumnarArchive) and archive.errors is None:
+			archive.errors = errors
+		self.hagglers = {}
+		self.open_by_user = {}
+		self.evicted = 0
+		self.wal = wal
+		self.threadsafe = threadsafe
+		self.lock = threading.Lock() if threadsafe else _NO_LOCK
+		self._haggler_class = ThreadSafeHaggler if threadsafe else Haggler
+		self.journal = {} if journal else None
+		self.feed = feed
+		self.index = NegotiationIndex() if indexed else None
+		self.retention = retention
+		self.expiry = expiry
+		self._recording = self.journal is not None or feed is not None or indexed or expiry is not None
+
+	@classmethod
+	def recover(cls, path, fsync=FSYNC_BATCH, **kwargs):
+		"""
+		Rebuilds a HagglerPool by replaying the WriteAheadLog at path, then carries on
+		logging to it. A torn record at the end of the log (from a crash mid write) is
+		dropped.
+		
+		Args:
+		    path (string): path of the log file. An empty pool is returned if it does not exist.
+		    fsync (string): fsync policy for the reopened log
+		    **kwargs: other HagglerPool arguments - should match those of the pool that wrote the log
+		
+		Returns:
+		    HagglerPool: the recovered pool, with wal set to the reopened log
+		"""
+		pool = cls(**kwargs)
+		if os.path.exists(path):
+			for record in WriteAheadLog.read(path):
+				pool._redo(record)
+		pool.wal = WriteAheadLog(path, fsync)
+		return pool
+
+	def snapshot(self, path):
+		"""
+		Writes every negotiation in the pool, open and archived, to a compact binary
+		snapshot file that HagglerPool.restore loads back.
+		
+		User ids, products and other strings are interned into one string table, and
+		actions, states and roles are stored as their codes. Each offer version is a
+		fixed width record of symbol indexes and numbers. Each PrivateInfo shared
+		between versions is stored once.
+		
+		Only a dict archive is included in the snapshot.
+		
+		Args:
+		    path (string): path of the snapshot file, replaced if it exists
+		"""
+		writer = _SnapshotWriter()
+		negotiation_ids = []
+		sources = [(self.hagglers, False)]
+		if isinstance(self.archive, dict):
+			sources.append((self.archive, True))
+
+		for hagglers, archived in sources:
+			for negotiation_id, haggler in hagglers.items():
+				negotiation_ids.append(negotiation_id)
+				writer.haggler(haggler, archived)
+
+		header = {
+			"event_sourced": self.event_sourced,
+			"on_end": self.on_end,
+			"errors": self.errors,
+			"evicted": self.evicted,
+		}
+		with open(path, "wb") as f:
+			writer.write(f, header, negotiation_ids)
+
+	@classmethod
+	def restore(cls, path, **kwargs):
+		"""
+		Loads a snapshot written by HagglerPool.snapshot into a new HagglerPool of live
+		Hagglers.
+		
+		Args:
+		    path (string): path of the snapshot file
+		    **kwargs: other HagglerPool arguments, e.g. archive or wal. event_sourced,
+		        on_end and errors default to those of the pool that was snapshotted.
+		
+		Returns:
+		    HagglerPool: the restored pool
+		
+		Raises:
+		    ValueError: if the file is not a snapshot this version can read
+		"""
+		with open(path, "rb") as f:
+			data = f.read()
+
+		magic, version = _SNAPSHOT_PREAMBLE.unpack_from(data, 0)
+		if magic != _SNAPSHOT_MAGIC or version != _SNAPSHOT_VERSION:
+			raise ValueError("{0} is not a version {1} HagglerPool snapshot".format(path, _SNAPSHOT_VERSION))
+
+		offset = _SNAPSHOT_PREAMBLE.size
+		header, offset = _readSnapshotTable(data, offset)
+		strings, offset = _readSnapshotTable(data, offset)
+		values, offset = _readSnapshotTable(data, offset)
+		negotiation_ids, offset = _readSnapshotTable(data, offset)
+		private_infos, offset = _readSnapshotTable(data, offset)
+		private_infos = [PrivateInfo(p) if p else _EMPTY_PRIVATE_INFO for p in private_infos]
+		offset += _SNAPSHOT_LENGTH.size
+
+		kwargs.setdefault("event_sourced", header["event_sourced"])
+		kwargs.setdefault("on_end", header["on_end"])
+		kwargs.setdefault("errors", header["errors"])
+		pool = cls(**kwargs)
+		pool.evicted = header["evicted"]
+		errors = pool.errors
+		retention = pool.retention
+
+		# strings are indexed directly, other values from _SNAPSHOT_VALUE_BIT on
+		values = dict(enumerate(values, _SNAPSHOT_VALUE_BIT))
+		values.update(enumerate(map(_intern, strings)))
+
+		records = memoryview(data)
+		offer_size = _SNAPSHOT_OFFER.size
+		new_offer = _new_offer
+		# setting the slots directly is much quicker than Offer.__setstate__
+		(set_user_id, set_version, set_action, set_user_action, set_state, set_buyer,
+			set_seller, set_product, set_price, set_quantity, set_private_info) = [slot.__set__ for _, slot in _OFFER_SLOTS]
+
+		# the loop allocates millions of objects, none of them garbage, so pause the
+		# collector rather than have it repeatedly scan them
+		gc_enabled = gc.isenabled()
+		gc.disable()
+		try:
+			for negotiation_id in negotiation_ids:
+				archived, event_sourced, step_count = _SNAPSHOT_NEGOTIATION.unpack_from(data, offset)
+				offset += _SNAPSHOT_NEGOTIATION.size
+				fields = []
+				for _ in range(2):
+					fields.append(_SNAPSHOT_USER.unpack_from(data, offset))
+					offset += _SNAPSHOT_USER.size
+
+				user_ids = [values[f[0]] for f in fields]
+				haggler = pool._haggler_class(user_ids[0], user_ids[1], errors=errors)
+				users = [haggler.users[user_id] for user_id in user_ids]
+				histories = []
+
+				for user, (_, role, state, end, has_other, curr_version, private_info, length) in zip(users, fields):
+					user.role = _SNAPSHOT_ROLES[role]
+					user.state = STATES[state]
+					user.state_code = state
+					user.end = bool(end)
+					user.curr_version = curr_version
+					user.private_info = private_infos[private_info]
+
+					history = []
+					user_id = user.user_id
+					end_offset = offset + length * offer_size
+					for (version, action, user_action, o_state, buyer, seller, product,
+						price_kind, price, quantity_kind, quantity, o_private_info) in _SNAPSHOT_OFFER.iter_unpack(records[offset:end_offset]):
+						offer = new_offer(Offer)
+						set_user_id(offer, user_id)
+						set_version(offer, version)
+						set_action(offer, ACTIONS[action])
+						set_user_action(offer, values[user_action])
+						set_state(offer, STATES[o_state])
+						set_buyer(offer, values[buyer])
+						set_seller(offer, values[seller])
+						set_product(offer, values[product])
+						set_price(offer, price if price_kind == _NUMBER_INT else _snapshotNumber(price_kind, price, values))
+						set_quantity(offer, quantity if quantity_kind == _NUMBER_INT else _snapshotNumber(quantity_kind, quantity, values))
+						set_private_info(offer, private_infos[o_private_info])
+						history.append(offer)
+					offset = end_offset
+					histories.append(history)
+					if history:
+						user.current_offer = history[-1]
+
+				if fields[0][4]:
+					users[0].other = users[1]
+				if fields[1][4]:
+					users[1].other = users[0]
+				haggler.steps = bytearray(records[offset:offset + step_count])
+				offset += step_count
+
+				if event_sourced:
+					haggler.log = EventLog.rebuild(user_ids[0], user_ids[1], histories[0], histories[1])
+					for user in users:
+						user.offer_history = haggler.log.projection(user.user_id)
+				else:
+					for user, history in zip(users, histories):
+						user.offer_history = history if retention is None else retention.history(user.user_id, history)
+				if pool.threadsafe:
+					haggler._publish()
+
+				if archived:
+					pool.archive[negotiation_id] = haggler
+				else:
+					pool.hagglers[negotiation_id] = haggler
+					pool._indexUsers(negotiation_id, haggler)
+		finally:
+			if gc_enabled:
+				gc.enable()
+
+		return pool
+
+	def _redo(self, record):
+		"""
+		Applies a record read back from a WriteAheadLog.
+		"""
+		op, negotiation_id, user_id, payload = record
+		if op == WAL_CREATE:
+			haggler = self._haggler_class(payload[0], payload[1], self.event_sourced, self.errors, self.retention)
+			self.hagglers[negotiation_id] = haggler
+			self._indexUsers(negotiation_id, haggler)
+			return
+
+		haggler = self.get(negotiation_id)
+		if haggler._apply(op, user_id, payload) == RESULT_OK:
+			if self._recording:
+				self._record(negotiation_id, haggler, op, user_id)
+			if ACTION_ENDS[op]:
+				self._ended(negotiation_id, haggler, user_id)
+
+	def __len__(self):
+		return len(self.hagglers)
+
+	def __contains__(self, negotiation_id):
+		return negotiation_id in self.hagglers
+
+	def create(self, negotiation_id, user_id_1, user_id_2):
+		"""
+		Creates a new negotiation between two users.
+		
+		Args:
+		    negotiation_id (hashable): id of the new negotiation
+		    user_id_1 (string): id of first User
+		    user_id_2 (string): id of second User
+		
+		Returns:
+		    Haggler: the new Haggler, or None if it could not be created
+		
+		Raises:
+		    ValueError: if negotiation_id is already in use
+		"""
+		with self.lock:
+			if negotiation_id in self.hagglers or negotiation_id in self.archive:
+				rejections.add(WAL_CREATE, RESULT_NEGOTIATION_EXISTS)
+				_reportError(self.errors, RESULT_NEGOTIATION_EXISTS, "Error: negotiation {0} already exists.", negotiation_id)
+				return
+
+			haggler = self._haggler_class(user_id_1, user_id_2, self.event_sourced, self.errors, self.retention)
+			if not hasattr(haggler, "users"):
+				return
+
+			self.hagglers[negotiation_id] = haggler
+			self._indexUsers(negotiation_id, haggler)
+		if self.wal is not None:
+			self.wal.append((WAL_CREATE, negotiation_id, None, (user_id_1, user_id_2)))
+		return haggler
+
+	def createMany(self, negotiations):
+		"""
+		Creates many negotiations in one call.
+		
+		Args:
+		    negotiations (iterable): (negotiation_id, user_id_1, user_id_2) tuples
+		
+		Returns:
+		    int: number of negotiations created
+		"""
+		hagglers = self.hagglers
+		archive = self.archive
+		index_users = self._indexUsers
+		event_sourced = self.event_sourced
+		errors = self.errors
+		wal = self.wal
+		retention = self.retention
+		haggler_class = self._haggler_class
+		created = 0
+
+		with self.lock:
+			for negotiation_id, user_id_1, user_id_2 in negotiations:
+				if negotiation_id in hagglers or negotiation_id in archive:
+					rejections.add(WAL_CREATE, RESULT_NEGOTIATION_EXISTS)
+					_reportError(errors, RESULT_NEGOTIATION_EXISTS, "Error: negotiation {0} already exists.", negotiation_id)
+					continue
+				if not (isinstance(user_id_1, str) and isinstance(user_id_2, str)):
+					rejections.add(WAL_CREATE, RESULT_UNKNOWN_USER)
+					_reportError(errors, RESULT_UNKNOWN_USER, "User IDs must be type string")
+					continue
+
+				haggler = hagglers[negotiation_id] = haggler_class(user_id_1, user_id_2, event_sourced, errors, retention)
+				index_users(negotiation_id, haggler)
+				if wal is not None:
+					wal.append((WAL_CREATE, negotiation_id, None, (user_id_1, user_id_2)))
+				created += 1
+
+		return created
+
+	def applyBatch(self, actions):
+		"""
+		Applies a sequence of actions in one call, with the same outcome as calling the
+		action methods one by one in the order given. Each negotiation is looked up
+		once per batch (and again after it ends), and the WriteAheadLog, journal and
+		ChangeFeed record the actions in the order given.
+		
+		Rejected actions are counted in rejections and reported as their action
+		methods would: printed in print mode, only returned in return mode, and in
+		raise mode a BatchError is raised at the first one, so the actions after it
+		are not applied.
+		
+		Each action is a (negotiation_id, action, user_id, payload) tuple where action
+		is the name of the Haggler method and payload depends on it:
+		
+		    "submit": (other_id, offer)
+		    "proposeUpdate": offer
+		    "updatePrivateData": private_info
+		    "accept", "withdraw", "cancel": ignored
+		
+		Args:
+		    actions (sequence): action tuples
+		
+		Returns:
+		    array: a RESULT_* code per action, in the order given
+		
+		Raises:
+		    BatchError: at the first rejected action, if errors is "raise"
+		"""
+		return self._applyBatch(actions, self.errors)
+
+	def _applyBatch(self, actions, errors):
+		"""
+		applyBatch, reporting rejected actions according to the errors mode errors.
+		"""
+		results = array("b", bytes(len(actions)))
+		action_codes = ACTION_CODES
+		wal = self.wal
+		recording = self._recording
+		# negotiation id -> Haggler (or None if unknown) for the negotiations seen so far
+		hagglers = {}
+
+		for index, (negotiation_id, name, user_id, payload) in enumerate(actions):
+			if negotiation_id in hagglers:
+				haggler = hagglers[negotiation_id]
+			else:
+				haggler = hagglers[negotiation_id] = self.get(negotiation_id)
+			action = action_codes.get(name)
+
+			if haggler is None:
+				result = RESULT_UNKNOWN_NEGOTIATION
+			elif action is None:
+				result = RESULT_UNKNOWN_ACTION
+			else:
+				result = haggler._apply(action, user_id, payload)
+
+			if result:
+				results[index] = result
+				if errors == ERRORS_RETURN:
+					rejections.add(action, result)
+					continue
+				try:
+					self._rejectBatched(haggler, result, action, name, negotiation_id, user_id, payload)
+				except HagglingError as error:
+					raise BatchError(error, index, results[:index + 1]) from error
+				continue
+
+			if wal is not None:
+				wal.append((action, negotiation_id, user_id, payload))
+			if recording:
+				self._record(negotiation_id, haggler, action, user_id)
+			if ACTION_ENDS[action]:
+				self._ended(negotiation_id, haggler, user_id)
+				hagglers[negotiation_id] = self.get(negotiation_id)
+
+		return results
+
+	def _rejectBatched(self, haggler, result, action, name, negotiation_id, user_id, payload):
+		"""
+		Counts and reports an action of applyBatch rejected with result code result,
+		as its action method would.
+		"""
+		if result == RESULT_UNKNOWN_NEGOTIATION:
+			rejections.add(action, result)
+			_reportError(self.errors, result, "Error: negotiation {0} is not in this HagglerPool.", negotiation_id)
+		elif result == RESULT_UNKNOWN_ACTION:
+			rejections.add(action, result)
+			_reportError(self.errors, result, "Error: {0!r} is not a Haggler action.", name)
+		else:
+			haggler._reject(result, action, user_id,
+				payload[0] if action == ACTION_SUBMIT else None,
+				payload if action == ACTION_UPDATE_PRIVATE_DATA else None)
+
+	def get(self, negotiation_id):
+		"""
+		Returns the Haggler for a negotiation, open or archived.
+		
+		Args:
+		    negotiation_id (hashable): id of the negotiation
+		
+		Returns:
+		    Haggler: the Haggler, or None if negotiation_id is unknown
+		"""
+		haggler = self.hagglers.get(negotiation_id)
+		if haggler is None and self.on_end == "archive":
+			haggler = self.archive.get(negotiation_id)
+		return haggler
+
+	def openNegotiations(self, user_id):
+		"""
+		Returns the ids of the open negotiations user_id is part of.
+		
+		Args:
+		    user_id (string): id of the user
+		
+		Returns:
+		    set: open negotiation ids
+		"""
+		with self.lock:
+			return set(self.open_by_user.get(user_id, ()))
+
+	def query(self, product=None, state=None, user_id=None, price=None, full_price=None):
+		"""
+		Returns the ids of the open negotiations matching every filter given, from the
+		NegotiationIndex. See NegotiationIndex.query for the filters.
+		
+		Returns:
+		    set: open negotiation ids
+		
+		Raises:
+		    ValueError: if the pool was made without indexed=True, or state is unknown
+		"""
+		if self.index is None:
+			raise ValueError("query needs a HagglerPool made with indexed=True")
+		with self.lock:
+			return self.index.query(product, state, user_id, price, full_price)
+
+	def expire(self, now=None):
+		"""
+		Fires the deadlines of the ExpiryScheduler that have passed. Each expired offer
+		is withdrawn by the user who made it, then each idle negotiation is cancelled
+		by its first user able to. The actions are taken in one batch, so they are
+		logged, journaled and published like any other, and a deadline that lost a
+		race with another action is only counted in rejections, whatever the errors
+		mode. The WriteAheadLog is
+		then ticked, so calling expire regularly also bounds how long records wait
+		to be committed.
+		
+		Args:
+		    now (float): time in the scheduler's clock seconds, its current time if None
+		
+		Returns:
+		    list: (negotiation_id, user_id, ACTION_* code) of each action taken
+		
+		Raises:
+		    ValueError: if the pool was made without an ExpiryScheduler
+		"""
+		if self.expiry is None:
+			raise ValueError("expire needs a HagglerPool made with an ExpiryScheduler")
+		with self.lock:
+			offers, idle = self.expiry.due(now)
+
+		actions = []
+		hagglers = self.hagglers
+		for negotiation_ids, action in ((offers, ACTION_WITHDRAW), (idle, ACTION_CANCEL)):
+			transitions = TRANSITIONS[action]
+			for negotiation_id in negotiation_ids:
+				haggler = hagglers.get(negotiation_id)
+				if haggler is None:
+					continue
+				if self.threadsafe:
+					haggler = haggler.view
+				for user_id, user in haggler.users.items():
+					if transitions[user.state_code] is not None:
+						actions.append((negotiation_id, ACTION_METHODS[action], user_id, None))
+						break
+
+		results = self._applyBatch(actions, ERRORS_RETURN)
+		if self.wal is not None:
+			self.wal.tick()
+		return [(negotiation_id, user_id, ACTION_CODES[action])
+			for (negotiation_id, action, user_id, _), result in zip(actions, results) if result == RESULT_OK]
+
+	def flush(self):
+		"""
+		Commits the records the WriteAheadLog has buffered, so every action taken so
+		far survives a crash. Does nothing without a log.
+		"""
+		if self.wal is not None:
+			self.wal.commit()
+
+	def _indexUsers(self, negotiation_id, haggler):
+		open_by_user = self.open_by_user
+		for user_id in haggler.users:
+			user_open = open_by_user.get(user_id)
+			if user_open is None:
+				open_by_user[user_id] = {negotiation_id}
+			else:
+				user_open.add(negotiation_id)
+		if self.index is not None:
+			self.index.update(negotiation_id, haggler)
+		if self.expiry is not None:
+			self.expiry.arm(negotiation_id, haggler)
+
+	def _finish(self, negotiation_id, haggler):
+		"""
+		Removes a negotiation that has reached an end state from the open indexes, then
+		archives or evicts it.
+		"""
+		with self.lock:
+			del self.hagglers[negotiation_id]
+			open_by_user = self.open_by_user
+			for user_id in haggler.users:
+				user_open = open_by_user.get(user_id)
+				if user_open is not None:
+					user_open.discard(negotiation_id)
+					if not user_open:
+						del open_by_user[user_id]
+			if self.index is not None:
+				self.index.remove(negotiation_id)
+			if self.expiry is not None:
+				self.expiry.disarm(negotiation_id)
+
+			if self.on_end == "archive":
+				self.archive[negotiation_id] = haggler
+			else:
+				self.evicted += 1
+
+	def _haggler(self, negotiation_id, action=None):
+		"""
+		Returns the Haggler for negotiation_id, or reports the error and returns None.
+		If action (an ACTION_* code) is given the rejection is counted.
+		"""
+		haggler = self.get(negotiation_id)
+		if haggler is None:
+			if action is not None:
+				rejections.add(action, RESULT_UNKNOWN_NEGOTIATION)
+			_reportError(self.errors, RESULT_UNKNOWN_NEGOTIATION,
+				"Error: negotiation {0} is not in this HagglerPool.", negotiation_id)
+		return haggler
+
+	def _record(self, negotiation_id, haggler, action, user_id):
+		"""
+		Adds the versions a successful action added - one for the acting user on
+		UpdatePrivateData, otherwise one for each user - to the journal and the feed,
+		and reindexes the negotiation and re-arms its deadlines after any other action.
+		"""
+		if self.index is not None and action != ACTION_UPDATE_PRIVATE_DATA and negotiation_id in self.hagglers:
+			with self.lock:
+				self.index.update(negotiation_id, haggler.view if self.threadsafe else haggler)
+		if self.expiry is not None and action != ACTION_UPDATE_PRIVATE_DATA and not ACTION_ENDS[action]:
+			with self.lock:
+				# a late record of an earlier action must not arm a finished negotiation
+				if negotiation_id in self.hagglers:
+					self.expiry.arm(negotiation_id, haggler.view if self.threadsafe else haggler)
+		users = haggler.users
+		changed = (user_id,) if action == ACTION_UPDATE_PRIVATE_DATA else tuple(users)
+		journal = self.journal
+		if journal is not None:
+			for journal_user in changed:
+				entries = journal.get(journal_user)
+				if entries is None:
+					entries = journal.setdefault(journal_user, [])
+				entries.append((negotiation_id, users[journal_user].curr_version - 1))
+		if self.feed is not None:
+			self.feed.publish(negotiation_id, haggler, changed)
+
+	def _ended(self, negotiation_id, haggler, user_id):
+		# only Accept and Cancel end a negotiation, and both end it for both users
+		if negotiation_id in self.hagglers:
+			user = haggler.users.get(user_id)
+			if user is not None and user.end:
+				self._finish(negotiation_id, haggler)
+
+	def submit(self, negotiation_id, user_id, other_id, offer):
+		"""
+		Haggler.submit for the negotiation with id negotiation_id.
+		"""
+		haggler = self._haggler(negotiation_id, ACTION_SUBMIT)
+		if haggler is None:
+			return RESULT_UNKNOWN_NEGOTIATION
+		result = haggler.submit(user_id, other_id, offer)
+		if result == RESULT_OK:
+			if self.wal is not None:
+				self.wal.append((ACTION_SUBMIT, negotiation_id, user_id, (other_id, offer)))
+			if self._recording:
+				self._record(negotiation_id, haggler, ACTION_SUBMIT, user_id)
+		return result
+
+	def accept(self, negotiation_id, user_id):
+		"""
+		Haggler.accept for the negotiation with id negotiation_id. The negotiation is
+		archived or evicted if the offer is accepted.
+		"""
+		haggler = self._haggler(negotiation_id, ACTION_ACCEPT)
+		if haggler is None:
+			return RESULT_UNKNOWN_NEGOTIATION
+		result = haggler.accept(user_id)
+		if result == RESULT_OK:
+			if self.wal is not None:
+				self.wal.append((ACTION_ACCEPT, negotiation_id, user_id, None))
+			if self._recording:
+				self._record(negotiation_id, haggler, ACTION_ACCEPT, user_id)
+			self._ended(negotiation_id, haggler, user_id)
+		return result
+
+	def cancel(self, negotiation_id, user_id):
+		"""
+		Haggler.cancel for the negotiation with id negotiation_id. The negotiation is
+		archived or evicted if it is cancelled.
+		"""
+		haggler = self._haggler(negotiation_id, ACTION_CANCEL)
+		if haggler is None:
+			return RESULT_UNKNOWN_NEGOTIATION
+		result = haggler.cancel(user_id)
+		if result == RESULT_OK:
+			if self.wal is not None:
+				self.wal.append((ACTION_CANCEL, negotiation_id, user_id, None))
+			if self._recording:
+				self._record(negotiation_id, haggler, ACTION_CANCEL, user_id)
+			self._ended(negotiation_id, haggler, user_id)
+		return result
+
+	def withdraw(self, negotiation_id, user_id):
+		"""
+		Haggler.withdraw for the negotiation with id negotiation_id.
+		"""
+		haggler = self._haggler(negotiation_id, ACTION_WITHDRAW)
+		if haggler is None:
+			return RESULT_UNKNOWN_NEGOTIATION
+		result = haggler.withdraw(user_id)
+		if result == RESULT_OK:
+			if self.wal is not None:
+				self.wal.append((ACTION_WITHDRAW, negotiation_id, user_id, None))
+			if self._recording:
+				self._record(negotiation_id, haggler, ACTION_WITHDRAW, user_id)
+		return result
+
+	def proposeUpdate(self, negotiation_id, user_id, offer):
+		"""
+		Haggler.proposeUpdate for the negotiation with id negotiation_id.
+		"""
+		haggler = self._haggler(negotiation_id, ACTION_PROPOSE_UPDATE)
+		if haggler is None:
+			return RESULT_UNKNOWN_NEGOTIATION
+		result = haggler.proposeUpdate(user_id, offer)
+		if result == RESULT_OK:
+			if self.wal is not None:
+				self.wal.append((ACTION_PROPOSE_UPDATE, negotiation_id, user_id, offer))
+			if self._recording:
+				self._record(negotiation_id, haggler, ACTION_PROPOSE_UPDATE, user_id)
+		return result
+
+	def updatePrivateData(self, negotiation_id, user_id, private_info):
+		"""
+		Haggler.updatePrivateData for the negotiation with id negotiation_id. Also
+		works for archived negotiations.
+		"""
+		haggler = self._haggler(negotiation_id, ACTION_UPDATE_PRIVATE_DATA)
+		if haggler is None:
+			return RESULT_UNKNOWN_NEGOTIATION
+		result = haggler.updatePrivateData(user_id, private_info)
+		if result == RESULT_OK:
+			if self.wal is not None:
+				self.wal.append((ACTION_UPDATE_PRIVATE_DATA, negotiation_id, user_id, private_info))
+			if self._recording:
+				self._record(negotiation_id, haggler, ACTION_UPDATE_PRIVATE_DATA, user_id)
+		return result
+
+	def printHistory(self, negotiation_id, user_id):
+		"""
+		Haggler.printHistory for the negotiation with id negotiation_id.
+		"""
+		haggler = self._haggler(negotiation_id)
+		if haggler is not None:
+			haggler.printHistory(user_id)
+
+	def historySince(self, user_id, cursor=0):
+		"""
+		Returns the versions added to the offer histories of user_id, in any of their
+		negotiations, since cursor, and the cursor to pass next time. Only the journal
+		entries after cursor are read, so polling costs O(new versions). Versions of
+		negotiations that have since been evicted are skipped. In a threadsafe pool,
+		concurrent actions on one negotiation may be journaled out of version order.
+		
+		The journal is kept in memory only. A pool recovered from its WriteAheadLog
+		rebuilds the same journal, a restored snapshot starts a new one.
+		
+		Args:
+		    user_id (string): id of the user
+		    cursor (int): cursor returned by the previous call, or 0
+		
+		Returns:
+		    tuple: (list of (negotiation_id, Offer), new cursor)
+		
+		Raises:
+		    ValueError: if the pool was created without journal, or cursor is negative
+		"""
+		if self.journal is None:
+			raise ValueError("historySince needs a HagglerPool created with journal=True")
+		if cursor < 0:
+			raise ValueError("cursor must be >= 0, not {0!r}".format(cursor))
+		entries = self.journal.get(user_id, ())
+		end = len(entries)
+		versions = []
+		haggler = last_id = None
+		for index in range(cursor, end):
+			negotiation_id, version = entries[index]
+			if negotiation_id != last_id or haggler is None:
+				last_id = negotiation_id
+				haggler = self.get(negotiation_id)
+			if haggler is not None:
+				versions.append((negotiation_id, haggler.users[user_id].offer_history[version - 1]))
+		return versions, max(cursor, end)
+
+	def _hagglersOf(self, negotiation_ids):
+		"""
+		Generator of (negotiation_id, Haggler) for the negotiations in negotiation_ids,
+		with a HagglerView in place of a ThreadSafeHaggler. None means every
+		negotiation, open then archived, as of the first step.
+		"""
+		if negotiation_ids is None:
+			with self.lock:
+				negotiation_ids = list(self.hagglers)
+				if self.on_end == "archive":
+					negotiation_ids.extend(self.archive)
+		for negotiation_id in negotiation_ids:
+			haggler = self._haggler(negotiation_id)
+			if haggler is None:
+				continue
+			if isinstance(haggler, ThreadSafeHaggler):
+				haggler = haggler.view
+			yield negotiation_id, haggler
+
+	def _histories(self, negotiation_ids, user_ids):
+		"""
+		Generator of (negotiation_id, user_id, offer_history) for the users in user_ids
+		(all users if None) of the negotiations in negotiation_ids, see _hagglersOf.
+		"""
+		for negotiation_id, haggler in self._hagglersOf(negotiation_ids):
+			users = haggler.users
+			for user_id in (users if user_ids is None else user_ids):
+				user = users.get(user_id)
+				if user is not None:
+					yield negotiation_id, user_id, user.offer_history
+
+	def _historiesLines(self, histories, format):
+		if format == EXPORT_CSV:
+			yield from _historyLines((), format, True, (("negotiation_id", None),))
+		for negotiation_id, user_id, history in histories:
+			if format == EXPORT_TABLE:
+				yield "Negotiation {0}, user {1}\n".format(negotiation_id, user_id)
+				yield from _historyLines(history, format, True)
+				yield "\n"
+			else:
+				yield from _historyLines(history, format, False, (("negotiation_id", negotiation_id),))
+
+	def iterHistories(self, format=EXPORT_TABLE, negotiation_ids=None, user_ids=None):
+		"""
+		Returns an iterator over the export lines of many offer histories, see
+		Haggler.iterHistory. CSV and JSONL rows start with a negotiation_id field; in the
+		table format each history is a printHistory table under a title line.
+		
+		Args:
+		    format (string): one of EXPORT_FORMATS
+		    negotiation_ids (iterable): negotiations to export, None for all of them
+		    user_ids (iterable): users to export from each negotiation, None for both
+		
+		Returns:
+		    iterator: lines ending in a newline
+		
+		Raises:
+		    ValueError: if format is not one of EXPORT_FORMATS
+		"""
+		_exportFormatter(format)
+		return self._historiesLines(self._histories(negotiation_ids, user_ids), format)
+
+	def exportHistories(self, file, format=EXPORT_TABLE, negotiation_ids=None, user_ids=None):
+		"""
+		Writes many offer histories to a file-like object, see iterHistories. Lines are
+		produced as they are written, so memory use stays bounded however many versions
+		are exported.
+		
+		Args:
+		    file (file-like): text stream with a write method
+		    format (string): one of EXPORT_FORMATS
+		    negotiation_ids (iterable): negotiations to export, None for all of them
+		    user_ids (iterable): users to export from each negotiation, None for both
+		
+		Returns:
+		    int: number of versions written
+		
+		Raises:
+		    ValueError: if format is not one of EXPORT_FORMATS
+		"""
+		_exportFormatter(format)
+		versions = [0]
+
+		def counted(histories):
+			for history in histories:
+				versions[0] += len(history[2])
+				yield history
+
+		_writeLines(file, self._historiesLines(counted(self._histories(negotiation_ids, user_ids)), format))
+		return versions[0]
+
+	def historyArrays(self, negotiation_ids=None, user_ids=None):
+		"""
+		Returns many offer histories as NumPy arrays for analytics, see HistoryArrays.
+		Needs NumPy.
+		
+		Args:
+		    negotiation_ids (iterable): negotiations to include, None for all of them
+		    user_ids (iterable): users to include from each negotiation, None for both
+		
+		Returns:
+		    HistoryArrays: the versions of every history
+		
+		Raises:
+		    ImportError: if NumPy is not installed
+		"""
+		return _historyArrays(self._hagglersOf(negotiation_ids), user_ids)
+
+	def printVersion(self, negotiation_id, user_id, version):
+		"""
+		Haggler.printVersion for the negotiation with id negotiation_id.
+		"""
+		haggler = self._haggler(negotiation_id)
+		if haggler is not None:
+			haggler.printVersion(user_id, version)
+
+	def returnVersion(self, negotiation_id, user_id, version):
+		"""
+		Haggler.returnVersion for the negotiation with id negotiation_id.
+		"""
+		haggler = self._haggler(negotiation_id)
+		if haggler is not None:
+			return haggler.returnVersion(user_id, version)
+
+	def versionDifferences(self, negotiation_id, user_id, v1, v2):
+		"""
+		Haggler.versionDifferences for the negotiation with id negotiation_id.
+		"""
+		haggler = self._haggler(negotiation_id)
+		if haggler is not None:
+			return haggler.versionDifferences(user_id, v1, v2)
+		return({})
+
+	def consecutiveDifferences(self, negotiation_id, user_id):
+		"""
+		Haggler.consecutiveDifferences for the negotiation with id negotiation_id.
+		"""
+		haggler = self._haggler(negotiation_id)
+		if haggler is not None:
+			return haggler.consecutiveDifferences(user_id)
+		return []
+
+	def versionsAt(self, negotiation_id, step):
+		"""
+		Haggler.versionsAt for the negotiation with id negotiation_id.
+		"""
+		haggler = self._haggler(negotiation_id)
+		if haggler is not None:
+			return haggler.versionsAt(step)
+		return {}
+
+	def jointState(self, negotiation_id, step):
+		"""
+		Haggler.jointState for the negotiation with id negotiation_id.
+		"""
+		haggler = self._haggler(negotiation_id)
+		if haggler is not None:
+			return haggler.jointState(step)
+		return {}
+
+	def stepOf(self, negotiation_id, user_id, version):
+		"""
+		Haggler.stepOf for the negotiation with id negotiation_id.
+		"""
+		haggler = self._haggler(negotiation_id)
+		if haggler is not None:
+			return haggler.stepOf(user_id, version)
+
+	def mapVersion(self, negotiation_id, user_id, version):
+		"""
+		Haggler.mapVersion for the negotiation with id negotiation_id.
+		"""
+		haggler = self._haggler(negotiation_id)
+		if haggler is not None:
+			return haggler.mapVersion(user_id, version)
+
+
+class _NegotiationActor:
+
+	"""
+	Queue and worker task of one negotiation in an AsyncHagglerPool. pending counts
+	the calls queued or waiting for room in the queue.
+	"""
+
+	__slots__ = ("queue", "pending", "task")
+
+	def __init__(self, queue_size):
+		self.queue = asyncio.Queue(queue_size)
+		self.pending = 0
+		self.task = None
+
+
+class AsyncHagglerPool:
+
+	"""
+	asyncio front end to a HagglerPool.
+	
+	Each negotiation with calls in flight has an actor - a bounded queue and a task
+	that runs its calls one at a time in the order they were made. Calls on
+	different negotiations never wait for each other. A caller waits while the
+	negotiation's queue is full, which pushes back on clients sending faster than
+	the pool keeps up. An actor's task ends once its queue is drained, so idle
+	negotiations cost nothing.
+	
+	While the pool's WriteAheadLog has records buffered, a timer on the event loop
+	ticks it every group_interval seconds, so records are committed even when the
+	calls stop.
+	
+	Every method is a coroutine returning what the HagglerPool method returns. In
+	ERRORS_RAISE mode the exception is raised to the awaiting caller. A call whose
+	caller is cancelled after it was queued is still applied.
+	
+	    service = AsyncHagglerPool(errors="return")
+	    await service.create("deal-1", "Batman", "Superman")
+	    result = await service.submit("deal-1", "Superman", "Batman", Offer("Batmobile", 500, 5))
+	
+	Attributes:
+	    actors (dict): negotiation id -> _NegotiationActor for negotiations with calls in flight
+	    pool (HagglerPool): the pool the calls are applied to. Reading it directly
+	        sees every call applied so far.
+	    queue_size (int): maximum calls queued per negotiation
+	"""
+
+	def __init__(self, pool=None, queue_size=64, **kwargs):
+		"""
+		Args:
+		    pool (HagglerPool): pool to apply calls to. A new HagglerPool(**kwargs) if None.
+		    queue_size (int): maximum calls queued per negotiation, at least 1
+		    **kwargs: HagglerPool arguments used when pool is None
+		
+		Raises:
+		    ValueError: if queue_size is less than 1
+		"""
+		if queue_size < 1:
+			raise ValueError("queue_size must be at least 1, not {0!r}".format(queue_size))
+		self.pool = HagglerPool(**kwargs) if pool is None else pool
+		self.queue_size = queue_size
+		self.actors = {}
+		self._commit_timer = None
+
+	def _armCommit(self):
+		# ticks the log group_interval from now, while it has records buffered
+		wal = self.pool.wal
+		if wal is not None and wal.pending and self._commit_timer is None:
+			self._commit_timer = asyncio.get_running_loop().call_later(wal.group_interval, self._commitLog)
+
+	def _commitLog(self):
+		self._commit_timer = None
+		self.pool.wal.tick()
+		self._armCommit()
+
+	async def _call(self, negotiation_id, method, *args):
+		actor = self.actors.get(negotiation_id)
+		if actor is None:
+			actor = self.actors[negotiation_id] = _NegotiationActor(self.queue_size)
+			actor.task = asyncio.get_running_loop().create_task(self._run(negotiation_id, actor))
+
+		future = asyncio.get_running_loop().create_future()
+		actor.pending += 1
+		try:
+			await actor.queue.put((method, args, future))
+		except asyncio.CancelledError:
+			actor.pending -= 1
+			if not actor.pending:
+				actor.task.cancel()
+				del self.actors[negotiation_id]
+			raise
+		return await future
+
+	async def _run(self, negotiation_id, actor):
+		queue = actor.queue
+		while True:
+			method, args, future = await queue.get()
+			try:
+				result = method(negotiation_id, *args)
+			except Exception as e:
+				if not future.cancelled():
+					future.set_exception(e)
+			else:
+				if not future.cancelled():
+					future.set_result(result)
+			self._armCommit()
+
+			actor.pending -= 1
+			if not actor.pending:
+				del self.actors[negotiation_id]
+				return
+
+	async def join(self):
+		"""
+		Waits until every call made so far has been applied.
+		"""
+		while self.actors:
+			await asyncio.gather(*[actor.task for actor in list(self.actors.values())], return_exceptions=True)
+
+	async def create(self, negotiation_id, user_id_1, user_id_2):
+		"""
+		HagglerPool.create, queued behind earlier calls on negotiation_id.
+		"""
+		return await self._call(negotiation_id, self.pool.create, user_id_1, user_id_2)
+
+	async def submit(self, negotiation_id, user_id, other_id, offer):
+		"""
+		HagglerPool.submit, queued behind earlier calls on negotiation_id.
+		"""
+		return await self._call(negotiation_id, self.pool.submit, user_id, other_id, offer)
+
+	async def proposeUpdate(self, negotiation_id, user_id, offer):
+		"""
+		HagglerPool.proposeUpdate, queued behind earlier calls on negotiation_id.
+		"""
+		return await self._call(negotiation_id, self.pool.proposeUpdate, user_id, offer)
+
+	async def withdraw(self, negotiation_id, user_id):
+		"""
+		HagglerPool.withdraw, queued behind earlier calls on negotiation_id.
+		"""
+		return await self._call(negotiation_id, self.pool.withdraw, user_id)
+
+	async def accept(self, negotiation_id, user_id):
+		"""
+		HagglerPool.accept, queued behind earlier calls on negotiation_id.
+		"""
+		return await self._call(negotiation_id, self.pool.accept, user_id)
+
+	async def cancel(self, negotiation_id, user_id):
+		"""
+		HagglerPool.cancel, queued behind earlier calls on negotiation_id.
+		"""
+		return await self._call(negotiation_id, self.pool.cancel, user_id)
+
+	async def updatePrivateData(self, negotiation_id, user_id, private_info):
+		"""
+		HagglerPool.updatePrivateData, queued behind earlier calls on negotiation_id.
+		"""
+		return await self._call(negotiation_id, self.pool.updatePrivateData, user_id, private_info)
+
+	async def returnVersion(self, negotiation_id, user_id, version):
+		"""
+		HagglerPool.returnVersion, queued behind earlier calls on negotiation_id.
+		"""
+		return await self._call(negotiation_id, self.pool.returnVersion, user_id, version)
+
+	async def versionDifferences(self, negotiation_id, user_id, v1, v2):
+		"""
+		HagglerPool.versionDifferences, queued behind earlier calls on negotiation_id.
+		"""
+		return await self._call(negotiation_id, self.pool.versionDifferences, user_id, v1, v2)
+
+	async def consecutiveDifferences(self, negotiation_id, user_id):
+		"""
+		HagglerPool.consecutiveDifferences, queued behind earlier calls on negotiation_id.
+		"""
+		return await self._call(negotiation_id, self.pool.consecutiveDifferences, user_id)
+
+	async def versionsAt(self, negotiation_id, step):
+		"""
+		HagglerPool.versionsAt, queued behind earlier calls on negotiation_id.
+		"""
+		return await self._call(negotiation_id, self.pool.versionsAt, step)
+
+	async def jointState(self, negotiation_id, step):
+		"""
+		HagglerPool.jointState, queued behind earlier calls on negotiation_id.
+		"""
+		return await self._call(negotiation_id, self.pool.jointState, step)
+
+	async def stepOf(self, negotiation_id, user_id, version):
+		"""
+		HagglerPool.stepOf, queued behind earlier calls on negotiation_id.
+		"""
+		return await self._call(negotiation_id, self.pool.stepOf, user_id, version)
+
+	async def mapVersion(self, negotiation_id, user_id, version):
+		"""
+		HagglerPool.mapVersion, queued behind earlier calls on negotiation_id.
+		"""
+		return await self._call(negotiation_id, self.pool.mapVersion, user_id, version)
+
+
+# HagglerPool methods a ShardedHagglerPool worker runs, indexed by message op code
+_SHARD_METHODS = (
+	"create",
+	"createMany",
+	"applyBatch",
+	"submit",
+	"proposeUpdate",
+	"withdraw",
+	"accept",
+	"cancel",
+	"updatePrivateData",
+	"printHistory",
+	"printVersion",
+	"returnVersion",
+	"versionDifferences",
+	"consecutiveDifferences",
+	"versionsAt",
+	"jointState",
+	"stepOf",
+	"mapVersion",
+	"openNegotiations",
+	"query",
+	"expire",
+	"historySince",
+	"__len__",
+)
+_SHARD_OPS = {method: op for op, method in enumerate(_SHARD_METHODS)}
+
+
+def _shardOf(negotiation_id, shards):
+	"""
+	Returns the shard that owns negotiation_id. Uses crc32 rather than hash so every
+	process agrees.
+	"""
+	return zlib.crc32(repr(negotiation_id).encode("utf-8")) % shards
+
+
+def _shardMain(connection, kwargs):
+	"""
+	Worker process of a ShardedHagglerPool. Receives (op, args) messages, runs them on
+	its own HagglerPool and replies (True, result), or (False, exception) if one
+	was raised. None stops it.
+	"""
+	pool = HagglerPool(**kwargs)
+	methods = [getattr(pool, method) for method in _SHARD_METHODS]
+	while True:
+		message = connection.recv()
+		if message is None:
+			break
+		op, args = message
+		try:
+			result = methods[op](*args)
+		except Exception as e:
+			connection.send((False, e))
+		else:
+			connection.send((True, result))
+	connection.close()
+
+
+class ShardedHagglerPool:
+
+	"""
+	HagglerPool split across worker processes, so actions on different
+	negotiations use more than one core.
+	
+	Negotiations are hash partitioned - each is owned by one worker process
+	holding a HagglerPool. Calls are sent to the owning worker over a pipe as an
+	(op code, arguments) message and block for the reply. The action and query
+	methods have the same signatures as those of HagglerPool. openNegotiations asks
+	every worker and merges the answers. applyBatch and createMany split their
+	input by worker, so the workers run in parallel.
+	
+	A single call is a round trip to another process, slower than calling a
+	HagglerPool in process. The speed up comes from applyBatch, or from several
+	threads calling at once. Calls from different threads are serialised per worker.
+	
+	Errors are reported by the workers: printed from the worker process, or
+	returned, or raised again in the caller in "raise" mode. Rejections are
+	counted in each worker's rejections, not in this process.
+	
+	Attributes:
+	    connections (list): pipe to each worker
+	    locks (list): lock guarding each pipe
+	    processes (list): worker processes
+	    shards (int): number of workers
+	"""
+
+	def __init__(self, workers=None, context=None, **kwargs):
+		"""
+		Starts the worker processes.
+		
+		Args:
+		    workers (int): number of worker processes, os.cpu_count() if None
+		    context (string): multiprocessing start method, the platform default if None
+		    **kwargs: HagglerPool arguments for each worker's pool, except wal, archive,
+		        feed and retention
+		
+		Raises:
+		    ValueError: if workers is less than 1, or wal, archive, feed or retention is given
+		"""
+		if workers is None:
+			workers = os.cpu_count() or 1
+		if workers < 1:
+			raise ValueError("workers must be at least 1, not {0!r}".format(workers))
+		if "wal" in kwargs or "archive" in kwargs or "feed" in kwargs or "retention" in kwargs:
+			raise ValueError("each worker keeps its own pool - wal, archive, feed and retention cannot be shared")
+
+		context = multiprocessing.get_context(context)
+		self.shards = workers
+		self.connections = []
+		self.locks = []
+		self.processes = []
+		for _ in range(workers):
+			connection, worker_connection = context.Pipe()
+			process = context.Process(target=_shardMain, args=(worker_connection, kwargs), daemon=True)
+			process.start()
+			worker_connection.close()
+			self.connections.append(connection)
+			self.locks.append(threading.Lock())
+			self.processes.append(process)
+
+	def _call(self, shard, method, *args):
+		with self.locks[shard]:
+			connection = self.connections[shard]
+			connection.send((_SHARD_OPS[method], args))
+			ok, result = connection.recv()
+		if not ok:
+			raise result
+		return result
+
+	def _scatter(self, method, shard_args):
+		"""
+		Sends method with each shard's arguments, then gathers the replies.
+		
+		Args:
+		    method (string): HagglerPool method name
+		    shard_args (dict): shard -> argument tuple
+		
+		Returns:
+		    dict: shard -> result
+		"""
+		replies = self._gather(method, shard_args)
+		for ok, result in replies.values():
+			if not ok:
+				raise result
+		return {shard: result for shard, (_, result) in replies.items()}
+
+	def _gather(self, method, shard_args):
+		"""
+		Sends method with each shard's arguments, then returns shard -> (ok, result or
+		exception) for each reply.
+		"""
+		op = _SHARD_OPS[method]
+		shards = sorted(shard_args)
+		for shard in shards:
+			self.locks[shard].acquire()
+		try:
+			for shard in shards:
+				self.connections[shard].send((op, shard_args[shard]))
+			return {shard: self.connections[shard].recv() for shard in shards}
+		finally:
+			for shard in shards:
+				self.locks[shard].release()
+
+	def shardOf(self, negotiation_id):
+		"""
+		Returns the index of the worker that owns negotiation_id.
+		"""
+		return _shardOf(negotiation_id, self.shards)
+
+	def create(self, negotiation_id, user_id_1, user_id_2):
+		"""
+		HagglerPool.create on the owning worker. Returns True if the negotiation was
+		created, as the Haggler itself stays in the worker.
+		"""
+		return self._call(_shardOf(negotiation_id, self.shards), "create", negotiation_id, user_id_1, user_id_2) is not None
+
+	def createMany(self, negotiations):
+		"""
+		HagglerPool.createMany, split by worker.
+		"""
+		split = {}
+		for negotiation in negotiations:
+			split.setdefault(_shardOf(negotiation[0], self.shards), []).append(negotiation)
+		return sum(self._scatter("createMany", {shard: (part,) for shard, part in split.items()}).values())
+
+	def applyBatch(self, actions):
+		"""
+		HagglerPool.applyBatch, split by worker. Each worker applies its share in
+		parallel with the others, in the order given.
+		
+		In "raise" mode a worker stops at its first rejected action, but the others
+		carry on, so actions given after the first rejection can still have been
+		applied by other workers. The BatchError raised is for the earliest rejection
+		given, with results for every action up to it.
+		"""
+		split = {}
+		for index, action in enumerate(actions):
+			part = split.get(_shardOf(action[0], self.shards))
+			if part is None:
+				part = split[_shardOf(action[0], self.shards)] = ([], [])
+			part[0].append(index)
+			part[1].append(action)
+
+		replies = self._gather("applyBatch", {shard: (part[1],) for shard, part in split.items()})
+		results = array("b", bytes(len(actions)))
+		first = None
+		for shard, (ok, reply) in replies.items():
+			if not ok and not isinstance(reply, BatchError):
+				raise reply
+			indexes = split[shard][0]
+			for index, result in zip(indexes, reply if ok else reply.results):
+				results[index] = result
+			if not ok and (first is None or indexes[reply.index] < first[0]):
+				first = (indexes[reply.index], reply.error)
+		if first is not None:
+			index, error = first
+			raise BatchError(error, index, results[:index + 1]) from error
+		return results
+
+	def openNegotiations(self, user_id):
+		"""
+		HagglerPool.openNegotiations, gathered from every worker.
+		"""
+		open_ids = set()
+		for part in self._scatter("openNegotiations", {shard: (user_id,) for shard in range(self.shards)}).values():
+			open_ids |= part
+		return open_ids
+
+	def query(self, product=None, state=None, user_id=None, price=None, full_price=None):
+		"""
+		HagglerPool.query, gathered from every worker. Needs indexed=True.
+		"""
+		args = (product, state, user_id, price, full_price)
+		matches = set()
+		for part in self._scatter("query", {shard: args for shard in range(self.shards)}).values():
+			matches |= part
+		return matches
+
+	def expire(self, now=None):
+		"""
+		HagglerPool.expire in every worker. Needs an ExpiryScheduler, whose clock each
+		worker calls itself unless now is given.
+		"""
+		taken = []
+		for part in self._scatter("expire", {shard: (now,) for shard in range(self.shards)}).values():
+			taken.extend(part)
+		return taken
+
+	def historySince(self, user_id, cursor=None):
+		"""
+		HagglerPool.historySince, gathered from every worker. Needs journal=True. The
+		cursor holds one HagglerPool cursor per worker, so versions are in journal order
+		per worker but not across workers.
+		
+		Args:
+		    user_id (string): id of the user
+		    cursor (tuple): cursor returned by the previous call, or None for everything
+		
+		Returns:
+		    tuple: (list of (negotiation_id, Offer), new cursor)
+		"""
+		if cursor is None:
+			cursor = (0,) * self.shards
+		replies = self._scatter("historySince", {shard: (user_id, cursor[shard]) for shard in range(self.shards)})
+		versions = []
+		for shard in range(self.shards):
+			versions.extend(replies[shard][0])
+		return versions, tuple(replies[shard][1] for shard in range(self.shards))
+
+	def __len__(self):
+		return sum(self._scatter("__len__", {shard: () for shard in range(self.shards)}).values())
+
+	def submit(self, negotiation_id, user_id, other_id, offer):
+		"""
+		HagglerPool.submit on the owning worker.
+		"""
+		return self._call(_shardOf(negotiation_id, self.shards), "submit", negotiation_id, user_id, other_id, offer)
+
+	def proposeUpdate(self, negotiation_id, user_id, offer):
+		"""
+		HagglerPool.proposeUpdate on the owning worker.
+		"""
+		return self._call(_shardOf(negotiation_id, self.shards), "proposeUpdate", negotiation_id, user_id, offer)
+
+	def withdraw(self, negotiation_id, user_id):
+		"""
+		HagglerPool.withdraw on the owning worker.
+		"""
+		return self._call(_shardOf(negotiation_id, self.shards), "withdraw", negotiation_id, user_id)
+
+	def accept(self, negotiation_id, user_id):
+		"""
+		HagglerPool.accept on the owning worker.
+		"""
+		return self._call(_shardOf(negotiation_id, self.shards), "accept", negotiation_id, user_id)
+
+	def cancel(self, negotiation_id, user_id):
+		"""
+		HagglerPool.cancel on the owning worker.
+		"""
+		return self._call(_shardOf(negotiation_id, self.shards), "cancel", negotiation_id, user_id)
+
+	def updatePrivateData(self, negotiation_id, user_id, private_info):
+		"""
+		HagglerPool.updatePrivateData on the owning worker.
+		"""
+		return self._call(_shardOf(negotiation_id, self.shards), "updatePrivateData", negotiation_id, user_id, private_info)
+
+	def printHistory(self, negotiation_id, user_id):
+		"""
+		HagglerPool.printHistory on the owning worker, which prints it.
+		"""
+		return self._call(_shardOf(negotiation_id, self.shards), "printHistory", negotiation_id, user_id)
+
+	def printVersion(self, negotiation_id, user_id, version):
+		"""
+		HagglerPool.printVersion on the owning worker, which prints it.
+		"""
+		return self._call(_shardOf(negotiation_id, self.shards), "printVersion", negotiation_id, user_id, version)
+
+	def returnVersion(self, negotiation_id, user_id, version):
+		"""
+		HagglerPool.returnVersion on the owning worker. Returns a copy of the Offer.
+		"""
+		return self._call(_shardOf(negotiation_id, self.shards), "returnVersion", negotiation_id, user_id, version)
+
+	def versionDifferences(self, negotiation_id, user_id, v1, v2):
+		"""
+		HagglerPool.versionDifferences on the owning worker.
+		"""
+		return self._call(_shardOf(negotiation_id, self.shards), "versionDifferences", negotiation_id, user_id, v1, v2)
+
+	def consecutiveDifferences(self, negotiation_id, user_id):
+		"""
+		HagglerPool.consecutiveDifferences on the owning worker.
+		"""
+		return self._call(_shardOf(negotiation_id, self.shards), "consecutiveDifferences", negotiation_id, user_id)
+
+	def versionsAt(self, negotiation_id, step):
+		"""
+		HagglerPool.versionsAt on the owning worker.
+		"""
+		return self._call(_shardOf(negotiation_id, self.shards), "versionsAt", negotiation_id, step)
+
+	def jointState(self, negotiation_id, step):
+		"""
+		HagglerPool.jointState on the owning worker.
+		"""
+		return self._call(_shardOf(negotiation_id, self.shards), "jointState", negotiation_id, step)
+
+	def stepOf(self, negotiation_id, user_id, version):
+		"""
+		HagglerPool.stepOf on the owning worker.
+		"""
+		return self._call(_shardOf(negotiation_id, self.shards), "stepOf", negotiation_id, user_id, version)
+
+	def mapVersion(self, negotiation_id, user_id, version):
+		"""
+		HagglerPool.mapVersion on the owning worker.
+		"""
+		return self._call(_shardOf(negotiation_id, self.shards), "mapVersion", negotiation_id, user_id, version)
+
+	def close(self):
+		"""
+		Stops the worker processes. Their negotiations are lost.
+		"""
+		for shard, connection in enumerate(self.connections):
+			with self.locks[shard]:
+				try:
+					connection.send(None)
+				except (BrokenPipeError, OSError):
+					pass
+				connection.close()
+		for process in self.processes:
+			process.join()
+
+	def __enter__(self):
+		return self
+
+	def __exit__(self, *exc_info):
+		self.close()
+
+
+# upper bounds in seconds of the latency histogram buckets, the last catches the rest
+LATENCY_BUCKETS = (
+	1e-6, 2e-6, 5e-6,
+	1e-5, 2e-5, 5e-5,
+	1e-4, 2e-4, 5e-4,
+	1e-3, 1e-2, 1e-1,
+	1.0, float("inf"),
+)
+
+
+class Histogram:
+
+	"""
+	Counts of observed values in fixed buckets, plus their sum and count.
+	
+	Attributes:
+	    bounds (tuple): upper bound of each bucket, ascending and ending with inf
+	    count (int): number of values observed
+	    counts (list): number of values in each bucket
+	    total (float): sum of the values observed
+	"""
+
+	__slots__ = ("bounds", "counts", "total", "count")
+
+	def __init__(self, bounds=LATENCY_BUCKETS):
+		self.bounds = bounds
+		self.counts = [0] * len(bounds)
+		self.total = 0.0
+		self.count = 0
+
+	def observe(self, value):
+		self.counts[bisect_left(self.bounds, value)] += 1
+		self.total += value
+		self.count += 1
+
+	def cumulative(self):
+		"""
+		Returns (bound, number of values <= bound) for each bucket.
+		"""
+		running = 0
+		buckets = []
+		for bound, n in zip(self.bounds, self.counts):
+			running += n
+			buckets.append((bound, running))
+		return buckets
+
+	def asDict(self):
+		"""
+		Returns {"buckets": {bound: cumulative count}, "sum": total, "count": count}.
+		"""
+		return {"buckets": dict(self.cumulative()), "sum": self.total, "count": self.count}
+
+
+class Metrics:
+
+	"""
+	Opt in instrumentation of Hagglers, shared by every Haggler in the process
+	through the module level metrics instance.
+	
+	enable() wraps the Haggler action cores, and the serialising methods of
+	WriteAheadLog, HagglerPool and ColumnarArchive, in timing wrappers. disable()
+	puts the originals back, so while disabled nothing at all is added to the hot
+	path. Rejections are always counted in rejections, which the exports include.
+	
+	The gauges are read from the Hagglers tracked: those seen opened by a Submit
+	while enabled, or passed to enable(), until they are evicted by a HagglerPool,
+	stored in a ColumnarArchive or garbage collected. live_negotiations counts the
+	tracked Hagglers not yet accepted or cancelled, so a re-Submit or an end it
+	never saw open leave it unchanged. history_versions is the versions the tracked
+	histories hold in memory, not counting those a HistoryRetention has spilled,
+	and largest_history the most versions in one of their Users' histories. Both
+	are worked out when read, in time linear in the Hagglers tracked.
+	
+	Attributes:
+	    actions (list): Histogram of action latency in seconds, by ACTION_* code
+	    enabled (bool): whether the wrappers are installed
+	    history_versions (int): versions held in memory by the tracked histories
+	    largest_history (int): most versions in one tracked User's history
+	    live_negotiations (int): tracked negotiations not yet accepted or cancelled
+	    serialization (dict): name -> Histogram of seconds spent serialising - "wal_append",
+	        "snapshot", "restore" and "archive_store"
+	"""
+
+	def __init__(self):
+		self.enabled = False
+		self._originals = []
+		self.reset()
+
+	def reset(self):
+		"""
+		Sets every histogram and gauge back to zero. Rejection counts are reset with
+		rejections.reset().
+		"""
+		self.actions = [Histogram() for _ in ACTIONS]
+		self.serialization = {
+			name: Histogram() for name in ("wal_append", "snapshot", "restore", "archive_store")}
+		self._tracked = weakref.WeakSet()
+		self._live = weakref.WeakSet()
+
+	@property
+	def live_negotiations(self):
+		return len(self._live)
+
+	def _histories(self):
+		# copied, as garbage collection can drop Hagglers from the set while it is read
+		return [user.offer_history for haggler in list(self._tracked) for user in haggler.users.values()]
+
+	@property
+	def history_versions(self):
+		return sum(
+			len(history.hot) if type(history) is _SpilledHistory else len(history)
+			for history in self._histories())
+
+	@property
+	def largest_history(self):
+		return max(map(len, self._histories()), default=0)
+
+	def _counted(self, action, haggler):
+		# called after a two sided action succeeds
+		if action == ACTION_SUBMIT:
+			self._tracked.add(haggler)
+			self._live.add(haggler)
+		elif ACTION_ENDS[action]:
+			self._live.discard(haggler)
+
+	def _released(self, pool, haggler):
+		# called after pool finishes a negotiation, which may take it out of memory
+		if pool.on_end == "evict" or isinstance(pool.archive, ColumnarArchive):
+			self._tracked.discard(haggler)
+
+	def _wrappers(self):
+		"""
+		Returns (class, attribute name, wrapper) for each method enable() replaces.
+		"""
+		clock = time.perf_counter
+		actions = self.actions
+		counted = self._counted
+		released = self._released
+		submit = Haggler._submit
+		transition = Haggler._transition
+		update_private_data = Haggler._updatePrivateData
+
+		def _submit(haggler, user_id, other_id, offer):
+			start = clock()
+			result = submit(haggler, user_id, other_id, offer)
+			actions[ACTION_SUBMIT].observe(clock() - start)
+			if result == RESULT_OK:
+				counted(ACTION_SUBMIT, haggler)
+			return result
+
+		def _transition(haggler, action, user_id, offer=None):
+			start = clock()
+			result = transition(haggler, action, user_id, offer)
+			actions[action].observe(clock() - start)
+			if result == RESULT_OK:
+				counted(action, haggler)
+			return result
+
+		def _updatePrivateData(haggler, user_id, private_info):
+			start = clock()
+			result = update_private_data(haggler, user_id, private_info)
+			actions[ACTION_UPDATE_PRIVATE_DATA].observe(clock() - start)
+			return result
+
+		finish = HagglerPool._finish
+
+		def _finish(pool, negotiation_id, haggler):
+			finish(pool, negotiation_id, haggler)
+			released(pool, haggler)
+
+		def serializing(name, method):
+			histogram = self.serialization[name]
+
+			def timed(*args, **kwargs):
+				start = clock()
+				try:
+					return method(*args, **kwargs)
+				finally:
+					histogram.observe(clock() - start)
+			return timed
+
+		return [
+			(Haggler, "_submit", _submit),
+			(Haggler, "_transition", _transition),
+			(Haggler, "_updatePrivateData", _updatePrivateData),
+			(HagglerPool, "_finish", _finish),
+			(WriteAheadLog, "append", serializing("wal_append", WriteAheadLog.append)),
+			(HagglerPool, "snapshot", serializing("snapshot", HagglerPool.snapshot)),
+			(HagglerPool, "restore", classmethod(serializing("restore", HagglerPool.restore.__func__))),
+			(ColumnarArchive, "__setitem__", serializing("archive_store", ColumnarArchive.__setitem__)),
+		]
+
+	def enable(self, hagglers=()):
+		"""
+		Starts collecting metrics. Does nothing if already enabled.
+		
+		Args:
+		    hagglers (iterable): Hagglers that may already be negotiating, e.g.
+		        pool.hagglers.values(), to track in the gauges
+		"""
+		if self.enabled:
+			return
+		for haggler in hagglers:
+			users = haggler.users.values()
+			if any(user.state_code != STATE_NONE for user in users):
+				self._tracked.add(haggler)
+				if not any(user.end for user in users):
+					self._live.add(haggler)
+		for cls, name, wrapper in self._wrappers():
+			self._originals.append((cls, name, cls.__dict__[name]))
+			setattr(cls, name, wrapper)
+		self.enabled = True
+
+	def disable(self):
+		"""
+		Stops collecting metrics, keeping those collected so far.
+		"""
+		for cls, name, original in self._originals:
+			setattr(cls, name, original)
+		self._originals = []
+		self.enabled = False
+
+	def asDict(self):
+		"""
+		Returns every metric as plain dicts, numbers and strings.
+		
+		Returns:
+		    dict: {"actions": {action name: histogram}, "rejections": {action name:
+		        {reason name: count}}, "gauges": {name: value}, "serialization":
+		        {name: histogram}}, with histograms as in Histogram.asDict
+		"""
+		return {
+			"actions": {name: histogram.asDict() for name, histogram in zip(ACTIONS, self.actions)},
+			"rejections": rejections.asDict(),
+			"gauges": {
+				"live_negotiations": self.live_negotiations,
+				"history_versions": self.history_versions,
+				"largest_history": self.largest_history,
+			},
+			"serialization": {name: histogram.asDict() for name, histogram in self.serialization.items()},
+		}
+
+	def exposition(self):
+		"""
+		Returns every metric in the Prometheus text exposition format.
+		
+		Returns:
+		    string: metrics text, one sample per line
+		"""
+		lines = []
+
+		def histogram(metric, label, histograms):
+			lines.append("# TYPE {0} histogram".format(metric))
+			for value, h in histograms:
+				for bound, n in h.cumulative():
+					le = "+Inf" if bound == float("inf") else repr(bound)
+					lines.append('{0}_bucket{{{1}="{2}",le="{3}"}} {4}'.format(metric, label, value, le, n))
+				lines.append('{0}_sum{{{1}="{2}"}} {3!r}'.format(metric, label, value, h.total))
+				lines.append('{0}_count{{{1}="{2}"}} {3}'.format(metric, label, value, h.count))
+
+		histogram("haggling_action_seconds", "action", zip(ACTIONS, self.actions))
+
+		lines.append("# TYPE haggling_rejections_total counter")
+		for action, reasons in rejections.asDict().items():
+			for reason, n in reasons.items():
+				lines.append('haggling_rejections_total{{action="{0}",reason="{1}"}} {2}'.format(action, reason, n))
+
+		for name in ("live_negotiations", "history_versions", "largest_history"):
+			lines.append("# TYPE haggling_{0} gauge".format(name))
+			lines.append("haggling_{0} {1}".format(name, getattr(self, name)))
+
+		histogram("haggling_serialization_seconds", "operation", self.serialization.items())
+		return "\n".join(lines) + "\n"
 
 
+metrics = Metrics()
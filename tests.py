@@ -1,8 +1,24 @@
 #!/usr/bin/env python
 
+import asyncio
+import contextlib
+import csv
+import io
+import json
+import math
+import os
+import pickle
+import random
+import tempfile
+import threading
 import unittest
 from haggling import *
 
+try:
+	import numpy
+except ImportError:
+	numpy = None
+
 class TestOffer(unittest.TestCase):
 
 	def test_offer_correct(self):
@@ -20,6 +36,93 @@ class TestOffer(unittest.TestCase):
 		self.assertEqual(offer.quantity, params[2])
 		self.assertEqual(offer.private_info, None )
 
+	def test_offer_replace(self):
+		offer = Offer("jam", 100, 10)
+		new_offer = offer.replace(price=90, action="ProposeUpdate")
+		self.assertEqual(new_offer.price, 90)
+		self.assertEqual(new_offer.action, "ProposeUpdate")
+		self.assertEqual(new_offer.product, "jam")
+		# original is untouched
+		self.assertEqual(offer.price, 100)
+		self.assertEqual(offer.action, None)
+		self.assertEqual(list(vars(new_offer).keys()), list(Offer.__slots__))
+
+		with self.assertRaises(AttributeError):
+			offer.price = 50
+		with self.assertRaises(AttributeError):
+			offer.replace(colour="red")
+
+	def test_offer_shared_between_versions(self):
+		haggler = Haggler("Batman", "Superman")
+		haggler.submit("Superman", "Batman", Offer("Batmobile", 500, 5))
+		haggler.updatePrivateData("Superman", {"reference": "order123"})
+		haggler.withdraw("Superman")
+
+		v2 = haggler.returnVersion("Superman", 2)
+		v3 = haggler.returnVersion("Superman", 3)
+		self.assertIs(v2.private_info, v3.private_info)
+		self.assertIs(v2.product, v3.product)
+
+	def test_interned(self):
+		# ids and products made separately end up as one shared copy
+		product, user_id = "".join(["Bat", "mobile"]), "".join(["Super", "man"])
+		haggler = Haggler("Batman", user_id)
+		haggler.submit("Superman", "Batman", Offer(product, 500, 5))
+		other = Haggler("Robin", "Superman")
+		other.submit("Superman", "Robin", Offer("Batmobile", 400, 5))
+
+		offer = haggler.returnVersion("Batman", 1)
+		self.assertIs(offer.product, other.returnVersion("Robin", 1).product)
+		self.assertIs(offer.seller, other.users["Superman"].user_id)
+		self.assertIs(offer.state, STATES[STATE_AWAITING_MY_ACCEPTANCE])
+		self.assertEqual((offer.action_code, offer.state_code), (ACTION_SUBMIT, STATE_AWAITING_MY_ACCEPTANCE))
+		self.assertEqual(Offer("jam", 100, 10).action_code, None)
+
+
+class TestPrivateInfo(unittest.TestCase):
+
+	def test_merge_shares_unchanged(self):
+		info = PrivateInfo({"reference": "order123", "notes": "fragile"})
+		updated = info.merge({"reference": "order456", "pricing": [1, 2, 3]})
+
+		self.assertEqual(info, {"reference": "order123", "notes": "fragile"})
+		self.assertEqual(updated, {"reference": "order456", "notes": "fragile", "pricing": [1, 2, 3]})
+		self.assertEqual(len(updated), 3)
+		self.assertIs(updated["pricing"], updated.get("pricing"))
+		self.assertNotIn("pricing", info)
+
+		with self.assertRaises(TypeError):
+			updated["reference"] = "order789"
+
+	def test_values_copied(self):
+		pricing = [1, 2, 3]
+		haggler = Haggler("Batman", "Superman", errors="return")
+		haggler.submit("Superman", "Batman", Offer("Batmobile", 500, 5))
+		haggler.updatePrivateData("Batman", {"pricing": pricing, "reference": "order123"})
+		pricing.append(4)
+		haggler.updatePrivateData("Batman", {"reference": "order456"})
+
+		self.assertEqual(haggler.returnVersion("Batman", 2).private_info["pricing"], [1, 2, 3])
+		self.assertEqual(haggler.users["Batman"].private_info["pricing"], [1, 2, 3])
+		self.assertIsNot(haggler.users["Batman"].private_info["pricing"], pricing)
+
+	def test_many_keys(self):
+		info = PrivateInfo()
+		expected = {}
+		for i in range(2000):
+			info = info.set(i % 700, i)
+			expected[i % 700] = i
+		self.assertEqual(info, expected)
+		self.assertEqual(sorted(info), sorted(expected))
+
+	def test_equality_of_versions(self):
+		info = PrivateInfo({i: i for i in range(500)})
+		self.assertEqual(info.merge({7: 7}), info)
+		self.assertNotEqual(info.merge({7: 8}), info)
+		self.assertEqual(info.merge({7: 8}).merge({7: 7}), info)
+		self.assertNotEqual(info.merge({"new": 1}), info)
+		self.assertEqual(PrivateInfo({i: i for i in reversed(range(500))}), info)
+
 
 class TestDifferences(unittest.TestCase):
 
@@ -44,6 +147,32 @@ class TestDifferences(unittest.TestCase):
 		}
 		self.assertEqual(diffs, target_diffs)
 
+	def test_indexed_ranges(self):
+		for event_sourced in (False, True):
+			haggler = Haggler("Batman", "Superman", event_sourced, errors="return")
+			haggler.submit("Superman", "Batman", Offer("Batmobile", 500, 5))
+			# price changes and changes back, private_info changes twice
+			haggler.proposeUpdate("Batman", Offer("Batmobile", 550, 5))
+			haggler.updatePrivateData("Batman", {"reference": "order123"})
+			haggler.proposeUpdate("Superman", Offer("Batmobile", 500, 5))
+			haggler.updatePrivateData("Batman", {"reference": "order456"})
+			history = haggler.users["Batman"].offer_history
+
+			def full(v1, v2):
+				a, b = vars(history[v1 - 1]), vars(history[v2 - 1])
+				return {k: [a[k], b[k]] for k in a if a[k] != b[k]}
+
+			for v1 in range(1, 6):
+				for v2 in range(1, 6):
+					self.assertEqual(haggler.versionDifferences("Batman", v1, v2), full(v1, v2))
+			self.assertNotIn("price", haggler.versionDifferences("Batman", 1, 4))
+
+			# the index is extended by later actions
+			haggler.accept("Batman")
+			self.assertEqual(haggler.versionDifferences("Batman", 5, 6), full(5, 6))
+			self.assertEqual(haggler.consecutiveDifferences("Batman"), [full(v, v + 1) for v in range(1, 6)])
+			self.assertEqual(haggler.consecutiveDifferences("Joker"), [])
+
 
 class BatmanSuperman(unittest.TestCase):
 
@@ -199,5 +328,1274 @@ class BatmanSuperman(unittest.TestCase):
 		# check private info is being updated and not leaking into other versions in the history
 		self.assertNotEqual(buyer_v2.private_info, buyer_v3.private_info)
 
+class TestStateMachine(unittest.TestCase):
+
+	def test_can(self):
+		seller = "Batman"
+		buyer = "Superman"
+		haggler = Haggler(seller, buyer)
+		self.assertTrue(haggler.can(buyer, "submit"))
+		self.assertFalse(haggler.can(buyer, "cancel"))
+		self.assertFalse(haggler.can("Joker", "submit"))
+
+		haggler.submit(buyer, seller, Offer("Batmobile", 500, 5))
+		self.assertTrue(haggler.can(seller, "Accept"))
+		self.assertFalse(haggler.can(buyer, "accept"))
+		self.assertTrue(haggler.can(buyer, ACTION_WITHDRAW))
+		self.assertFalse(haggler.can(buyer, "proposeUpdate"))
+
+		haggler.withdraw(buyer)
+		self.assertTrue(haggler.can(buyer, "proposeUpdate"))
+		self.assertFalse(haggler.can(seller, "proposeUpdate"))
+
+		haggler.cancel(seller)
+		for action in ACTION_METHODS:
+			self.assertEqual(haggler.can(seller, action), action == "updatePrivateData")
+
+	def test_table_matches_states(self):
+		self.assertEqual(len(TRANSITIONS), len(ACTIONS))
+		for row in TRANSITIONS:
+			self.assertEqual(len(row), len(STATES))
+		self.assertEqual(ACTION_ENDS, (False, False, False, True, True, False))
+		self.assertEqual(TRANSITIONS[ACTION_ACCEPT][STATE_AWAITING_MY_ACCEPTANCE], ("Accepted", "Accepted", True))
+		self.assertIsNone(TRANSITIONS[ACTION_WITHDRAW][STATE_WITHDRAWN_BY_ME])
+
+
+class TestErrors(unittest.TestCase):
+
+	def setUp(self):
+		rejections.reset()
+
+	def test_return_mode(self):
+		seller = "Batman"
+		buyer = "Superman"
+		haggler = Haggler(seller, buyer, errors="return")
+		with contextlib.redirect_stdout(io.StringIO()) as out:
+			self.assertEqual(haggler.submit(buyer, seller, Offer("Batmobile", 500, 5)), RESULT_OK)
+			self.assertEqual(haggler.accept(buyer), RESULT_INVALID_STATE)
+			self.assertEqual(haggler.accept("Joker"), RESULT_UNKNOWN_USER)
+			self.assertEqual(haggler.updatePrivateData(buyer, 42), RESULT_INVALID_PRIVATE_INFO)
+			self.assertEqual(haggler.accept(seller), RESULT_OK)
+			self.assertEqual(haggler.accept(seller), RESULT_ENDED)
+			self.assertEqual(haggler.accept(seller), RESULT_ENDED)
+			self.assertIsNone(haggler.returnVersion(seller, 5))
+			self.assertEqual(haggler.versionDifferences(seller, 1, 5), {})
+		self.assertEqual(out.getvalue(), "")
+
+		self.assertEqual(rejections.total, 5)
+		self.assertEqual(rejections.asDict(), {
+			"Accept": {"UnknownUser": 1, "Ended": 2, "InvalidState": 1},
+			"UpdatePrivateData": {"InvalidPrivateInfo": 1},
+		})
+
+	def test_raise_mode(self):
+		seller = "Batman"
+		buyer = "Superman"
+		haggler = Haggler(seller, buyer, errors="raise")
+		haggler.submit(buyer, seller, Offer("Batmobile", 500, 5))
+
+		with self.assertRaises(InvalidStateError) as context:
+			haggler.withdraw(seller)
+		self.assertEqual(context.exception.result, RESULT_INVALID_STATE)
+		self.assertIn("invalid for Withdraw by Batman", str(context.exception))
+
+		with self.assertRaises(UnknownVersionError):
+			haggler.returnVersion(seller, 2)
+		with self.assertRaises(TypeError):
+			haggler.updatePrivateData(seller, None)
+		with self.assertRaises(TypeError):
+			Haggler(1, 2, errors="raise")
+
+		haggler.cancel(seller)
+		with self.assertRaises(NegotiationEndedError):
+			haggler.cancel(buyer)
+
+	def test_pool(self):
+		pool = HagglerPool(errors="return")
+		pool.create("deal-1", "Batman", "Superman")
+		self.assertIsNone(pool.create("deal-1", "Batman", "Superman"))
+		self.assertEqual(pool.accept("deal-2", "Batman"), RESULT_UNKNOWN_NEGOTIATION)
+		self.assertEqual(pool.submit("deal-1", "Superman", "Batman", Offer("Batmobile", 500, 5)), RESULT_OK)
+		self.assertEqual(pool.withdraw("deal-1", "Batman"), RESULT_INVALID_STATE)
+		self.assertEqual(rejections.asDict(), {
+			"Withdraw": {"InvalidState": 1},
+			"Accept": {"UnknownNegotiation": 1},
+			"Create": {"NegotiationExists": 1},
+		})
+
+		with self.assertRaises(NegotiationExistsError):
+			HagglerPool(errors="raise").createMany([("deal-1", "Batman", "Superman")] * 2)
+
+		# a bad user id is reported and counted like any other rejection
+		rejections.reset()
+		stdout = io.StringIO()
+		with contextlib.redirect_stdout(stdout):
+			self.assertEqual(pool.createMany([("deal-2", "Batman", 2), ("deal-3", "Joker", "Robin")]), 1)
+		self.assertEqual(stdout.getvalue(), "")
+		self.assertNotIn("deal-2", pool)
+		self.assertEqual(pool.openNegotiations("Joker"), {"deal-3"})
+		self.assertEqual(rejections.asDict(), {"Create": {"UnknownUser": 1}})
+		with self.assertRaises(UnknownUserError):
+			HagglerPool(errors="raise").createMany([("deal-1", 1, 2)])
+		with contextlib.redirect_stdout(stdout):
+			HagglerPool().createMany([("deal-1", 1, 2)])
+		self.assertEqual(stdout.getvalue(), "User IDs must be type string\n")
+
+
+class TestEventSourced(unittest.TestCase):
+
+	def play(self, haggler):
+		seller = "Batman"
+		buyer = "Superman"
+		haggler.submit(buyer, seller, Offer("Batmobile", 500, 5))
+		haggler.updatePrivateData(buyer, {"reference": "order123"})
+		haggler.withdraw(buyer)
+		haggler.updatePrivateData(seller, {"reference": "po-9"})
+		haggler.proposeUpdate(buyer, Offer("Batmobile", 450, 5))
+		haggler.accept(seller)
+		return haggler
+
+	def test_matches_offer_history(self):
+		plain = self.play(Haggler("Batman", "Superman"))
+		sourced = self.play(Haggler("Batman", "Superman", event_sourced=True))
+
+		for user_id in ["Batman", "Superman"]:
+			expected = [vars(o) for o in plain.users[user_id].offer_history]
+			history = [vars(o) for o in sourced.users[user_id].offer_history]
+			self.assertEqual(history, expected)
+			self.assertEqual(vars(sourced.returnVersion(user_id, 2)), expected[1])
+			self.assertEqual(sourced.versionDifferences(user_id, 1, len(expected)),
+				plain.versionDifferences(user_id, 1, len(expected)))
+
+	def test_one_event_per_action(self):
+		sourced = self.play(Haggler("Batman", "Superman", event_sourced=True))
+		events = list(sourced.log)
+
+		self.assertEqual(len(sourced.log), 6)
+		self.assertEqual([e["action"] for e in events],
+			["Submit", "UpdatePrivateData", "Withdraw", "UpdatePrivateData", "ProposeUpdate", "Accept"])
+		self.assertEqual(sorted(events[0]["users"]), ["Batman", "Superman"])
+		self.assertEqual(list(events[1]["users"]), ["Superman"])
+		self.assertEqual(events[5]["users"]["Superman"]["private_info"], {"reference": "order123"})
+
+		# actions, states and user ids are stored as one byte codes
+		self.assertEqual(list(sourced.log.action), [ACTION_SUBMIT, ACTION_UPDATE_PRIVATE_DATA, ACTION_WITHDRAW,
+			ACTION_UPDATE_PRIVATE_DATA, ACTION_PROPOSE_UPDATE, ACTION_ACCEPT])
+		self.assertEqual(list(sourced.log.state[0]), [STATE_AWAITING_MY_ACCEPTANCE, STATE_NONE, STATE_WITHDRAWN_BY_THEM,
+			STATE_WITHDRAWN_BY_THEM, STATE_AWAITING_MY_ACCEPTANCE, STATE_ACCEPTED])
+		self.assertEqual(events[0]["seller"], "Superman")
+
+
+class TestHagglerPool(unittest.TestCase):
+
+	def test_indexes_and_archive(self):
+		pool = HagglerPool()
+		self.assertEqual(pool.createMany([
+			("deal-1", "Batman", "Superman"),
+			("deal-2", "Batman", "Robin"),
+			("deal-3", "Joker", "Robin"),
+		]), 3)
+		self.assertIsNone(pool.create("deal-1", "Batman", "Superman"))
+
+		self.assertEqual(pool.openNegotiations("Batman"), {"deal-1", "deal-2"})
+		self.assertEqual(pool.openNegotiations("Robin"), {"deal-2", "deal-3"})
+
+		pool.submit("deal-1", "Superman", "Batman", Offer("Batmobile", 500, 5))
+		pool.submit("deal-2", "Robin", "Batman", Offer("Batarang", 20, 100))
+		pool.accept("deal-1", "Batman")
+		pool.cancel("deal-2", "Batman")
+
+		self.assertEqual(len(pool), 1)
+		self.assertNotIn("deal-1", pool)
+		self.assertEqual(pool.openNegotiations("Batman"), set())
+		self.assertEqual(pool.openNegotiations("Robin"), {"deal-3"})
+
+		# finished negotiations are still readable from the archive
+		self.assertEqual(pool.returnVersion("deal-1", "Batman", 2).state, "Accepted")
+		self.assertEqual(sorted(pool.archive), ["deal-1", "deal-2"])
+
+	def test_batch_matches_single_calls(self):
+		actions = [
+			("deal-1", "submit", "Superman", ("Batman", Offer("Batmobile", 500, 5))),
+			("deal-2", "submit", "Robin", ("Batman", Offer("Batarang", 20, 100))),
+			("deal-1", "accept", "Superman", None),
+			("deal-2", "withdraw", "Robin", None),
+			("deal-1", "updatePrivateData", "Superman", {"reference": "order123"}),
+			("deal-2", "proposeUpdate", "Robin", Offer("Batarang", 18, 100)),
+			("deal-1", "withdraw", "Superman", None),
+			("deal-2", "accept", "Batman", None),
+			("deal-2", "cancel", "Batman", None),
+			("deal-3", "accept", "Batman", None),
+			("deal-1", "haggle", "Batman", None),
+			("deal-1", "updatePrivateData", "Batman", 42),
+		]
+
+		batched = HagglerPool(on_end="evict")
+		single = HagglerPool(on_end="evict")
+		for pool in (batched, single):
+			pool.createMany([("deal-1", "Batman", "Superman"), ("deal-2", "Batman", "Robin")])
+
+		batched_printed = io.StringIO()
+		with contextlib.redirect_stdout(batched_printed):
+			results = batched.applyBatch(actions)
+		single_printed = io.StringIO()
+		with contextlib.redirect_stdout(single_printed):
+			for negotiation_id, action, user_id, payload in actions:
+				if action == "submit":
+					single.submit(negotiation_id, user_id, *payload)
+				elif action in ("proposeUpdate", "updatePrivateData"):
+					getattr(single, action)(negotiation_id, user_id, payload)
+				elif hasattr(single, action):
+					getattr(single, action)(negotiation_id, user_id)
+
+		# rejections are printed as the action methods print them
+		printed = batched_printed.getvalue().splitlines()
+		self.assertIn("Error: 'haggle' is not a Haggler action.", printed)
+		printed.remove("Error: 'haggle' is not a Haggler action.")
+		self.assertEqual(printed, single_printed.getvalue().splitlines())
+
+		self.assertEqual(list(results), [
+			RESULT_OK, RESULT_OK, RESULT_INVALID_STATE, RESULT_OK, RESULT_OK, RESULT_OK,
+			RESULT_OK, RESULT_OK, RESULT_UNKNOWN_NEGOTIATION, RESULT_UNKNOWN_NEGOTIATION,
+			RESULT_UNKNOWN_ACTION, RESULT_INVALID_PRIVATE_INFO,
+		])
+		self.assertEqual(batched.evicted, single.evicted)
+		self.assertEqual(batched.open_by_user, single.open_by_user)
+		for user_id in ("Batman", "Superman"):
+			self.assertEqual(
+				[vars(o) for o in batched.get("deal-1").users[user_id].offer_history],
+				[vars(o) for o in single.get("deal-1").users[user_id].offer_history])
+
+	def test_batch_records_in_order(self):
+		with tempfile.TemporaryDirectory() as directory:
+			path = os.path.join(directory, "pool.wal")
+			feed = ChangeFeed()
+			pool = HagglerPool(errors="return", journal=True, feed=feed, wal=WriteAheadLog(path, fsync="never"))
+			pool.createMany([("deal-1", "Batman", "Superman"), ("deal-2", "Batman", "Robin")])
+			subscription = feed.subscribe(user_ids=["Batman"], batch_size=10)
+			pool.applyBatch([
+				("deal-1", "submit", "Superman", ("Batman", Offer("Batmobile", 500, 5))),
+				("deal-2", "submit", "Robin", ("Batman", Offer("Batarang", 20, 100))),
+				("deal-1", "withdraw", "Superman", None),
+			])
+			pool.wal.close()
+
+			self.assertEqual([(r[0], r[1]) for r in WriteAheadLog.read(path)][2:],
+				[(ACTION_SUBMIT, "deal-1"), (ACTION_SUBMIT, "deal-2"), (ACTION_WITHDRAW, "deal-1")])
+			versions, _ = pool.historySince("Batman", 0)
+			self.assertEqual([(n, offer.version) for n, offer in versions], [("deal-1", 1), ("deal-2", 1), ("deal-1", 2)])
+			self.assertEqual([(e.negotiation_id, e.version) for e in subscription.poll()], [("deal-1", 1), ("deal-2", 1), ("deal-1", 2)])
+
+	def test_batch_raises(self):
+		pool = HagglerPool(errors="raise")
+		pool.createMany([("deal-1", "Batman", "Superman"), ("deal-2", "Batman", "Robin")])
+		with self.assertRaises(BatchError) as raised:
+			pool.applyBatch([
+				("deal-1", "submit", "Superman", ("Batman", Offer("Batmobile", 500, 5))),
+				("deal-2", "accept", "Robin", None),
+				("deal-1", "accept", "Batman", None),
+			])
+		error = raised.exception
+		self.assertEqual((error.index, error.result, list(error.results)), (1, RESULT_INVALID_STATE, [RESULT_OK, RESULT_INVALID_STATE]))
+		self.assertIsInstance(error.error, InvalidStateError)
+		self.assertIsInstance(error, HagglingError)
+		# the action after the rejected one was not applied
+		self.assertEqual(pool.get("deal-1").users["Batman"].state, "AwaitingMyAcceptance")
+
+	def test_evict(self):
+		pool = HagglerPool(on_end="evict")
+		pool.create("deal-1", "Batman", "Superman")
+		pool.submit("deal-1", "Superman", "Batman", Offer("Batmobile", 500, 5))
+		pool.withdraw("deal-1", "Superman")
+		self.assertIn("deal-1", pool)
+		pool.cancel("deal-1", "Superman")
+
+		self.assertNotIn("deal-1", pool)
+		self.assertIsNone(pool.get("deal-1"))
+		self.assertEqual(pool.evicted, 1)
+		self.assertEqual(pool.archive, {})
+
+
+class TestWriteAheadLog(unittest.TestCase):
+
+	def setUp(self):
+		self.directory = tempfile.TemporaryDirectory()
+		self.path = os.path.join(self.directory.name, "haggling.wal")
+
+	def tearDown(self):
+		self.directory.cleanup()
+
+	def test_recover(self):
+		pool = HagglerPool(wal=WriteAheadLog(self.path, fsync="never"))
+		pool.createMany([("deal-1", "Batman", "Superman"), ("deal-2", "Batman", "Robin")])
+		pool.submit("deal-1", "Superman", "Batman", Offer("Batmobile", 500, 5))
+		pool.updatePrivateData("deal-1", "Superman", {"reference": "order123"})
+		pool.applyBatch([
+			("deal-2", "submit", "Robin", ("Batman", Offer("Batarang", 20, 100))),
+			("deal-2", "accept", "Robin", None),
+			("deal-2", "withdraw", "Robin", None),
+		])
+		pool.accept("deal-1", "Batman")
+		pool.wal.close()
+
+		recovered = HagglerPool.recover(self.path)
+		self.assertEqual(sorted(recovered.archive), ["deal-1"])
+		self.assertEqual(recovered.openNegotiations("Robin"), {"deal-2"})
+		for negotiation_id in ("deal-1", "deal-2"):
+			for user_id, user in pool.get(negotiation_id).users.items():
+				self.assertEqual(
+					[vars(o) for o in recovered.get(negotiation_id).users[user_id].offer_history],
+					[vars(o) for o in user.offer_history])
+
+		# the recovered pool carries on logging to the same file
+		recovered.proposeUpdate("deal-2", "Robin", Offer("Batarang", 18, 100))
+		recovered.wal.close()
+		again = HagglerPool.recover(self.path)
+		again.wal.close()
+		self.assertEqual(again.returnVersion("deal-2", "Batman", 3).price, 18)
+
+	def test_torn_tail(self):
+		with WriteAheadLog(self.path) as wal:
+			wal.append((WAL_CREATE, "deal-1", None, ("Batman", "Superman")))
+			wal.append((ACTION_SUBMIT, "deal-1", "Superman", ("Batman", Offer("Batmobile", 500, 5))))
+
+		# lose the end of the last record, as if the process died mid write
+		with open(self.path, "r+b") as f:
+			f.truncate(os.path.getsize(self.path) - 3)
+
+		self.assertEqual(len(list(WriteAheadLog.read(self.path))), 1)
+		pool = HagglerPool.recover(self.path)
+		pool.submit("deal-1", "Batman", "Superman", Offer("Batmobile", 450, 5))
+		pool.wal.close()
+
+		records = list(WriteAheadLog.read(self.path))
+		self.assertEqual([r[0] for r in records], [WAL_CREATE, ACTION_SUBMIT])
+		self.assertEqual(records[1][3][1].price, 450)
+
+	def test_quiet_log_committed(self):
+		pool = HagglerPool(errors="return", wal=WriteAheadLog(self.path, fsync="never", group_size=100, group_interval=60))
+		pool.create("deal-1", "Batman", "Superman")
+		pool.submit("deal-1", "Superman", "Batman", Offer("Batmobile", 500, 5))
+		self.assertEqual((pool.wal.pending, len(list(WriteAheadLog.read(self.path)))), (2, 0))
+
+		# a tick only commits a group that has waited group_interval
+		pool.wal.tick()
+		self.assertEqual(pool.wal.pending, 2)
+		pool.wal.group_interval = 0
+		pool.wal.tick()
+		self.assertEqual((pool.wal.pending, len(list(WriteAheadLog.read(self.path)))), (0, 2))
+
+		pool.wal.group_interval = 60
+		pool.withdraw("deal-1", "Superman")
+		pool.flush()
+		self.assertEqual(len(list(WriteAheadLog.read(self.path))), 3)
+		pool.wal.close()
+
+	def test_async_commits_on_timer(self):
+		wal = WriteAheadLog(self.path, fsync="never", group_size=100, group_interval=0.01)
+
+		async def run():
+			service = AsyncHagglerPool(errors="return", wal=wal)
+			await service.create("deal-1", "Batman", "Superman")
+			await service.submit("deal-1", "Superman", "Batman", Offer("Batmobile", 500, 5))
+			# no more calls, but the buffered records are committed
+			for _ in range(100):
+				if not wal.pending:
+					break
+				await asyncio.sleep(0.01)
+
+		asyncio.run(run())
+		self.assertEqual(len(list(WriteAheadLog.read(self.path))), 2)
+		wal.close()
+
+
+class TestSnapshot(unittest.TestCase):
+
+	def setUp(self):
+		self.directory = tempfile.TemporaryDirectory()
+		self.path = os.path.join(self.directory.name, "pool.snapshot")
+
+	def tearDown(self):
+		self.directory.cleanup()
+
+	def assertSameHistories(self, pool, restored):
+		for negotiation_id, haggler in list(pool.hagglers.items()) + list(pool.archive.items()):
+			for user_id, user in haggler.users.items():
+				other = restored.get(negotiation_id).users[user_id]
+				self.assertEqual([vars(o) for o in other.offer_history], [vars(o) for o in user.offer_history])
+				self.assertEqual((other.role, other.state, other.end, other.curr_version), (user.role, user.state, user.end, user.curr_version))
+				self.assertEqual(other.private_info, user.private_info)
+
+	def test_round_trip(self):
+		for event_sourced in (False, True):
+			pool = HagglerPool(event_sourced=event_sourced, errors="return")
+			pool.createMany([("deal-1", "Batman", "Superman"), ("deal-2", "Batman", "Robin"), (3, "Robin", "Joker")])
+			pool.submit("deal-1", "Superman", "Batman", Offer("Batmobile", 500.5, 5))
+			pool.updatePrivateData("deal-1", "Superman", {"reference": "order123"})
+			pool.updatePrivateData("deal-1", "Batman", {"budget": 10 ** 30})
+			pool.proposeUpdate("deal-1", "Batman", Offer("Batmobile", 450, 5))
+			pool.submit("deal-2", "Robin", "Batman", Offer("Batarang", 20, 100))
+			pool.accept("deal-2", "Batman")
+			pool.snapshot(self.path)
+
+			restored = HagglerPool.restore(self.path)
+			self.assertEqual(restored.event_sourced, event_sourced)
+			self.assertEqual(restored.errors, "return")
+			self.assertEqual(sorted(restored.archive), ["deal-2"])
+			self.assertEqual(restored.openNegotiations("Robin"), {3})
+			self.assertSameHistories(pool, restored)
+
+			# the restored pool carries on where the snapshot left off
+			self.assertEqual(restored.accept("deal-1", "Superman"), RESULT_OK)
+			self.assertEqual(restored.returnVersion("deal-1", "Superman", 4).state, "Accepted")
+
+	def test_bad_file(self):
+		with open(self.path, "wb") as f:
+			f.write(b"not a snapshot")
+		self.assertRaises(ValueError, HagglerPool.restore, self.path)
+
+
+class TestColumnarArchive(unittest.TestCase):
+
+	def setUp(self):
+		self.directory = tempfile.TemporaryDirectory()
+		self.path = os.path.join(self.directory.name, "deals.archive")
+
+	def tearDown(self):
+		self.directory.cleanup()
+
+	def play(self, pool):
+		pool.createMany([("deal-1", "Batman", "Superman"), ("deal-2", "Batman", "Robin")])
+		pool.submit("deal-1", "Superman", "Batman", Offer("Batmobile", 500, 5))
+		pool.updatePrivateData("deal-1", "Batman", {"budget": 2.5})
+		pool.proposeUpdate("deal-1", "Batman", Offer("Batmobile", 450.5, 5))
+		pool.accept("deal-1", "Superman")
+		pool.submit("deal-2", "Robin", "Batman", Offer("Batarang", 20, 100))
+		return pool
+
+	def test_matches_dict_archive(self):
+		expected = self.play(HagglerPool(errors="return"))
+		pool = self.play(HagglerPool(errors="return", archive=ColumnarArchive(self.path, errors="return")))
+		self.assertEqual(list(pool.archive), ["deal-1"])
+
+		archived = pool.get("deal-1")
+		haggler = expected.get("deal-1")
+		for user_id, user in haggler.users.items():
+			self.assertEqual([vars(o) for o in archived.users[user_id].offer_history], [vars(o) for o in user.offer_history])
+			self.assertEqual(archived.users[user_id].state, user.state)
+			for v1 in range(5):
+				for v2 in range(5):
+					self.assertEqual(archived.versionDifferences(user_id, v1, v2), haggler.versionDifferences(user_id, v1, v2))
+
+		version = pool.returnVersion("deal-1", "Batman", 3)
+		self.assertIsInstance(version, ArchivedOffer)
+		self.assertEqual(version.price, 450.5)
+		self.assertEqual(vars(version.offer()), vars(expected.returnVersion("deal-1", "Batman", 3)))
+
+		# archived negotiations are read only
+		self.assertEqual(pool.updatePrivateData("deal-1", "Batman", {"budget": 3}), RESULT_ENDED)
+		self.assertEqual(pool.applyBatch([("deal-1", "accept", "Joker", None)]).tolist(), [RESULT_UNKNOWN_USER])
+
+	def test_inherits_errors(self):
+		pool = self.play(HagglerPool(errors="return", archive=ColumnarArchive(self.path)))
+		self.assertEqual(pool.archive.errors, "return")
+		self.assertEqual(pool.accept("deal-1", "Batman"), RESULT_ENDED)
+		self.assertEqual(pool.archive["deal-1"].accept("Batman"), RESULT_ENDED)
+		with self.assertRaises(HagglingError):
+			pool.archive.errors = "raise"
+			pool.accept("deal-1", "Batman")
+
+	def test_reopen(self):
+		pool = self.play(HagglerPool(errors="return", archive=ColumnarArchive(self.path)))
+		pool.archive.close()
+
+		with ColumnarArchive(self.path) as archive:
+			self.assertIn("deal-1", archive)
+			user = archive["deal-1"].users["Batman"]
+			self.assertEqual(user.private_info, {"budget": 2.5})
+			self.assertEqual(user.other.user_id, "Superman")
+			self.assertEqual([o.action for o in user.offer_history], ["Submit", "UpdatePrivateData", "ProposeUpdate", "Accept"])
+
+
+class TestAsyncHagglerPool(unittest.TestCase):
+
+	def test_ordering_and_results(self):
+		async def run():
+			service = AsyncHagglerPool(queue_size=2, errors="return")
+			await asyncio.gather(service.create("deal-1", "Batman", "Superman"), service.create("deal-2", "Batman", "Robin"))
+			# fired together, but applied in order per negotiation
+			results = await asyncio.gather(
+				service.submit("deal-1", "Superman", "Batman", Offer("Batmobile", 500, 5)),
+				service.submit("deal-2", "Robin", "Batman", Offer("Batarang", 20, 100)),
+				service.withdraw("deal-1", "Superman"),
+				service.accept("deal-1", "Batman"),
+				service.proposeUpdate("deal-1", "Superman", Offer("Batmobile", 450, 5)),
+				service.accept("deal-1", "Batman"),
+			)
+			version = await service.returnVersion("deal-1", "Batman", 3)
+			await service.join()
+			return service, results, version
+
+		service, results, version = asyncio.run(run())
+		self.assertEqual(results, [RESULT_OK, RESULT_OK, RESULT_OK, RESULT_INVALID_STATE, RESULT_OK, RESULT_OK])
+		self.assertEqual(version.price, 450)
+		self.assertEqual(service.actors, {})
+		self.assertEqual(sorted(service.pool.archive), ["deal-1"])
+
+	def test_raise_mode(self):
+		async def run():
+			service = AsyncHagglerPool(errors="raise")
+			await service.create("deal-1", "Batman", "Superman")
+			with self.assertRaises(InvalidStateError):
+				await service.accept("deal-1", "Batman")
+			return await service.submit("deal-1", "Superman", "Batman", Offer("Batmobile", 500, 5))
+
+		self.assertEqual(asyncio.run(run()), RESULT_OK)
+
+
+class TestThreadSafe(unittest.TestCase):
+
+	PAIRS = {
+		("AwaitingMyAcceptance", "AwaitingTheirAcceptance"),
+		("AwaitingTheirAcceptance", "AwaitingMyAcceptance"),
+		("WithdrawnByMe", "WithdrawnByThem"),
+		("WithdrawnByThem", "WithdrawnByMe"),
+		("Accepted", "Accepted"),
+		("Cancelled", "Cancelled"),
+	}
+
+	def test_views_are_consistent(self):
+		haggler = ThreadSafeHaggler("Batman", "Superman", errors="return")
+		haggler.submit("Superman", "Batman", Offer("Batmobile", 500, 5))
+		torn = []
+
+		def write(user_id):
+			for i in range(2000):
+				haggler.withdraw(user_id)
+				haggler.proposeUpdate(user_id, Offer("Batmobile", i, 5))
+
+		def read():
+			for _ in range(4000):
+				view = haggler.view
+				batman, superman = view.users["Batman"], view.users["Superman"]
+				if (batman.state, superman.state) not in self.PAIRS or len(batman.offer_history) != len(superman.offer_history):
+					torn.append((batman.state, superman.state))
+				last = len(batman.offer_history)
+				if view.versionDifferences("Batman", 1, last).get("version") != [1, last] and last > 1:
+					torn.append(last)
+
+		threads = [threading.Thread(target=write, args=(u,)) for u in ("Batman", "Superman")]
+		threads += [threading.Thread(target=read) for _ in range(2)]
+		for thread in threads:
+			thread.start()
+		for thread in threads:
+			thread.join()
+
+		self.assertEqual(torn, [])
+		self.assertEqual(haggler.view.users["Batman"].curr_version, haggler.users["Batman"].curr_version)
+		self.assertEqual(len(haggler.users["Batman"].offer_history), len(haggler.users["Superman"].offer_history))
+
+	def test_view_differences(self):
+		haggler = ThreadSafeHaggler("Batman", "Superman", errors="return")
+		haggler.submit("Superman", "Batman", Offer("Batmobile", 500, 5))
+		haggler.proposeUpdate("Batman", Offer("Batmobile", 450, 5))
+		haggler.proposeUpdate("Superman", Offer("Batmobile", 475, 5))
+		view = haggler.view
+		expected = view.consecutiveDifferences("Batman")
+		# the live Haggler's delta index grows past the view's history
+		haggler.proposeUpdate("Batman", Offer("Batmobile", 460, 5))
+		haggler.withdraw("Batman")
+		haggler.consecutiveDifferences("Batman")
+		self.assertEqual(view.consecutiveDifferences("Batman"), expected)
+		self.assertEqual(len(expected), 2)
+		self.assertEqual(len(haggler.consecutiveDifferences("Batman")), 4)
+
+	def test_delta_locks_per_negotiation(self):
+		hagglers = [ThreadSafeHaggler("Batman", "Superman", errors="return") for _ in range(2)]
+		for haggler in hagglers:
+			haggler.submit("Superman", "Batman", Offer("Batmobile", 500, 5))
+			haggler.proposeUpdate("Batman", Offer("Batmobile", 450, 5))
+		results = []
+		# indexing one negotiation does not wait for another being indexed
+		with hagglers[0].users["Batman"].deltas.lock:
+			reader = threading.Thread(target=lambda: results.append(hagglers[1].versionDifferences("Batman", 1, 2)))
+			reader.start()
+			reader.join(5)
+		self.assertEqual(results, [hagglers[0].versionDifferences("Batman", 1, 2)])
+
+		# the lock is not pickled with the index
+		haggler = Haggler("Batman", "Superman", errors="return")
+		haggler.submit("Superman", "Batman", Offer("Batmobile", 500, 5))
+		haggler.proposeUpdate("Batman", Offer("Batmobile", 450, 5))
+		expected = haggler.consecutiveDifferences("Batman")
+		self.assertEqual(pickle.loads(pickle.dumps(haggler)).consecutiveDifferences("Batman"), expected)
+
+	def test_pool(self):
+		pool = HagglerPool(threadsafe=True, errors="return")
+		pool.createMany([("deal-1", "Batman", "Superman")])
+		self.assertIsInstance(pool.get("deal-1"), ThreadSafeHaggler)
+		pool.submit("deal-1", "Superman", "Batman", Offer("Batmobile", 500, 5))
+		pool.accept("deal-1", "Batman")
+		self.assertEqual(pool.returnVersion("deal-1", "Superman", 2).state, "Accepted")
+		self.assertRaises(ValueError, HagglerPool, threadsafe=True, wal=object())
+
+
+class TestShardedHagglerPool(unittest.TestCase):
+
+	def test_matches_pool(self):
+		actions = [(i, "submit", "Batman", ("Robin{0}".format(i), Offer("Batarang", 20, i))) for i in range(20)]
+		actions += [(i, "accept", "Robin{0}".format(i), None) for i in range(0, 20, 3)]
+		actions += [(i, "withdraw", "Joker", None) for i in range(5)]
+
+		pool = HagglerPool(errors="return")
+		with ShardedHagglerPool(3, errors="return") as sharded:
+			for p in (pool, sharded):
+				self.assertEqual(p.createMany((i, "Batman", "Robin{0}".format(i)) for i in range(20)), 20)
+
+			self.assertEqual(sharded.applyBatch(actions), pool.applyBatch(actions))
+			self.assertEqual(sharded.openNegotiations("Batman"), pool.openNegotiations("Batman"))
+			self.assertEqual(len(sharded), len(pool))
+			self.assertEqual(sharded.proposeUpdate(1, "Robin1", Offer("Batarang", 18, 1)), RESULT_OK)
+			self.assertEqual(sharded.returnVersion(1, "Batman", 2).price, 18)
+			self.assertEqual(sharded.versionDifferences(0, "Batman", 1, 2), pool.versionDifferences(0, "Batman", 1, 2))
+			self.assertFalse(sharded.create(0, "Batman", "Robin0"))
+
+	def test_raise_mode(self):
+		with ShardedHagglerPool(2, errors="raise") as sharded:
+			sharded.create("deal-1", "Batman", "Superman")
+			self.assertRaises(InvalidStateError, sharded.accept, "deal-1", "Batman")
+			self.assertRaises(UnknownNegotiationError, sharded.accept, "deal-2", "Batman")
+
+
+class TestNegotiationIndex(unittest.TestCase):
+
+	def play(self, pool):
+		pool.createMany([(i, "Batman", "Robin{0}".format(i)) for i in range(6)])
+		pool.create("deal-1", "Superman", "Joker")
+		for i in range(6):
+			pool.submit(i, "Batman", "Robin{0}".format(i), Offer(("Batarang", "Batmobile")[i % 2], 10 * (i + 1), 2))
+		pool.proposeUpdate(1, "Robin1", Offer("Batarang", 15, 2))
+		pool.withdraw(2, "Batman")
+		pool.accept(3, "Robin3")
+		pool.updatePrivateData(4, "Batman", {"budget": 100})
+		return pool
+
+	def test_query(self):
+		pool = self.play(HagglerPool(errors="return", indexed=True))
+		self.assertEqual(pool.query(), {0, 1, 2, 4, 5, "deal-1"})
+		self.assertEqual(pool.query(product="Batarang"), {0, 1, 2, 4})
+		self.assertEqual(pool.query(product="Batarang", state="AwaitingMyAcceptance"), {0, 1, 4})
+		self.assertEqual(pool.query(user_id="Batman", state=STATE_AWAITING_MY_ACCEPTANCE), {1})
+		self.assertEqual(pool.query(user_id="Batman", state="WithdrawnByMe"), {2})
+		self.assertEqual(pool.query(state=STATE_NONE), {"deal-1"})
+		self.assertEqual(pool.query(user_id="Superman"), {"deal-1"})
+		self.assertEqual(pool.query(price=(15, 30)), {1, 2})
+		self.assertEqual(pool.query(price=(50, None)), {4, 5})
+		self.assertEqual(pool.query(product="Batmobile", full_price=(None, 100)), set())
+		self.assertEqual(pool.query(product="Batarang", full_price=(60, 100)), {2, 4})
+		self.assertEqual(pool.query(product="Robin"), set())
+		self.assertRaises(ValueError, pool.query, state="Haggling")
+		self.assertRaises(ValueError, HagglerPool().query)
+
+	def test_rebuilt(self):
+		pool = self.play(HagglerPool(errors="return", indexed=True))
+		with tempfile.TemporaryDirectory() as directory:
+			path = os.path.join(directory, "pool.snapshot")
+			pool.snapshot(path)
+			restored = HagglerPool.restore(path, indexed=True)
+		self.assertEqual(restored.index.entries, pool.index.entries)
+		threadsafe = self.play(HagglerPool(errors="return", indexed=True, threadsafe=True))
+		self.assertEqual(threadsafe.index.entries, pool.index.entries)
+
+		with ShardedHagglerPool(2, errors="return", indexed=True) as sharded:
+			self.play(sharded)
+			self.assertEqual(sharded.query(product="Batarang", state="AwaitingMyAcceptance"), {0, 1, 4})
+
+
+class TestMetrics(unittest.TestCase):
+
+	def setUp(self):
+		self.submit = Haggler._submit
+		metrics.reset()
+		rejections.reset()
+		metrics.enable()
+
+	def tearDown(self):
+		metrics.disable()
+		metrics.reset()
+
+	def test_collects(self):
+		pool = HagglerPool(errors="return")
+		pool.createMany([("deal-1", "Batman", "Superman"), ("deal-2", "Batman", "Robin")])
+		pool.submit("deal-1", "Superman", "Batman", Offer("Batmobile", 500, 5))
+		pool.submit("deal-2", "Robin", "Batman", Offer("Batarang", 20, 100))
+		pool.updatePrivateData("deal-1", "Batman", {"budget": 400})
+		pool.accept("deal-1", "Superman")
+		pool.accept("deal-1", "Batman")
+
+		collected = metrics.asDict()
+		self.assertEqual(collected["actions"]["Submit"]["count"], 2)
+		self.assertEqual(collected["actions"]["Accept"]["count"], 2)
+		self.assertEqual(collected["actions"]["Accept"]["buckets"][float("inf")], 2)
+		self.assertEqual(collected["rejections"], {"Accept": {"InvalidState": 1}})
+		self.assertEqual(collected["gauges"], {"live_negotiations": 1, "history_versions": 7, "largest_history": 3})
+
+		text = metrics.exposition()
+		self.assertIn('haggling_action_seconds_count{action="Submit"} 2', text)
+		self.assertIn('haggling_rejections_total{action="Accept",reason="InvalidState"} 1', text)
+		self.assertIn("haggling_live_negotiations 1", text)
+
+	def test_resubmit_counted_once(self):
+		haggler = Haggler("Batman", "Superman", errors="return")
+		haggler.submit("Superman", "Batman", Offer("Batmobile", 500, 5))
+		haggler.submit("Batman", "Superman", Offer("Batmobile", 450, 5))
+		self.assertEqual(metrics.live_negotiations, 1)
+		haggler.cancel("Superman")
+		self.assertEqual(metrics.live_negotiations, 0)
+
+	def test_enabled_mid_negotiation(self):
+		metrics.disable()
+		pool = HagglerPool(errors="return")
+		pool.createMany([("deal-1", "Batman", "Superman"), ("deal-2", "Batman", "Robin"), ("deal-3", "Joker", "Robin")])
+		pool.submit("deal-1", "Superman", "Batman", Offer("Batmobile", 500, 5))
+		pool.submit("deal-2", "Robin", "Batman", Offer("Batarang", 20, 100))
+
+		metrics.enable(pool.hagglers.values())
+		self.assertEqual(metrics.live_negotiations, 2)
+		pool.accept("deal-1", "Batman")
+		pool.submit("deal-3", "Joker", "Robin", Offer("Batarang", 20, 100))
+		self.assertEqual(metrics.live_negotiations, 2)
+
+		# an end never seen open does not take the gauge below zero
+		metrics.disable()
+		metrics.reset()
+		metrics.enable()
+		pool.cancel("deal-2", "Robin")
+		self.assertEqual(metrics.live_negotiations, 0)
+
+	def test_gauges_follow_memory(self):
+		retention = HistoryRetention(keep=4, spill=4)
+		pool = HagglerPool(errors="return", on_end="evict", retention=retention)
+		pool.createMany([("deal-1", "Batman", "Superman"), ("deal-2", "Batman", "Robin")])
+		pool.submit("deal-1", "Superman", "Batman", Offer("Batmobile", 500, 5))
+		pool.submit("deal-2", "Robin", "Batman", Offer("Batarang", 20, 100))
+		for i in range(9):
+			pool.updatePrivateData("deal-1", "Batman", {"round": i})
+		# Batman's history of deal-1 has 10 versions, 4 of them spilled
+		self.assertEqual((metrics.history_versions, metrics.largest_history), (6 + 1 + 1 + 1, 10))
+
+		pool.cancel("deal-1", "Batman")
+		self.assertEqual((metrics.history_versions, metrics.largest_history), (2, 1))
+		self.assertIn("# TYPE haggling_history_versions gauge\nhaggling_history_versions 2\n", metrics.exposition())
+		retention.close()
+
+	def test_disable_restores_methods(self):
+		self.assertIsNot(Haggler._submit, self.submit)
+		metrics.disable()
+		self.assertIs(Haggler._submit, self.submit)
+		Haggler("Batman", "Superman").submit("Superman", "Batman", Offer("Batmobile", 500, 5))
+		self.assertEqual(metrics.actions[ACTION_SUBMIT].count, 0)
+
+
+class TestExport(unittest.TestCase):
+
+	def setUp(self):
+		self.pool = HagglerPool(errors="return")
+		self.pool.createMany([("deal-1", "Batman", "Superman"), ("deal-2", "Batman", "Robin")])
+		self.pool.submit("deal-1", "Superman", "Batman", Offer("Batmobile", 500, 5))
+		self.pool.updatePrivateData("deal-1", "Superman", {"reference": "order123"})
+		self.pool.proposeUpdate("deal-1", "Batman", Offer("Batmobile", 450, 5))
+		self.pool.submit("deal-2", "Robin", "Batman", Offer("Batarang", 20, 100))
+		self.pool.accept("deal-2", "Batman")
+
+	def test_table_is_print_history(self):
+		haggler = self.pool.get("deal-1")
+		printed = io.StringIO()
+		with contextlib.redirect_stdout(printed):
+			haggler.printHistory("Superman")
+		exported = io.StringIO()
+		self.assertEqual(haggler.exportHistory(exported, "Superman"), 3)
+		self.assertEqual(printed.getvalue(), exported.getvalue() + "\n")
+		self.assertEqual(exported.getvalue().count("\n"), 4)
+		self.assertIn("2250", exported.getvalue())
+
+	def test_csv_and_jsonl(self):
+		haggler = self.pool.get("deal-1")
+		rows = list(csv.DictReader(haggler.iterHistory("Superman", EXPORT_CSV)))
+		self.assertEqual([row["action"] for row in rows], ["Submit", "UpdatePrivateData", "ProposeUpdate"])
+		self.assertEqual(json.loads(rows[1]["private_info"]), {"reference": "order123"})
+
+		records = [json.loads(line) for line in haggler.iterHistory("Superman", EXPORT_JSONL)]
+		self.assertEqual(records[2], dict(vars(haggler.returnVersion("Superman", 3)), private_info={"reference": "order123"}))
+		self.assertIsNone(haggler.iterHistory("Joker", EXPORT_CSV))
+		self.assertRaises(ValueError, haggler.iterHistory, "Superman", "xml")
+
+	def test_pool(self):
+		exported = io.StringIO()
+		self.assertEqual(self.pool.exportHistories(exported, EXPORT_CSV), 9)
+		rows = list(csv.DictReader(io.StringIO(exported.getvalue())))
+		self.assertEqual(len(rows), 9)
+		self.assertEqual({row["negotiation_id"] for row in rows}, {"deal-1", "deal-2"})
+
+		exported = io.StringIO()
+		self.assertEqual(self.pool.exportHistories(exported, EXPORT_JSONL, ["deal-2", "deal-3"], ["Robin"]), 2)
+		records = [json.loads(line) for line in exported.getvalue().splitlines()]
+		self.assertEqual([(r["negotiation_id"], r["user_id"], r["action"]) for r in records], [("deal-2", "Robin", "Submit"), ("deal-2", "Robin", "Accept")])
+
+		tables = "".join(self.pool.iterHistories(negotiation_ids=["deal-2"]))
+		self.assertEqual(tables.count("Negotiation deal-2, user "), 2)
+
+
+@unittest.skipIf(numpy is None, "needs numpy")
+class TestHistoryArrays(unittest.TestCase):
+
+	def setUp(self):
+		self.pool = HagglerPool(errors="return")
+		for n, (product, ending) in enumerate([("Batmobile", "accept"), ("Batmobile", "cancel"), ("Batarang", None)]):
+			self.pool.create(n, "Batman", "Superman")
+			self.pool.submit(n, "Superman", "Batman", Offer(product, 100, 5))
+			self.pool.updatePrivateData(n, "Superman", {"reference": n})
+			self.pool.proposeUpdate(n, "Batman", Offer(product, 90 - n * 10, 5))
+			if ending == "accept":
+				self.pool.accept(n, "Superman")
+			elif ending == "cancel":
+				self.pool.cancel(n, "Batman")
+
+	def test_arrays(self):
+		arrays = self.pool.historyArrays()
+		self.assertEqual(arrays.negotiation_ids, [2, 0, 1])
+		self.assertEqual(arrays.user_ids, ["Batman", "Superman"])
+		self.assertEqual(len(arrays), sum(len(h.users[u].offer_history)
+			for h in [self.pool.get(n) for n in range(3)] for u in h.users))
+
+		offers = arrays.offers
+		row = offers[(offers["negotiation"] == 1) & (offers["slot"] == 1)][-1]
+		expected = self.pool.get(0).users["Superman"].offer_history[-1]
+		self.assertEqual((row["version"], row["action"], row["state"]), (expected.version, expected.action_code, expected.state_code))
+		self.assertEqual(arrays.products[row["product"]], "Batmobile")
+		self.assertEqual((row["price"], row["quantity"], row["full_price"]), (90, 5, 450))
+
+		# the same for a single Haggler, and for event sourced histories
+		single = self.pool.get(2).historyArrays(user_ids=["Superman"])
+		self.assertEqual(list(single.offers["version"]), [1, 2, 3])
+		sourced = HagglerPool(errors="return", event_sourced=True)
+		sourced.create(0, "Batman", "Superman")
+		sourced.submit(0, "Superman", "Batman", Offer("Batmobile", 100, 5))
+		self.assertEqual(list(sourced.historyArrays().offers["state"]), [STATE_AWAITING_MY_ACCEPTANCE, STATE_AWAITING_THEIR_ACCEPTANCE])
+
+	def test_analytics(self):
+		arrays = self.pool.historyArrays()
+		rounds, concessions = arrays.concessions()
+		self.assertEqual(list(rounds), [0, 1, 0, 1, 0, 1])
+		self.assertEqual([round(c, 6) for c in arrays.meanConcessionByRound()], [0, 0.2])
+
+		negotiations, versions = arrays.timeToAccept()
+		self.assertEqual([arrays.negotiation_ids[n] for n in negotiations], [0])
+		self.assertEqual(list(versions), [3])
+
+		self.assertEqual(arrays.outcomesByProduct(), {
+			"Batarang": {"negotiations": 1, "accepted": 0.0, "cancelled": 0.0},
+			"Batmobile": {"negotiations": 2, "accepted": 0.5, "cancelled": 0.5},
+		})
+		self.assertEqual(HagglerPool().historyArrays().outcomesByProduct(), {})
+
+
+class TestHistorySince(unittest.TestCase):
+
+	def test_haggler(self):
+		for event_sourced in (False, True):
+			haggler = Haggler("Batman", "Superman", event_sourced, errors="return")
+			haggler.submit("Superman", "Batman", Offer("Batmobile", 500, 5))
+			offers, cursor = haggler.historySince("Superman")
+			self.assertEqual(([o.action for o in offers], cursor), (["Submit"], 1))
+
+			haggler.updatePrivateData("Superman", {"reference": "order123"})
+			haggler.proposeUpdate("Batman", Offer("Batmobile", 450, 5))
+			offers, cursor = haggler.historySince("Superman", cursor)
+			self.assertEqual(([o.version for o in offers], cursor), ([2, 3], 3))
+			self.assertEqual(haggler.historySince("Superman", cursor), ([], 3))
+			self.assertEqual(haggler.historySince("Superman", 7), ([], 7))
+			self.assertEqual(haggler.historySince("Joker"), ([], 0))
+
+	def test_pool(self):
+		with tempfile.TemporaryDirectory() as directory:
+			path = os.path.join(directory, "haggling.wal")
+			pool = HagglerPool(errors="return", journal=True, wal=WriteAheadLog(path, fsync="never"))
+			pool.createMany([("deal-1", "Batman", "Superman"), ("deal-2", "Batman", "Robin")])
+			pool.submit("deal-1", "Superman", "Batman", Offer("Batmobile", 500, 5))
+			pool.applyBatch([("deal-2", "submit", "Robin", ("Batman", Offer("Batarang", 20, 100)))])
+			offers, cursor = pool.historySince("Batman")
+			self.assertEqual([(n, o.action) for n, o in offers], [("deal-1", "Submit"), ("deal-2", "Submit")])
+
+			pool.updatePrivateData("deal-1", "Superman", {"reference": "order123"})
+			pool.accept("deal-2", "Batman")
+			offers, cursor = pool.historySince("Batman", cursor)
+			self.assertEqual([(n, o.version, o.state) for n, o in offers], [("deal-2", 2, "Accepted")])
+			self.assertEqual(pool.historySince("Batman", cursor), ([], 3))
+			pool.wal.close()
+
+			# replaying the log rebuilds the same journal
+			recovered = HagglerPool.recover(path, journal=True)
+			recovered.wal.close()
+			self.assertEqual(recovered.journal, pool.journal)
+
+		self.assertRaises(ValueError, HagglerPool().historySince, "Batman")
+
+
+class TestChangeFeed(unittest.TestCase):
+
+	def setUp(self):
+		self.feed = ChangeFeed()
+		self.pool = HagglerPool(errors="return", feed=self.feed)
+		self.pool.createMany([("deal-1", "Batman", "Superman"), ("deal-2", "Batman", "Robin")])
+
+	def act(self):
+		self.pool.submit("deal-1", "Superman", "Batman", Offer("Batmobile", 500, 5))
+		self.pool.updatePrivateData("deal-1", "Superman", {"reference": "order123"})
+		self.pool.submit("deal-2", "Robin", "Batman", Offer("Batarang", 20, 100))
+		self.pool.accept("deal-2", "Batman")
+
+	def test_closed_loop(self):
+		subscription = self.feed.subscribe()
+		loop = asyncio.new_event_loop()
+		task = loop.create_task(subscription.next())
+		loop.run_until_complete(asyncio.sleep(0))
+		task.cancel()
+		loop.run_until_complete(asyncio.gather(task, return_exceptions=True))
+		loop.close()
+
+		# the action succeeds and the subscription whose loop is gone is closed
+		self.assertEqual(self.pool.submit("deal-1", "Superman", "Batman", Offer("Batmobile", 500, 5)), RESULT_OK)
+		self.assertTrue(subscription.closed)
+		self.assertIsInstance(subscription.error, RuntimeError)
+		self.assertEqual(self.feed.subscriptions, [])
+		self.assertEqual(len(subscription.poll()), 1)
+
+	def test_filters_and_batches(self):
+		everything = self.feed.subscribe(batch_size=4)
+		batman = self.feed.subscribe(user_ids=["Batman"], kind=EVENT_STATE)
+		deal_1 = self.feed.subscribe(negotiation_ids=["deal-1"], user_ids=["Superman"])
+		self.act()
+
+		self.assertEqual([len(everything.poll()) for _ in range(3)], [4, 3, 0])
+		self.assertEqual([(e.negotiation_id, e.previous_state, e.state) for e in batman.poll()], [
+			("deal-1", None, "AwaitingMyAcceptance"),
+			("deal-2", None, "AwaitingMyAcceptance"),
+			("deal-2", "AwaitingMyAcceptance", "Accepted"),
+		])
+		events = deal_1.poll()
+		self.assertEqual([(e.action, e.version) for e in events], [("Submit", 1), ("UpdatePrivateData", 2)])
+		self.assertEqual(events[1].offer.private_info, {"reference": "order123"})
+
+	def test_overflow_and_callback(self):
+		oldest = self.feed.subscribe(buffer_size=2)
+		newest = self.feed.subscribe(buffer_size=2, overflow=OVERFLOW_DROP_NEWEST)
+		closing = self.feed.subscribe(buffer_size=2, overflow=OVERFLOW_CLOSE)
+		batches = []
+		pushed = self.feed.subscribe(batch_size=3, callback=batches.append)
+		self.act()
+
+		self.assertEqual([(e.negotiation_id, e.version) for e in oldest.poll()], [("deal-2", 2), ("deal-2", 2)])
+		self.assertEqual([(e.negotiation_id, e.version) for e in newest.poll()], [("deal-1", 1), ("deal-1", 1)])
+		self.assertEqual((oldest.dropped, newest.dropped, closing.dropped), (5, 5, 1))
+		self.assertTrue(closing.closed)
+		self.assertEqual(self.feed.subscriptions, [oldest, newest, pushed])
+
+		self.assertEqual([len(b) for b in batches], [3, 3])
+		self.feed.flush()
+		self.assertEqual([len(b) for b in batches], [3, 3, 1])
+		self.assertRaises(ValueError, self.feed.subscribe, overflow="block")
+
+	def test_async_consumer(self):
+		subscription = self.feed.subscribe(user_ids=["Robin"])
+
+		async def consume():
+			events = []
+			async for batch in subscription:
+				events.extend(batch)
+				if len(events) == 2:
+					subscription.close()
+			return events
+
+		async def main():
+			consumer = asyncio.ensure_future(consume())
+			await asyncio.sleep(0)
+			# the second action comes from another thread
+			self.pool.submit("deal-2", "Robin", "Batman", Offer("Batarang", 20, 100))
+			thread = threading.Thread(target=self.pool.withdraw, args=("deal-2", "Robin"))
+			thread.start()
+			thread.join()
+			return await asyncio.wait_for(consumer, 5)
+
+		events = asyncio.run(main())
+		self.assertEqual([e.action for e in events], ["Submit", "Withdraw"])
+		self.assertEqual(asyncio.run(self.feed.subscribe().next(timeout=0.01)), [])
+
+
+class TestTimeline(unittest.TestCase):
+
+	def play(self, haggler):
+		"""
+		Takes 300 actions, mostly one sided, and returns the versions of both Users
+		after each step.
+		"""
+		users = haggler.users["Batman"], haggler.users["Superman"]
+		haggler.submit("Superman", "Batman", Offer("Batmobile", 500, 5))
+		expected = [(0, 0), (1, 1)]
+		for i in range(300):
+			if i % 7 == 0:
+				self.assertEqual(haggler.proposeUpdate(("Batman", "Superman")[i // 7 % 2], Offer("Batmobile", 500 - i, 5)), RESULT_OK)
+			else:
+				haggler.updatePrivateData(("Batman", "Superman")[i % 3 == 0], {"round": i})
+			expected.append(tuple(len(u.offer_history) for u in users))
+		return expected
+
+	def assertTimeline(self, haggler, expected):
+		for step, (i, j) in enumerate(expected):
+			self.assertEqual(haggler.versionsAt(step), {"Batman": i, "Superman": j})
+			state = haggler.jointState(step)
+			self.assertEqual((state["Batman"].version, state["Superman"].version) if i else (None, None), (i or None, j or None))
+		for version in range(1, expected[-1][0] + 1):
+			step = haggler.stepOf("Batman", version)
+			self.assertEqual(expected[step][0], version)
+			self.assertEqual(expected[step - 1][0], version - 1)
+			self.assertEqual(haggler.mapVersion("Batman", version), expected[step][1])
+
+	def test_haggler(self):
+		for event_sourced in (False, True):
+			haggler = Haggler("Batman", "Superman", event_sourced, errors="return")
+			expected = self.play(haggler)
+			self.assertGreater(len(expected), 4 * 64)
+			self.assertTimeline(haggler, expected)
+			self.assertEqual(haggler.mapVersion("Superman", 1), 1)
+			self.assertEqual(haggler.versionsAt(len(expected)), {})
+			self.assertEqual(haggler.stepOf("Joker", 1), None)
+			self.assertEqual(haggler.mapVersion("Batman", 1000), None)
+
+			# steps taken after the timeline was made extend it
+			haggler.accept("Superman")
+			self.assertEqual(haggler.jointState(len(expected))["Superman"].state, "Accepted")
+
+	def test_restored(self):
+		pool = HagglerPool(errors="return")
+		pool.create("deal-1", "Batman", "Superman")
+		expected = self.play(pool.get("deal-1"))
+		with tempfile.TemporaryDirectory() as directory:
+			path = os.path.join(directory, "pool.snapshot")
+			pool.snapshot(path)
+			restored = HagglerPool.restore(path)
+			self.assertTimeline(restored.get("deal-1"), expected)
+			self.assertEqual(restored.mapVersion("deal-1", "Superman", 1), 1)
+
+			archive = ColumnarArchive(os.path.join(directory, "deals.archive"), errors="return")
+			archive["deal-1"] = pool.get("deal-1")
+			self.assertTimeline(archive["deal-1"], expected)
+			archive.close()
+
+	def test_round_trip(self):
+		pool = HagglerPool(errors="return")
+		pool.create("deal-1", "Batman", "Superman")
+		haggler = pool.get("deal-1")
+		haggler.submit("Superman", "Batman", Offer("Batmobile", 500, 5))
+		haggler.updatePrivateData("Batman", {"round": 1})
+		haggler.updatePrivateData("Superman", {"round": 2})
+		expected = [(0, 0), (1, 1), (2, 1), (2, 2)]
+		self.assertTimeline(haggler, expected)
+		self.assertEqual(haggler.stepOf("Batman", 2), 2)
+		with tempfile.TemporaryDirectory() as directory:
+			path = os.path.join(directory, "pool.snapshot")
+			pool.snapshot(path)
+			restored = HagglerPool.restore(path).get("deal-1")
+			archive = ColumnarArchive(os.path.join(directory, "deals.archive"), errors="return")
+			archive["deal-1"] = haggler
+			for copy in (restored, archive["deal-1"]):
+				self.assertEqual(bytes(copy.steps), bytes(haggler.steps))
+				self.assertTimeline(copy, expected)
+				for step in range(len(expected)):
+					self.assertEqual(
+						{name: state and state.version for name, state in copy.jointState(step).items()},
+						{name: state and state.version for name, state in haggler.jointState(step).items()})
+				for name in ("Batman", "Superman"):
+					for version in (1, 2):
+						self.assertEqual(copy.stepOf(name, version), haggler.stepOf(name, version))
+			archive.close()
+
+	def test_threadsafe(self):
+		haggler = ThreadSafeHaggler("Batman", "Superman", errors="return")
+		expected = self.play(haggler)
+		view = haggler.view
+		self.assertTimeline(haggler, expected)
+		# a view does not see steps taken after it
+		haggler.updatePrivateData("Batman", {"round": "last"})
+		self.assertEqual(view.versionsAt(len(expected)), {})
+		self.assertEqual(haggler.versionsAt(len(expected))["Batman"], expected[-1][0] + 1)
+
+	def test_view_lock_free(self):
+		haggler = ThreadSafeHaggler("Batman", "Superman", errors="return")
+		expected = self.play(haggler)
+		view = haggler.view
+		results = []
+		# a writer holding the lock does not stall readers, at any step
+		with haggler.lock:
+			reader = threading.Thread(target=lambda: results.append([view.versionsAt(step) for step in range(len(expected))]))
+			reader.start()
+			reader.join(5)
+		self.assertEqual(results, [[{"Batman": i, "Superman": j} for i, j in expected]])
+
+class TestRetention(unittest.TestCase):
+
+	def play(self, haggler, *negotiation_id):
+		"""
+		Takes 600 actions, mostly private data updates, on a Haggler or on a
+		negotiation of a HagglerPool.
+		"""
+		haggler.submit(*negotiation_id, "Superman", "Batman", Offer("Batmobile", 500, 5))
+		haggler.updatePrivateData(*negotiation_id, "Batman", {"key{0}".format(k): k for k in range(40)})
+		for i in range(600):
+			if i % 9 == 0:
+				haggler.proposeUpdate(*negotiation_id, ("Batman", "Superman")[i // 9 % 2], Offer("Batmobile", 500 - i, 5))
+			else:
+				haggler.updatePrivateData(*negotiation_id, ("Batman", "Superman")[i % 4 == 0], {"key{0}".format(i % 50): i})
+
+	def assertSameHistories(self, haggler, expected):
+		for user_id in ("Batman", "Superman"):
+			history = haggler.users[user_id].offer_history
+			self.assertEqual(len(history), len(expected.users[user_id].offer_history))
+			for offer, expected_offer in zip(history, expected.users[user_id].offer_history):
+				self.assertEqual(offer.__getstate__(), expected_offer.__getstate__())
+
+	def test_haggler(self):
+		expected = Haggler("Batman", "Superman", errors="return")
+		self.play(expected)
+		sizes = {}
+		for compact in (False, True):
+			retention = HistoryRetention(keep=10, spill=16, cache=2, compact=compact)
+			haggler = Haggler("Batman", "Superman", errors="return", retention=retention)
+			self.play(haggler)
+			self.assertSameHistories(haggler, expected)
+			history = haggler.users["Batman"].offer_history
+			self.assertLess(len(history.hot), 10 + 16)
+			self.assertGreater(retention.spilled, 500)
+
+			# spilled versions read back the same, in any order
+			n = len(history)
+			for version in list(range(n, 0, -7)) + list(range(1, n + 1, 5)):
+				self.assertEqual(haggler.returnVersion("Batman", version).__getstate__(),
+					expected.returnVersion("Batman", version).__getstate__())
+				self.assertEqual(haggler.versionDifferences("Batman", version, n - version + 1),
+					expected.versionDifferences("Batman", version, n - version + 1))
+			self.assertLessEqual(len(retention._chunks), 2)
+			self.assertEqual(haggler.returnVersion("Batman", n + 1), None)
+			for version in (1, 100):
+				printed = io.StringIO()
+				with contextlib.redirect_stdout(printed):
+					haggler.printVersion("Batman", version)
+					expected.printVersion("Batman", version)
+				lines = printed.getvalue().splitlines()
+				self.assertEqual(lines[:len(lines) // 2], lines[len(lines) // 2:])
+			sizes[compact] = retention.size
+			retention.close()
+		# runs of private data updates only store the key they change
+		self.assertLess(sizes[True] * 3, sizes[False])
+
+	def test_pool(self):
+		expected = Haggler("Batman", "Superman", errors="return")
+		self.play(expected)
+		with tempfile.TemporaryDirectory() as directory:
+			retention = HistoryRetention(keep=20, spill=8, path=os.path.join(directory, "histories.segment"))
+			pool = HagglerPool(errors="return", retention=retention, wal=WriteAheadLog(os.path.join(directory, "pool.wal")))
+			pool.create("deal-1", "Batman", "Superman")
+			self.play(pool, "deal-1")
+			self.assertSameHistories(pool.get("deal-1"), expected)
+			pool.wal.close()
+
+			recovered = HagglerPool.recover(os.path.join(directory, "pool.wal"), errors="return", retention=HistoryRetention(keep=5))
+			self.assertSameHistories(recovered.get("deal-1"), expected)
+			self.assertGreater(recovered.retention.spilled, 0)
+
+			pool.snapshot(os.path.join(directory, "pool.snapshot"))
+			restored = HagglerPool.restore(os.path.join(directory, "pool.snapshot"), retention=HistoryRetention(keep=5))
+			self.assertSameHistories(restored.get("deal-1"), expected)
+			self.assertGreater(restored.retention.spilled, 0)
+
+			retention.close()
+			self.assertFalse(os.path.exists(os.path.join(directory, "histories.segment")))
+
+		with self.assertRaises(ValueError):
+			HagglerPool(event_sourced=True, retention=HistoryRetention())
+		with self.assertRaises(ValueError):
+			HagglerPool(threadsafe=True, retention=HistoryRetention())
+		with self.assertRaises(ValueError):
+			HistoryRetention(spill=0)
+
+class TestExpiry(unittest.TestCase):
+
+	def setUp(self):
+		self.now = 0.0
+		self.clock = lambda: self.now
+
+	def test_wheel(self):
+		# against the deadlines of every timer, over jumps from a fraction of a tick
+		# to far past the top level
+		rng = random.Random(1)
+		wheel = TimingWheel(tick=0.5, slots=8, levels=3, clock=self.clock)
+		deadlines = {}
+		for _ in range(3000):
+			r = rng.random()
+			if r < 0.5:
+				key = rng.randrange(300)
+				deadline = self.now + rng.choice((rng.uniform(-2, 2), rng.uniform(0, 50), rng.uniform(0, 5000)))
+				wheel.schedule(key, deadline)
+				deadlines[key] = deadline
+			elif r < 0.6:
+				key = rng.randrange(300)
+				self.assertEqual(wheel.cancel(key), key in deadlines)
+				deadlines.pop(key, None)
+			else:
+				self.now += rng.choice((0.2, 0.5, rng.uniform(0, 40), rng.uniform(0, 3000)))
+				expected = {key for key, deadline in deadlines.items() if math.ceil(deadline / 0.5) <= self.now // 0.5}
+				self.assertEqual(sorted(wheel.advance()), sorted(expected))
+				for key in expected:
+					del deadlines[key]
+			self.assertEqual(len(wheel), len(deadlines))
+
+	def test_pool(self):
+		pool = HagglerPool(errors="return", expiry=ExpiryScheduler(offer_ttl=30, idle_ttl=100, clock=self.clock))
+		pool.createMany(("deal-{0}".format(n), "Batman", "Superman") for n in range(4))
+		for n in range(3):
+			pool.submit("deal-{0}".format(n), "Superman", "Batman", Offer("Batmobile", 500, 5))
+		self.assertEqual(len(pool.expiry), 6)
+
+		# a counter offer restarts the offer's clock, a withdrawal disarms it
+		self.now = 20
+		pool.proposeUpdate("deal-1", "Batman", Offer("Batmobile", 450, 5))
+		pool.withdraw("deal-2", "Superman")
+		pool.updatePrivateData("deal-2", "Batman", {"walk away": 400})
+		self.now = 29.5
+		self.assertEqual(pool.expire(), [])
+		self.now = 30
+		self.assertEqual(pool.expire(), [("deal-0", "Superman", ACTION_WITHDRAW)])
+		self.assertEqual(pool.get("deal-0").users["Superman"].state, "WithdrawnByMe")
+		self.now = 50
+		self.assertEqual(pool.expire(), [("deal-1", "Batman", ACTION_WITHDRAW)])
+
+		# updatePrivateData is not activity, so deal-2 has been idle since it was withdrawn
+		self.now = 120
+		self.assertEqual(pool.expire(), [("deal-2", "Batman", ACTION_CANCEL)])
+		self.assertIn("deal-2", pool.archive)
+		self.assertEqual(pool.get("deal-2").users["Superman"].state, "Cancelled")
+
+		# a negotiation ended by hand has no deadlines left
+		pool.cancel("deal-1", "Superman")
+		self.now = 1000
+		self.assertEqual(pool.expire(), [("deal-0", "Batman", ACTION_CANCEL)])
+		self.assertEqual(len(pool.expiry), 0)
+		self.assertEqual(sorted(pool.hagglers), ["deal-3"])
+
+		with self.assertRaises(ValueError):
+			HagglerPool().expire()
+		with self.assertRaises(ValueError):
+			ExpiryScheduler()
+
 if __name__ == '__main__':
 	unittest.main()
\ No newline at end of file